@@ -44,6 +44,8 @@ HELP_DICT = {
     "genomeDir": "Genome directory after running `celescope {assay} mkref`.",
     "thread": "Thread to use.",
     "debug": "If this argument is used, celescope may output addtional file for debugging.",
+    "resume": "Skip steps whose inputs, arguments and celescope version are unchanged since their last successful run and whose outputs exist. Steps after a rerun step are always run. Changing `--thread` does not rerun a step, except flv_trust4 assemble whose output depends on it.",
+    "profile": "Show the resource usage of steps in the HTML report. The resource usage is always written to `.profile.json`.",
     "fasta": "Required. Genome fasta file. Use absolute path or relative path to `genomeDir`.",
     "outdir": "Output directory.",
     "matrix_dir": "Match celescope scRNA-Seq matrix directory.",
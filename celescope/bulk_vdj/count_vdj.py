@@ -118,6 +118,17 @@ def format_value(value, total):
     return display
 
 
+def deletion_keys(seq):
+    """
+    Keys of seq with one base deleted. Two sequences of the same length
+    have hamming distance 1 if and only if they share a deletion key.
+
+    >>> sorted(deletion_keys("ACG"))
+    [(0, 'CG'), (1, 'AG'), (2, 'AC')]
+    """
+    return [(i, seq[:i] + seq[i + 1 :]) for i in range(len(seq))]
+
+
 def correct_cdr3_nt(umi_dict, percent=0.1):
     """
     Correct umi_dict in place.
@@ -127,37 +138,82 @@ def correct_cdr3_nt(umi_dict, percent=0.1):
             low_count / high_count < percent, merge low to high.
     Returns:
         correct_dict: dict {low_umi_cdr3: high_umi_cdr3}
+
+    CDR3s are ranked by (umi_count, cdr3_nt) in descending order and processed from the lowest rank.
+    A low CDR3 is merged to the highest ranked CDR3 with hamming distance 1, searching only the leading
+    CDR3s which have the same length as the top CDR3. Candidates are looked up in a deletion-key index
+    instead of comparing against every higher ranked CDR3.
+
+    >>> umi_dict = {"AAAA": 300, "AAAT": 20, "AATT": 1, "CCCC": 50, "AAA": 1}
+    >>> correct_cdr3_nt(umi_dict)
+    {'AATT': 'AAAT', 'AAAT': 'AAAA'}
+    >>> umi_dict
+    {'AAAA': 321, 'CCCC': 50, 'AAA': 1}
     """
     correct_dict = dict()
 
     umi_arr = sorted(umi_dict.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
-
-    while True:
-        # break when only highest in umi_arr
-        if len(umi_arr) <= 1:
+    if len(umi_arr) <= 1:
+        return correct_dict
+
+    # the search for a high CDR3 stops at the first CDR3 with a different length
+    length = len(umi_arr[0][0])
+    n_head = len(umi_arr)
+    for rank, (seq, _count) in enumerate(umi_arr):
+        if len(seq) != length:
+            n_head = rank
             break
-        umi_low = umi_arr.pop()
-        low_seq = umi_low[0]
-        low_count = umi_low[1]
-
-        for umi_kv in umi_arr:
-            high_seq = umi_kv[0]
-            high_count = umi_kv[1]
-            if len(low_seq) != len(high_seq):
-                break
-            if float(low_count / high_count) > percent:
-                break
-            if utils.hamming_distance(low_seq, high_seq) == 1:
-                correct_dict[low_seq] = high_seq
-                n_low = umi_dict[low_seq]
-                # merge
-                umi_dict[high_seq] += n_low
-                del umi_dict[low_seq]
-                break
+
+    # {deletion_key: [rank]}, ranks are in ascending order
+    neighbor_index = defaultdict(list)
+    for rank in range(n_head):
+        for key in deletion_keys(umi_arr[rank][0]):
+            neighbor_index[key].append(rank)
+
+    for rank in range(len(umi_arr) - 1, 0, -1):
+        low_seq, low_count = umi_arr[rank]
+        if len(low_seq) != length:
+            continue
+
+        high_rank = rank
+        for key in deletion_keys(low_seq):
+            if key in neighbor_index:
+                high_rank = min(high_rank, neighbor_index[key][0])
+        if high_rank == rank:
+            continue
+
+        high_seq, high_count = umi_arr[high_rank]
+        # counts decrease with rank, so no higher ranked CDR3 with hamming distance 1 can pass
+        if float(low_count / high_count) > percent:
+            continue
+
+        correct_dict[low_seq] = high_seq
+        n_low = umi_dict[low_seq]
+        # merge
+        umi_dict[high_seq] += n_low
+        del umi_dict[low_seq]
 
     return correct_dict
 
 
+def resolve_correct_dict(correct_dict):
+    """
+    Follow merge chains so that each low CDR3 maps to its final CDR3.
+    correct_dict from correct_cdr3_nt is in merge order, so applying it entry by entry
+    gives the same result.
+
+    >>> resolve_correct_dict({"A": "B", "B": "C", "D": "C"})
+    {'A': 'C', 'B': 'C', 'D': 'C'}
+    """
+    final_dict = {}
+    for low_seq in correct_dict:
+        high_seq = correct_dict[low_seq]
+        while high_seq in correct_dict:
+            high_seq = correct_dict[high_seq]
+        final_dict[low_seq] = high_seq
+    return final_dict
+
+
 def simpson_di(data):
     """Given a hash { 'species': count } , returns the Simpson Diversity Index
 
@@ -314,14 +370,17 @@ class Count_vdj(Step):
             umi_dict = dict(zip(list(clonetypes.nSeqCDR3), list(clonetypes.umi)))
             correct_dict = correct_cdr3_nt(umi_dict)
 
-            for low_nt, high_nt in correct_dict.items():
-                high_aa = df_tmp.loc[df_tmp.nSeqCDR3 == high_nt].aaSeqCDR3.iloc[0]
-                self.productive_file.loc[
-                    self.productive_file.nSeqCDR3 == low_nt, "aaSeqCDR3"
-                ] = high_aa
-                self.productive_file.loc[
-                    self.productive_file.nSeqCDR3 == low_nt, "nSeqCDR3"
-                ] = high_nt
+            if not correct_dict:
+                continue
+            nt_dict = resolve_correct_dict(correct_dict)
+            first_aa = df_tmp.drop_duplicates("nSeqCDR3").set_index("nSeqCDR3")[
+                "aaSeqCDR3"
+            ]
+            aa_dict = {low_nt: first_aa[high_nt] for low_nt, high_nt in nt_dict.items()}
+            is_low = self.productive_file.nSeqCDR3.isin(nt_dict)
+            low_nt = self.productive_file.loc[is_low, "nSeqCDR3"]
+            self.productive_file.loc[is_low, "aaSeqCDR3"] = low_nt.map(aa_dict)
+            self.productive_file.loc[is_low, "nSeqCDR3"] = low_nt.map(nt_dict)
 
         self.productive_file.to_csv(
             self.corrected_productive_file, sep="\t", index=False
@@ -12,7 +12,7 @@ class Count_virus(Count_bam):
     - Taking the bam file as input, count the number of UMIs and reads mapped to the viral genome.
 
     ## Output
-    - {sample_raw_read_count.json} : barcode - UMI - raw_reads_count
+    - `{sample}_raw_read_count.npz` : barcode - ref - UMI - raw read count. Load with `celescope.tools.capture.read_count.Read_count.from_file`.
     """
 
 
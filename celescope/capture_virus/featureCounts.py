@@ -1,11 +1,12 @@
-import json
 import collections
 
+import numpy as np
 import pandas as pd
 import pysam
 
 from celescope.tools import utils
 from celescope.tools.step import Step, s_common
+from celescope.tools.capture.read_count import Read_count
 from celescope.__init__ import HELP_DICT
 
 
@@ -28,22 +29,22 @@ class FeatureCounts(Step):
         return valid_barcodes
 
     @staticmethod
-    def get_valid_umis(filter_read_count_json, valid_barcodes):
+    def get_valid_umis(filter_read_count_file, valid_barcodes):
         barcode_umis = collections.defaultdict(set)
-        with open(filter_read_count_json) as fh:
-            dic = json.load(fh)
-        for barcode in dic:
-            if barcode in valid_barcodes:
-                for ref in dic[barcode]:
-                    for umi in dic[barcode][ref]:
-                        if dic[barcode][ref][umi] > 0:
-                            barcode_umis[barcode].add(umi)
+        rc = Read_count.from_file(filter_read_count_file)
+        is_valid = np.isin(rc.barcodes, list(valid_barcodes))
+        mask = (rc.read_count > 0) & is_valid[rc.barcode_code]
+        for barcode, umi in zip(
+            rc.barcodes[rc.barcode_code[mask]].tolist(),
+            rc.umis[rc.umi_code[mask]].tolist(),
+        ):
+            barcode_umis[barcode].add(umi)
         return barcode_umis
 
     def run_filter(self):
         valid_barcodes = FeatureCounts.get_valid_barcodes(self.args.filter_umi_file)
         barcode_umis = FeatureCounts.get_valid_umis(
-            self.args.filter_read_count_json, valid_barcodes
+            self.args.filter_read_count_file, valid_barcodes
         )
 
         with pysam.AlignmentFile(self.args.bam, "rb") as raw_bam:
@@ -138,8 +139,10 @@ def get_opts_featureCounts(parser, sub_program):
         parser.add_argument("--bam", help="input bam file", required=True)
         parser.add_argument("--filter_umi_file", help="filter umi file", required=True)
         parser.add_argument(
+            "--filter_read_count_file",
             "--filter_read_count_json",
-            help="filter_read_count_json file",
+            dest="filter_read_count_file",
+            help="filtered read count file from the filter step.",
             required=True,
         )
         parser.add_argument(
@@ -52,7 +52,7 @@ class Multi_capture_virus(Multi):
         step = "filter_virus"
         cmd_line = self.get_cmd_line(step, sample)
         raw_read_count_file = (
-            f'{self.outdir_dic[sample]["count_virus"]}/{sample}_raw_read_count.json'
+            f'{self.outdir_dic[sample]["count_virus"]}/{sample}_raw_read_count.npz'
         )
         cmd = (
             f"{cmd_line} "
@@ -80,14 +80,14 @@ class Multi_capture_virus(Multi):
         filter_umi_file = (
             f'{self.outdir_dic[sample]["filter_virus"]}/{sample}_filtered_UMI.csv'
         )
-        filter_read_count_json = f'{self.outdir_dic[sample]["filter_virus"]}/{sample}_filtered_read_count.json'
+        filter_read_count_file = f'{self.outdir_dic[sample]["filter_virus"]}/{sample}_filtered_read_count.npz'
         bam = (
             f'{self.outdir_dic[sample]["star_virus"]}/{sample}_virus_{STAR_BAM_SUFFIX}'
         )
         cmd = (
             f"{cmd_line} "
             f"--filter_umi_file {filter_umi_file} "
-            f"--filter_read_count_json {filter_read_count_json} "
+            f"--filter_read_count_file {filter_read_count_file} "
             f"--bam {bam}"
         )
         self.process_cmd(cmd, step, sample, m=5, x=self.args.thread)
@@ -11,7 +11,7 @@ import argparse
 # However, this approach is only tested on one system.
 import scanpy  # noqa # pylint: disable=unused-import
 
-from celescope.tools import utils
+from celescope.tools import step_cache, utils
 from celescope.__init__ import __VERSION__, ASSAY_LIST
 
 
@@ -54,7 +54,7 @@ def main():
         parser.print_help()
         parser.exit()
     else:
-        args.func(args)
+        step_cache.run_step(args)
 
 
 if __name__ == "__main__":
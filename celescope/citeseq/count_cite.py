@@ -2,6 +2,7 @@ import sys
 
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 from celescope.tools import utils
 from celescope.tools.step import Step, s_common
@@ -14,11 +15,25 @@ TAG_COL = "tag_name"
 
 
 class Count_cite(Step):
+    """
+    ## Features
+    - Count antibody UMI of each cell barcode. (barcode, antibody) pairs are integer-coded and counted
+    into a sparse matrix without dense pivot tables.
+
+    ## Output
+    - `{sample}_citeseq_matrix/` Sparse antibody UMI matrix of cell barcodes.
+    - `{sample}_rna_citeseq_matrix/` RNA matrix with antibody UMI appended as features.
+    - `{sample}_tsne_coord.tsv` t-SNE coordinates with log2(UMI + 1) of each antibody.
+    - `{sample}_citeseq.mtx.gz` Dense antibody x cell UMI table. Only produced when `--dense_tsv` is used.
+    """
+
     def __init__(self, args, display_title):
         super().__init__(args, display_title)
 
         self.df_read_count = pd.read_csv(
-            args.read_count_file, sep="\t", index_col=[0, 1]
+            args.read_count_file,
+            sep="\t",
+            usecols=["barcode", TAG_COL, "read_count"],
         )
 
         self.match_dict = utils.parse_match_dir(args.match_dir)
@@ -32,55 +47,72 @@ class Count_cite(Step):
 
         # out
         self.mtx = f"{self.out_prefix}_citeseq.mtx.gz"
+        self.citeseq_matrix_dir = f"{self.out_prefix}_citeseq_matrix"
         self.matrix_dir = f"{self.out_prefix}_rna_citeseq_matrix"
         self.tsne_file = f"{self.out_prefix}_tsne_coord.tsv"
 
     @utils.add_log
-    def run(self):
+    def get_citeseq_matrix(self):
+        """
+        Each row of the read count file is a UMI. UMI of each (antibody, barcode) pair are counted with integer codes.
+        Antibodies are in the order they first appear in cell barcodes.
+
+        Returns:
+            CountMatrix of antibody x match_barcode
+        """
+        barcode_code = pd.Index(self.match_barcode).get_indexer(
+            self.df_read_count["barcode"]
+        )
+        in_cell = barcode_code >= 0
         mapped_read = int(self.df_read_count["read_count"].sum())
-
-        # in cell
-        df_read_count_in_cell = self.df_read_count[
-            self.df_read_count.index.isin(self.match_barcode, level=0)
-        ]
-        mapped_read_in_cell = int(df_read_count_in_cell["read_count"].sum())
+        mapped_read_in_cell = int(self.df_read_count["read_count"][in_cell].sum())
         self.add_metric(
             name="Mapped Reads in Cells",
             value=mapped_read_in_cell,
             total=mapped_read,
         )
 
-        # UMI
-        df_UMI_in_cell = df_read_count_in_cell.groupby(["barcode", TAG_COL]).agg(
-            {"UMI": "count"}
-        )
-
-        df_temp = df_UMI_in_cell.reset_index().pivot(
-            index="barcode", columns=TAG_COL, values="UMI"
+        tag_code, tag_names = pd.factorize(self.df_read_count[TAG_COL][in_cell])
+        matrix = scipy.sparse.csc_matrix(
+            (
+                np.ones(len(tag_code), dtype=np.int64),
+                (tag_code, barcode_code[in_cell]),
+            ),
+            shape=(len(tag_names), len(self.match_barcode)),
         )
-        df_cell = pd.DataFrame(index=self.match_barcode)
-        df_pivot = pd.merge(
-            df_cell, df_temp, how="left", left_index=True, right_index=True
+        matrix.sum_duplicates()
+        return CountMatrix(Features(tag_names), self.match_barcode, matrix)
+
+    def get_df_tag_cell(self, citeseq_matrix, barcodes):
+        """
+        Returns:
+            dense barcodes x antibody UMI DataFrame. Antibodies are sorted by name.
+        """
+        features = citeseq_matrix.get_features().gene_id
+        feature_order = np.argsort(np.asarray(features, dtype=str), kind="stable")
+        barcode_index = pd.Index(self.match_barcode).get_indexer(barcodes)
+        matrix = citeseq_matrix.get_matrix()[feature_order][:, barcode_index]
+        return pd.DataFrame(
+            matrix.T.toarray(),
+            index=barcodes,
+            columns=[features[i] for i in feature_order],
         )
 
-        # fillna
-        df_pivot.fillna(0, inplace=True)
-        df_pivot = df_pivot.astype(int)
-        df_UMI_cell_out = df_pivot.T
-        df_UMI_cell_out.to_csv(self.mtx, sep="\t", compression="gzip")
+    @utils.add_log
+    def run(self):
+        citeseq_matrix = self.get_citeseq_matrix()
+        citeseq_matrix.to_matrix_dir(self.citeseq_matrix_dir)
+        if self.args.dense_tsv:
+            df_UMI_cell_out = self.get_df_tag_cell(citeseq_matrix, self.match_barcode).T
+            df_UMI_cell_out.to_csv(self.mtx, sep="\t", compression="gzip")
 
         # merge rna matrix
-        tag_names = df_read_count_in_cell.index.get_level_values(1).unique()
-        features = Features(tag_names)
-        citeseq_matrix = CountMatrix.from_dataframe(
-            df_UMI_in_cell, features, barcodes=self.match_barcode, value="UMI"
-        )
         rna_matrix = CountMatrix.from_matrix_dir(matrix_dir=self.match_matrix_dir)
         merged_matrix = rna_matrix.concat_by_barcodes(citeseq_matrix)
         merged_matrix.to_matrix_dir(self.matrix_dir)
 
         # UMI
-        UMIs = df_pivot.apply(sum, axis=1)
+        UMIs = np.asarray(citeseq_matrix.get_matrix().sum(axis=0)).ravel()
         median_umi = round(np.median(UMIs), 2)
         mean_umi = round(np.mean(UMIs), 2)
         self.add_metric(
@@ -94,7 +126,13 @@ class Count_cite(Step):
 
         # out tsne
         if not self.df_rna_tsne.empty:
-            df_log1p = np.log2(df_pivot + 1)
+            match_barcode_set = set(self.match_barcode)
+            tsne_barcodes = [
+                barcode
+                for barcode in self.df_rna_tsne.index
+                if barcode in match_barcode_set
+            ]
+            df_log1p = np.log2(self.get_df_tag_cell(citeseq_matrix, tsne_barcodes) + 1)
             df_tsne = self.df_rna_tsne.merge(
                 df_log1p, left_index=True, right_index=True
             )
@@ -102,6 +140,11 @@ class Count_cite(Step):
 
 
 def get_opts_count_cite(parser, sub_program):
+    parser.add_argument(
+        "--dense_tsv",
+        help="Also write the dense antibody x cell UMI table `{sample}_citeseq.mtx.gz`.",
+        action="store_true",
+    )
     if sub_program:
         parser.add_argument("--match_dir", help=HELP_DICT["match_dir"], required=True)
         parser.add_argument("--read_count_file", help="tag read count file")
@@ -19,7 +19,7 @@ class Multi_citeseq(Multi):
         fq = f'{self.outdir_dic[sample]["barcode"]}/{sample}_2.fq'
         cmd_line = self.get_cmd_line(step, sample)
         cmd = f"{cmd_line} " f"--fq {fq} "
-        self.process_cmd(cmd, step, sample, m=5, x=1)
+        self.process_cmd(cmd, step, sample, m=5, x=self.args.thread)
 
     def count_cite(self, sample):
         step = "count_cite"
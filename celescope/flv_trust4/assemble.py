@@ -1,3 +1,4 @@
+import heapq
 import subprocess
 from collections import defaultdict
 from multiprocessing import Pool
@@ -5,23 +6,59 @@ import math
 import random
 
 import pandas as pd
-import numpy as np
 import pysam
 
 from celescope.tools import utils
 from celescope.tools.step import Step, s_common
 from celescope.flv_trust4.__init__ import CHAIN, REF_DIR, TOOLS_DIR
 
-# split fastq into const N_CHUNK. Different N_CHUNK will cause different results as discussed in
+# split fastq into N_CHUNK(=thread). Different N_CHUNK will cause different results as discussed in
 # https://github.com/liulab-dfci/TRUST4/issues/75
-SPLIT_N_CHUNKS = 4
+# seed used to break ties between barcodes with the same read count
+SPLIT_SEED = 0
+
+
+def split_barcodes(read_count_dict, n_chunk, seed=SPLIT_SEED):
+    """
+    Longest-processing-time bin packing of barcodes by read count.
+    Barcodes are sorted by read count in descending order(ties are shuffled with a fixed seed)
+    and each barcode is assigned to the chunk with the fewest reads.
+
+    Args:
+        read_count_dict: {barcode: read_count}
+        n_chunk: number of chunks
+    Returns:
+        barcode_chunk: {barcode: chunk_index}
+        chunk_read_count: list of read count of each chunk
+
+    >>> barcode_chunk, chunk_read_count = split_barcodes({"A": 10, "B": 6, "C": 5, "D": 1}, 2)
+    >>> chunk_read_count
+    [11, 11]
+    >>> barcode_chunk["A"] == barcode_chunk["D"]
+    True
+    """
+    barcodes = sorted(read_count_dict)
+    random.Random(seed).shuffle(barcodes)
+    barcodes.sort(key=lambda bc: read_count_dict[bc], reverse=True)
+
+    barcode_chunk = {}
+    chunk_read_count = [0] * n_chunk
+    heap = [(0, i) for i in range(n_chunk)]
+    for bc in barcodes:
+        read_count, i = heapq.heappop(heap)
+        barcode_chunk[bc] = i
+        chunk_read_count[i] = read_count + read_count_dict[bc]
+        heapq.heappush(heap, (chunk_read_count[i], i))
+
+    return barcode_chunk, chunk_read_count
 
 
 class Assemble(Step):
     """
     ## Features
 
-    - TRUST4 does not use multi-processing when assembling. By default, the candidate reads are split into 4 chunks to speed up.
+    - TRUST4 does not use multi-processing when assembling. By default, the candidate reads are split by barcode into `--thread` chunks
+    with similar read counts to speed up.
 
     - Keep only full-length contigs.
 
@@ -55,10 +92,8 @@ class Assemble(Step):
         if args.not_split:
             self._n_chunk = 1
         else:
-            self._n_chunk = SPLIT_N_CHUNKS
+            self._n_chunk = self.thread
         self._chains = CHAIN[self.seqtype]
-        # total thread may be higher than argument thread
-        self._single_thread = math.ceil(self.thread / SPLIT_N_CHUNKS)
 
         # outdir
         self.assemble_outdir = f"{self.outdir}/assemble"
@@ -66,6 +101,9 @@ class Assemble(Step):
         for d in [self.assemble_outdir, self.temp_outdir]:
             utils.check_mkdir(dir_name=d)
 
+    def set_chunk_list(self):
+        """chunk arguments for run_assemble and run_annotate. call after n_chunk is final"""
+        self._single_thread = math.ceil(self.thread / self._n_chunk)
         self.temp_outdir_list = [self.temp_outdir] * self._n_chunk
         self.temp_ref_list = [self.ref] * self._n_chunk
         self.temp_name_list = [f"temp_{i}" for i in range(self._n_chunk)]
@@ -82,6 +120,7 @@ class Assemble(Step):
     def split_candidate_reads(self):
         """
         split original candidate reads(_bcrtcr.fq) by barcode into N_CHUNK files
+        with similar read counts.
         """
         read_count_dict, umi_dict = defaultdict(int), defaultdict(set)
         with pysam.FastxFile(self.candidate_fq) as f:
@@ -101,13 +140,16 @@ class Assemble(Step):
         df_count.sort_values(by="UMI", ascending=False, inplace=True)
         df_count.to_csv(f"{self.assemble_outdir}/count.txt", sep="\t", index=False)
 
-        del read_count_dict
         del umi_dict
 
-        # Split barcode list into equal size chunks.
-        random.shuffle(barcode_list)
-        split_barcodes = np.array_split(barcode_list, self._n_chunk)
-        split_barcodes = [set(i) for i in split_barcodes]
+        # avoid empty chunks
+        self._n_chunk = max(1, min(self._n_chunk, len(barcode_list)))
+        self.set_chunk_list()
+        barcode_chunk, chunk_read_count = split_barcodes(read_count_dict, self._n_chunk)
+        del read_count_dict
+        self.split_candidate_reads.logger.info(
+            f"read count of each chunk: {chunk_read_count}"
+        )
 
         fq_list = [
             open(f"{self.temp_outdir}/temp_{i}.fq", "w") for i in range(self._n_chunk)
@@ -125,12 +167,10 @@ class Assemble(Step):
             for read in f:
                 name = read.name
                 bc, umi = name.split(":")[0], name.split(":")[1]
-                for i in range(self._n_chunk):
-                    if bc in split_barcodes[i]:
-                        fq_list[i].write(str(read) + "\n")
-                        bc_list[i].write(f">{name}\n{bc}\n")
-                        umi_list[i].write(f">{name}\n{umi}\n")
-                        break
+                i = barcode_chunk[bc]
+                fq_list[i].write(str(read) + "\n")
+                bc_list[i].write(f">{name}\n{bc}\n")
+                umi_list[i].write(f">{name}\n{umi}\n")
 
         for i in range(self._n_chunk):
             fq_list[i].close()
@@ -142,7 +182,7 @@ class Assemble(Step):
         """
         run assemble for each chunk
         """
-        with Pool(self._n_chunk) as pool:
+        with Pool(min(self._n_chunk, self.thread)) as pool:
             pool.starmap(
                 Assemble.assemble,
                 zip(
@@ -174,7 +214,7 @@ class Assemble(Step):
         """
         run annotate for each chunk
         """
-        with Pool(self._n_chunk) as pool:
+        with Pool(min(self._n_chunk, self.thread)) as pool:
             pool.starmap(
                 Assemble.annotate,
                 zip(
@@ -13,6 +13,11 @@ class Count_fusion(Count_bam):
     - Count the number of reads and umis that
         1. originate from cell barcodes;
         2. align to the fusion site and include flanking sequences of a certain length(default 20bp) on both sides of the fusion site.
+    - The capture bam is read in one pass and does not need to be sorted.
+
+    ## Output
+    - `{sample}_raw_fusion.bam` Reads supporting fusions.
+    - `{sample}_raw_fusion_posSorted.bam` Coordinate-sorted and indexed `{sample}_raw_fusion.bam`. Only produced when `--sort_fusion_bam` is used.
     """
 
     def __init__(self, args, display_title="Count"):
@@ -23,8 +28,13 @@ class Count_fusion(Count_bam):
             "fusion_pos"
         ]
         self.pos_dict = self.read_pos_file(fusion_pos_file)
-        self.posSorted_bam = f"{self.out_prefix}_posSorted.bam"
+        # {ref: (left, pos, right)}
+        self.window_dict = {
+            ref: (pos - self.flanking_base, pos, pos + self.flanking_base)
+            for ref, pos in self.pos_dict.items()
+        }
         self.fusion_bam = f"{self.out_prefix}_raw_fusion.bam"
+        self.posSorted_fusion_bam = f"{self.out_prefix}_raw_fusion_posSorted.bam"
 
     @staticmethod
     def read_pos_file(fusion_pos_file):
@@ -39,49 +49,62 @@ class Count_fusion(Count_bam):
             pos_dict[name] = pos
         return pos_dict
 
+    def get_fusion_window(self, read):
+        """
+        Returns:
+            (ref, left_bases, right_bases) if read overlaps the window around the fusion position. Otherwise None.
+        """
+        if read.is_unmapped:
+            return None
+        ref = read.reference_name
+        if ref not in self.window_dict:
+            return None
+        left, pos, right = self.window_dict[ref]
+        if read.reference_start >= right or read.reference_end <= left:
+            return None
+        left_bases = read.get_overlap(left, pos)
+        right_bases = read.get_overlap(pos, right)
+        return ref, left_bases, right_bases
+
+    @utils.add_log
     def process_bam(self):
         """
-        find valid fusion reads
+        find valid fusion reads in one pass over the unsorted bam
             1. flank the fusion position
             2. match barcode
         """
 
-        with pysam.AlignmentFile(self.posSorted_bam, "rb") as bam:
+        with pysam.AlignmentFile(self.capture_bam, "rb") as bam:
             header = bam.header
             with pysam.AlignmentFile(
                 self.fusion_bam, "wb", header=header
             ) as fusion_bam:
-                for ref in self.pos_dict:
-                    pos = self.pos_dict[ref]
-                    left = pos - self.flanking_base
-                    right = pos + self.flanking_base
-                    for read in bam.fetch(
-                        reference=ref,
-                        start=left,
-                        end=right,
+                for read in bam:
+                    window = self.get_fusion_window(read)
+                    if not window:
+                        continue
+                    ref, left_bases, right_bases = window
+                    if (
+                        left_bases < self.flanking_base
+                        or right_bases < self.flanking_base
                     ):
-                        left_bases = read.get_overlap(left, pos)
-                        right_bases = read.get_overlap(pos, right)
-                        if (
-                            left_bases < self.flanking_base
-                            or right_bases < self.flanking_base
-                        ):
-                            continue
-                        attr = read.query_name.split(":")
-                        barcode = attr[0]
-                        umi = attr[1]
-                        if barcode in self.match_barcode:
-                            fusion_bam.write(read)
-                            self.count_dict[barcode][ref][umi] += 1
+                        continue
+                    attr = read.query_name.split(":")
+                    barcode = attr[0]
+                    umi = attr[1]
+                    if barcode in self.match_barcode:
+                        fusion_bam.write(read)
+                        self.count_dict[barcode][ref][umi] += 1
 
     def run(self):
-        utils.sort_bam(
-            self.args.capture_bam,
-            self.posSorted_bam,
-            threads=self.thread,
-        )
-        utils.index_bam(self.posSorted_bam)
         super().run()
+        if self.args.sort_fusion_bam:
+            utils.sort_bam(
+                self.fusion_bam,
+                self.posSorted_fusion_bam,
+                threads=self.thread,
+            )
+            utils.index_bam(self.posSorted_fusion_bam)
 
 
 def count_fusion(args):
@@ -98,4 +121,9 @@ def get_opts_count_fusion(parser, sub_program):
         help="Number of bases flanking the fusion position.",
         default=5,
     )
+    parser.add_argument(
+        "--sort_fusion_bam",
+        help="Coordinate-sort and index the fusion reads bam for visualization.",
+        action="store_true",
+    )
     get_opts_count_bam(parser, sub_program)
@@ -21,8 +21,8 @@ class Filter_fusion(Filter):
         - 'hard' : Using User provided UMI threshold.
 
     ## Output
-    - `{sample}_corrected_read_count.json` Read counts after UMI correction.
-    - `{sample}_filtered_read_count.json` Filtered read counts.
+    - `{sample}_corrected_read_count.npz` Read counts after UMI correction.
+    - `{sample}_filtered_read_count.npz` Filtered read counts. UMIs filtered by the read threshold have read count 0.
     - `{sample}_filtered_UMI.csv` Filtered UMI counts.
 
     """
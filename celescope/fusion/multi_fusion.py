@@ -51,7 +51,7 @@ class Multi_fusion(Multi):
         step = "filter_fusion"
         cmd_line = self.get_cmd_line(step, sample)
         raw_read_count_file = (
-            f'{self.outdir_dic[sample]["count_fusion"]}/{sample}_raw_read_count.json'
+            f'{self.outdir_dic[sample]["count_fusion"]}/{sample}_raw_read_count.npz'
         )
         cmd = (
             f"{cmd_line} "
@@ -1,4 +1,7 @@
+import glob
 import os
+import shutil
+import tempfile
 from collections import defaultdict
 from concurrent.futures import ProcessPoolExecutor
 
@@ -36,6 +39,63 @@ def razer(fq, outdir, sample, thread):
     return out_bam
 
 
+@add_log
+def group_cell_reads(out_bam, barcodes):
+    """
+    Read the razers3 bam once and group reads by cell barcode.
+
+    Returns:
+        cell_reads: {barcode: {umi: read}}, keep one read for each UMI
+        count_dict: {barcode: {umi: read_count}}
+        header: bam header
+    """
+    barcode_set = set(barcodes)
+    cell_reads = defaultdict(dict)
+    count_dict = defaultdict(dict)
+
+    with pysam.AlignmentFile(out_bam, "rb") as samfile:
+        header = samfile.header
+        for read in samfile:
+            attr = read.query_name.split(":")
+            barcode = attr[0]
+            umi = attr[1]
+            if barcode in barcode_set:
+                # keep one read for each UMI
+                if umi not in cell_reads[barcode]:
+                    cell_reads[barcode][umi] = read
+                    count_dict[barcode][umi] = 1
+                else:
+                    count_dict[barcode][umi] += 1
+
+    return cell_reads, count_dict, header
+
+
+@add_log
+def write_index_and_count(barcodes, count_dict, outdir, sample):
+    """
+    index: assign index(1-based) to cells. cells with reads are valid.
+    """
+    index_list = []
+    for index, barcode in enumerate(barcodes, start=1):
+        index_list.append(
+            {"cell_index": index, "barcode": barcode, "valid": barcode in count_dict}
+        )
+    df_index = pd.DataFrame(index_list, columns=["cell_index", "barcode", "valid"])
+    df_index.set_index("cell_index", inplace=True)
+    index_file = f"{outdir}/{sample}_cell_index.tsv"
+    df_index.to_csv(index_file, sep="\t")
+
+    count_list = []
+    for barcode, umi_dict in count_dict.items():
+        for umi, read_count in umi_dict.items():
+            count_list.append((barcode, umi, read_count))
+    df_count = pd.DataFrame(count_list, columns=["barcode", "UMI", "read_count"])
+    count_file = f"{outdir}/{sample}_UMI_count.tsv"
+    df_count.to_csv(count_file, sep="\t", index=False)
+
+    return index_file, count_file
+
+
 @add_log
 def split_bam(out_bam, barcodes, outdir, sample):
     """
@@ -47,68 +107,21 @@ def split_bam(out_bam, barcodes, outdir, sample):
         count_dict: UMI counts per cell
         index: assign index(1-based) to cells
     """
-
-    # init
-    count_dict = defaultdict(dict)
-    bam_dict = defaultdict(dict)
-    index_dict = defaultdict(dict)
     cells_dir = f"{outdir}/cells/"
-
-    # read bam and split
-    split_bam.logger.info("reading bam...")
-    samfile = pysam.AlignmentFile(out_bam, "rb")
-    header = samfile.header
-    for read in samfile:
-        attr = read.query_name.split(":")
-        barcode = attr[0]
-        umi = attr[1]
-        if barcode in barcodes:
-            # keep one read for each UMI
-            if umi not in bam_dict[barcode]:
-                bam_dict[barcode][umi] = read
-            if umi in count_dict[barcode]:
-                count_dict[barcode][umi] += 1
-            else:
-                count_dict[barcode][umi] = 1
+    bam_dict, count_dict, header = group_cell_reads(out_bam, barcodes)
 
     split_bam.logger.info("writing cell bam...")
-    # write new bam
-    index = 0
-    for barcode in barcodes:
-        # init
-        index += 1
-        index_dict[index]["barcode"] = barcode
-        index_dict[index]["valid"] = False
-
-        # out
+    for index, barcode in enumerate(barcodes, start=1):
         if barcode in bam_dict:
             cell_dir = f"{cells_dir}/cell{index}"
             cell_bam_file = f"{cell_dir}/cell{index}.bam"
             if not os.path.exists(cell_dir):
                 os.makedirs(cell_dir)
-            index_dict[index]["valid"] = True
-            cell_bam = pysam.AlignmentFile(f"{cell_bam_file}", "wb", header=header)
-            for umi in bam_dict[barcode]:
-                read = bam_dict[barcode][umi]
-                cell_bam.write(read)
-            cell_bam.close()
-
-    # out df_index
-    df_index = pd.DataFrame(index_dict).T
-    df_index.index.name = "cell_index"
-    index_file = f"{outdir}/{sample}_cell_index.tsv"
-    df_index.to_csv(index_file, sep="\t")
+            with pysam.AlignmentFile(cell_bam_file, "wb", header=header) as cell_bam:
+                for read in bam_dict[barcode].values():
+                    cell_bam.write(read)
 
-    # out count_dict
-    df_count = pd.DataFrame(count_dict).T
-    df_temp = df_count.stack()
-    df_temp = df_temp.astype(int)
-    df_temp = df_temp.reset_index()
-    df_temp.columns = ["barcode", "UMI", "read_count"]
-    count_file = f"{outdir}/{sample}_UMI_count.tsv"
-    df_temp.to_csv(count_file, sep="\t", index=False)
-
-    return index_file, count_file
+    return write_index_and_count(barcodes, count_dict, outdir, sample)
 
 
 def sub_typing(bam):
@@ -142,11 +155,94 @@ def hla_typing(index_file, outdir, thread):
             all_res.append(res)
 
 
+def typing_batch(batch, header_dict, scratch_dir=None):
+    """
+    Type a batch of cells in one worker process.
+    Each cell bam is written to a local scratch directory and removed after typing.
+
+    Args:
+        batch: list of (cell_index, barcode, reads), reads are SAM strings.
+        header_dict: bam header dict
+    Returns:
+        list of typing result DataFrame
+    """
+    header = pysam.AlignmentHeader.from_dict(header_dict)
+    work_dir = tempfile.mkdtemp(prefix="hla_typing_", dir=scratch_dir)
+    sub_df_list = []
+    try:
+        for index, barcode, reads in batch:
+            bam = f"{work_dir}/cell{index}.bam"
+            with pysam.AlignmentFile(bam, "wb", header=header) as cell_bam:
+                for read in reads:
+                    cell_bam.write(pysam.AlignedSegment.fromstring(read, header))
+            sub_typing(bam)
+
+            result_file = f"{work_dir}/cell{index}_result.tsv"
+            if os.path.exists(result_file):
+                sub_df = pd.read_csv(result_file, sep="\t", index_col=0)
+                sub_df["barcode"] = barcode
+                sub_df["cell_index"] = index
+                sub_df_list.append(sub_df)
+            for f in glob.glob(f"{work_dir}/cell{index}[._]*"):
+                if os.path.isdir(f):
+                    shutil.rmtree(f)
+                else:
+                    os.remove(f)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return sub_df_list
+
+
+@add_log
+def batch_hla_typing(barcodes, cell_reads, header, thread, scratch_dir=None):
+    """
+    Type cells in `thread` batches. No per-cell files are kept.
+
+    Returns:
+        list of typing result DataFrame
+    """
+    cells = []
+    for index, barcode in enumerate(barcodes, start=1):
+        if barcode in cell_reads:
+            reads = [read.to_string() for read in cell_reads[barcode].values()]
+            cells.append((index, barcode, reads))
+    if not cells:
+        return []
+
+    n_batch = min(thread, len(cells))
+    batches = [cells[i::n_batch] for i in range(n_batch)]
+    header_dict = header.to_dict()
+    sub_df_list = []
+    with ProcessPoolExecutor(n_batch) as pool:
+        for res in pool.map(
+            typing_batch,
+            batches,
+            [header_dict] * n_batch,
+            [scratch_dir] * n_batch,
+        ):
+            sub_df_list += res
+    sub_df_list.sort(key=lambda sub_df: sub_df["cell_index"].iloc[0])
+    return sub_df_list
+
+
+@add_log
+def write_typing(sub_df_list, outdir, sample):
+    out_file = f"{outdir}/{sample}_typing.tsv"
+    if not sub_df_list:
+        write_typing.logger.warning("No typing result found.")
+        return
+    all_df = pd.concat(sub_df_list, ignore_index=True)
+    all_df["Reads"] = all_df["Reads"].apply(int)
+    all_df = all_df[all_df["Reads"] != 0]
+    all_df = all_df.drop("Objective", axis=1)
+    all_df.to_csv(out_file, sep="\t", index=False)
+
+
 @add_log
 def summary(index_file, outdir, sample):
-    n = 0
     df_valid = read_index(index_file)
 
+    sub_df_list = []
     for index in df_valid.index:
         try:
             sub_df = pd.read_csv(
@@ -156,18 +252,10 @@ def summary(index_file, outdir, sample):
             )
         except FileNotFoundError:
             continue
-        n += 1
         sub_df["barcode"] = df_valid.loc[index, :]["barcode"]
         sub_df["cell_index"] = index
-        if n == 1:
-            all_df = sub_df
-        else:
-            all_df = all_df.append(sub_df, ignore_index=True)
-    all_df["Reads"] = all_df["Reads"].apply(int)
-    all_df = all_df[all_df["Reads"] != 0]
-    all_df = all_df.drop("Objective", axis=1)
-    out_file = f"{outdir}/{sample}_typing.tsv"
-    all_df.to_csv(out_file, sep="\t", index=False)
+        sub_df_list.append(sub_df)
+    write_typing(sub_df_list, outdir, sample)
 
 
 @add_log
@@ -188,14 +276,15 @@ def mapping_hla(args):
     # razer
     out_bam = razer(fq, outdir, sample, thread)
 
-    # split bam
-    index_file, _count_file = split_bam(out_bam, barcodes, outdir, sample)
+    # group reads by cell
+    cell_reads, count_dict, header = group_cell_reads(out_bam, barcodes)
+    write_index_and_count(barcodes, count_dict, outdir, sample)
 
     # typing
-    hla_typing(index_file, outdir, thread)
+    sub_df_list = batch_hla_typing(barcodes, cell_reads, header, thread)
 
     # summary
-    summary(index_file, outdir, sample)
+    write_typing(sub_df_list, outdir, sample)
 
 
 def get_opts_mapping_hla(parser, sub_program):
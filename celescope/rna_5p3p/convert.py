@@ -3,18 +3,150 @@
 2. 读入3p R1,生成3p barcode + UMI
 """
 
+import gzip
+import itertools
+import os
 import subprocess
+import time
+from collections import defaultdict, deque
+from multiprocessing import Pool
 
 from xopen import xopen
-import pysam
 
 from celescope.tools import utils
 from celescope.tools.__init__ import PATTERN_DICT
 from celescope.tools.step import Step, s_common
 from celescope.tools.barcode import Chemistry, Barcode as Bc
 
+# reads per chunk sent to a worker
+CHUNK_READS = 100_000
+# chunks converted ahead of the writer per worker
+CHUNK_PER_WORKER = 2
+# gzip level of output fastq, the same as the xopen default
+COMPRESS_LEVEL = 1
+
+# pattern dicts and whitelist index, set once in each worker by init_worker
+_state = {}
+
+
+def init_worker(state):
+    _state.update(state)
+
+
+def convert_5p_R1(name, seq1, qual1):
+    """
+    convert 5p R1 to 3p bc
+    """
+    pattern_dict_5p = _state["pattern_dict_5p"]
+    seq_list = Bc.get_seq_list(seq1, pattern_dict_5p, "C")
+    seq_list = [utils.reverse_complement(seq) for seq in seq_list[::-1]]
+    bool_valid, bool_corrected, corrected_seq_list = Bc.check_seq_mismatch(
+        seq_list, _state["barcode_set_list"], _state["barcode_mismatch_list"]
+    )
+    umi = Bc.get_seq_str(seq1, pattern_dict_5p["U"])
+    umi = utils.reverse_complement(umi)
+    if bool_valid:
+        bc = "".join(corrected_seq_list)
+    else:
+        bc = "".join(seq_list)
+    bc_qual = Bc.get_seq_str(qual1, pattern_dict_5p["C"])
+    umi_qual = Bc.get_seq_str(qual1, pattern_dict_5p["U"])
+    return name, bc + umi, bc_qual + umi_qual
+
+
+def convert_5p_R2(name, seq2, qual2):
+    return name, utils.reverse_complement(seq2), qual2[::-1]
+
+
+def convert_3p_R1(name, seq1, qual1):
+    pattern_dict_3p = _state["pattern_dict_3p"]
+    bc = Bc.get_seq_str(seq1, pattern_dict_3p["C"])
+    umi = Bc.get_seq_str(seq1, pattern_dict_3p["U"])
+    bc_qual = Bc.get_seq_str(qual1, pattern_dict_3p["C"])
+    umi_qual = Bc.get_seq_str(qual1, pattern_dict_3p["U"])
+    return name, bc + umi, bc_qual + umi_qual
+
+
+CONVERT_FUNCS = {
+    "5p_R1": convert_5p_R1,
+    "5p_R2": convert_5p_R2,
+    "3p_R1": convert_3p_R1,
+}
+
+
+def read_chunks(fq, chunk_reads=CHUNK_READS):
+    """
+    Yields:
+        list of fastq lines of chunk_reads records
+    """
+    with xopen(fq, "rb", threads=1) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_reads * 4))
+            if not lines:
+                break
+            yield lines
+
+
+def convert_chunk(lines, convert_name):
+    """
+    Returns:
+        gzip member of converted records, number of records, worker pid, seconds used
+    """
+    start = time.time()
+    convert_func = CONVERT_FUNCS[convert_name]
+    out = []
+    for i in range(0, len(lines) - 3, 4):
+        header = lines[i].decode()
+        # the same as pysam FastxFile name: the header before the first whitespace
+        name = header[1:].split(maxsplit=1)[0] if header[1:].strip() else ""
+        seq = lines[i + 1].decode().rstrip()
+        qual = lines[i + 3].decode().rstrip()
+        out.append("@{}\n{}\n+\n{}\n".format(*convert_func(name, seq, qual)))
+    data = gzip.compress("".join(out).encode(), compresslevel=COMPRESS_LEVEL)
+    return data, len(out), os.getpid(), time.time() - start
+
+
+@utils.add_log
+def convert_fastq(in_fq, out_fq, convert_name, pool, n_worker):
+    """
+    Convert in_fq chunk by chunk with pool. Chunks are compressed by workers as gzip members
+    and written in input order, so out_fq is a valid multi-member gzip file.
+    If pool is None, chunks are converted in this process.
+
+    Returns:
+        {worker pid: [number of reads, seconds used]}
+    """
+    worker_stats = defaultdict(lambda: [0, 0.0])
+
+    def write(result):
+        data, n_read, pid, seconds = result
+        out.write(data)
+        worker_stats[pid][0] += n_read
+        worker_stats[pid][1] += seconds
+
+    with open(out_fq, "wb") as out:
+        if pool is None:
+            for lines in read_chunks(in_fq):
+                write(convert_chunk(lines, convert_name))
+        else:
+            pending = deque()
+            for lines in read_chunks(in_fq):
+                pending.append(pool.apply_async(convert_chunk, (lines, convert_name)))
+                if len(pending) >= n_worker * CHUNK_PER_WORKER:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+    return worker_stats
+
 
 class Convert(Step):
+    """
+    ## Features
+    - Convert 5 prime R1 reads to 3 prime barcode and UMI. 5 prime R2 reads are reverse complemented.
+    - Reads are converted in chunks by `--thread` worker processes. Each worker compresses its own chunks
+    and chunks are written in input order.
+    """
+
     def __init__(self, args, display_title=None):
         Step.__init__(self, args, display_title=display_title)
         self.fq1_5p = args.fq1_5p.split(",")
@@ -27,37 +159,28 @@ class Convert(Step):
         self.barcode_set_list, self.barcode_mismatch_list = Bc.parse_whitelist_file(
             whitelist_files, n_pattern=len(self.pattern_dict_5p["C"]), n_mismatch=1
         )
+        self.state = {
+            "pattern_dict_5p": self.pattern_dict_5p,
+            "pattern_dict_3p": self.pattern_dict_3p,
+            "barcode_set_list": self.barcode_set_list,
+            "barcode_mismatch_list": self.barcode_mismatch_list,
+        }
+        self.pool = None
+        self.worker_stats = defaultdict(lambda: [0, 0.0])
 
-    def convert_5p_R1(self, seq1):
-        # convert 5p R1 to 3p bc
-        seq_list = Bc.get_seq_list(seq1, self.pattern_dict_5p, "C")
-        seq_list = [utils.reverse_complement(seq) for seq in seq_list[::-1]]
-        bool_valid, bool_corrected, corrected_seq_list = Bc.check_seq_mismatch(
-            seq_list, self.barcode_set_list, self.barcode_mismatch_list
+    def convert_fastq(self, in_fq, out_fq, convert_name):
+        worker_stats = convert_fastq(
+            in_fq, out_fq, convert_name, self.pool, self.thread
         )
-        umi = Bc.get_seq_str(seq1, self.pattern_dict_5p["U"])
-        umi = utils.reverse_complement(umi)
-        if bool_valid:
-            bc = "".join(corrected_seq_list)
-        else:
-            bc = "".join(seq_list)
-        return bc, umi
+        for pid, (n_read, seconds) in worker_stats.items():
+            self.worker_stats[pid][0] += n_read
+            self.worker_stats[pid][1] += seconds
 
     def write_3p(self):
         for i, (fn1, fn2) in enumerate(zip(self.fq1_3p, self.fq2_3p), start=1):
             out_fn1 = f"{self.out_prefix}_3p{i}_R1.fq.gz"
             out_fn2 = f"{self.out_prefix}_3p{i}_R2.fq.gz"
-            fh_3p = xopen(out_fn1, "w")
-            with pysam.FastxFile(fn1, persist=False) as fq:
-                for entry1 in fq:
-                    header1, seq1, qual1 = entry1.name, entry1.sequence, entry1.quality
-                    bc = Bc.get_seq_str(seq1, self.pattern_dict_3p["C"])
-                    umi = Bc.get_seq_str(seq1, self.pattern_dict_3p["U"])
-                    bc_qual = Bc.get_seq_str(qual1, self.pattern_dict_3p["C"])
-                    umi_qual = Bc.get_seq_str(qual1, self.pattern_dict_3p["U"])
-                    fh_3p.write(
-                        "@{}\n{}\n+\n{}\n".format(header1, bc + umi, bc_qual + umi_qual)
-                    )
+            self.convert_fastq(fn1, out_fn1, "3p_R1")
             cmd = f"ln -s -f {fn2} {out_fn2}"
             subprocess.check_call(cmd, shell=True)
 
@@ -65,29 +188,30 @@ class Convert(Step):
         for i, (fn1, fn2) in enumerate(zip(self.fq1_5p, self.fq2_5p), start=1):
             out_fn1 = f"{self.out_prefix}_5p{i}_R1.fq.gz"
             out_fn2 = f"{self.out_prefix}_5p{i}_R2.fq.gz"
-            fh_5p_1 = xopen(out_fn1, "w")
-            fh_5p_2 = xopen(out_fn2, "w")
-            with pysam.FastxFile(fn1, persist=False) as fq:
-                for entry1 in fq:
-                    header1, seq1, qual1 = entry1.name, entry1.sequence, entry1.quality
-                    bc, umi = self.convert_5p_R1(seq1)
-                    bc_qual = Bc.get_seq_str(qual1, self.pattern_dict_5p["C"])
-                    umi_qual = Bc.get_seq_str(qual1, self.pattern_dict_5p["U"])
-                    fh_5p_1.write(
-                        "@{}\n{}\n+\n{}\n".format(header1, bc + umi, bc_qual + umi_qual)
-                    )
-            fh_5p_1.close()
-            with pysam.FastxFile(fn2, persist=False) as fq:
-                for entry2 in fq:
-                    header2, seq2, qual2 = entry2.name, entry2.sequence, entry2.quality
-                    seq2 = utils.reverse_complement(seq2)
-                    qual2 = qual2[::-1]
-                    fh_5p_2.write("@{}\n{}\n+\n{}\n".format(header2, seq2, qual2))
-            fh_5p_2.close()
+            self.convert_fastq(fn1, out_fn1, "5p_R1")
+            self.convert_fastq(fn2, out_fn2, "5p_R2")
+
+    @utils.add_log
+    def log_worker_stats(self):
+        for i, (n_read, seconds) in enumerate(self.worker_stats.values(), start=1):
+            reads_per_min = int(n_read / seconds * 60) if seconds > 0 else 0
+            self.log_worker_stats.logger.info(
+                f"worker {i}: {n_read} reads, {seconds:.1f} seconds, {reads_per_min} reads/min"
+            )
 
     def run(self):
-        self.write_3p()
-        self.write_5p()
+        init_worker(self.state)
+        if self.thread > 1:
+            with Pool(
+                self.thread, initializer=init_worker, initargs=(self.state,)
+            ) as self.pool:
+                self.write_3p()
+                self.write_5p()
+            self.pool = None
+        else:
+            self.write_3p()
+            self.write_5p()
+        self.log_worker_stats()
 
 
 @utils.add_log
@@ -49,7 +49,7 @@ class Multi_rna_5p3p(Multi):
             f"--fq1_5p {fq1_5p} --fq1_3p {fq1_3p} "
             f"--fq2_5p {fq2_5p} --fq2_3p {fq2_3p} "
         )
-        self.process_cmd(cmd, step, sample, m=self.args.starMem, x=1)
+        self.process_cmd(cmd, step, sample, m=self.args.starMem, x=self.args.thread)
 
     def starsolo(self, sample):
         step = "starsolo"
@@ -15,3 +15,8 @@ __ASSAY__ = "snp"
 IMPORT_DICT = {"star": "celescope.rna"}
 
 PANEL = {"lung_1", "blood_1", "CHIP"}
+
+# java heap(GB) of each gatk SplitNCigarReads in sharded variant_calling
+SPLIT_N_CIGAR_HEAP = 4
+# memory(GB) of variant_calling besides the gatk heaps: JVM overhead, bcftools and the step process
+VARIANT_CALLING_MEM_OVERHEAD = 4
@@ -4,6 +4,7 @@ import sys
 import warnings
 
 import scanpy as sc
+import numpy as np
 import pandas as pd
 import pysam
 import matplotlib
@@ -20,6 +21,9 @@ from celescope.snp.__init__ import PANEL
 matplotlib.use("Agg")
 warnings.filterwarnings("ignore")
 
+# genotype string of missing genotype
+GT_NA = "NA"
+
 AA_DICT = {
     "Gly": "G",
     "Ala": "A",
@@ -92,35 +96,42 @@ def parse_vcf_to_df(vcf_file, cols=("chrom", "pos", "alleles"), infos=("VID", "C
     """
     Read cols and infos into pandas df
     """
-    vcf = pysam.VariantFile(vcf_file)
-    df = pd.DataFrame(columns=[col.capitalize() for col in cols] + infos)
-    rec_dict = {}
-    for rec in vcf.fetch():
-        for col in cols:
-            rec_dict[col.capitalize()] = getattr(rec, col)
-            if col == "alleles":
-                rec_dict["Alleles"] = "-".join(rec_dict["Alleles"])
+    columns = [col.capitalize() for col in cols] + list(infos)
+    data = {column: [] for column in columns}
+    with pysam.VariantFile(vcf_file) as vcf:
+        for rec in vcf.fetch():
+            for col in cols:
+                value = getattr(rec, col)
+                if col == "alleles":
+                    value = "-".join(value)
+                data[col.capitalize()].append(value)
+
+            for info in infos:
+                data[info].append(rec.info[info])
+
+    df = pd.DataFrame(data, columns=columns)
+    return df
 
-        for info in infos:
-            rec_dict[info] = rec.info[info]
 
-        """
-        rec_dict['GT'] = [s['GT'] for s in rec.samples.values()][0]
-        rec_dict['GT'] = [str(item) for item in rec_dict['GT']]
-        rec_dict['GT'] = '/'.join(rec_dict['GT'])
-        """
-        df_new = pd.DataFrame(rec_dict, index=[0])
-        df = pd.concat([df, df_new])
-
-    vcf.close()
-    df.reset_index(drop=True, inplace=True)
-    return df
+def genotype_to_str(genotype):
+    g1, g2 = genotype
+    if g1 is None:
+        return GT_NA
+    return "/".join([str(g1), str(g2)])
 
 
-def vcf_to_gt_csv(vcf_file, csv_file):
+def vcf_to_gt_csv(vcf_file, csv_file, cache_file=None):
+    """
+    Args:
+        cache_file: if set, also save genotypes as an int8 code matrix(row: variant, column: cell) to this `.npz` file.
+            Use `read_gt_cache` to read it.
+    """
     vcf = pysam.VariantFile(vcf_file)
 
     samples = vcf.header.samples
+    categories = {}
+    variants = []
+    codes = []
 
     with open(csv_file, "w") as f:
         header = ["variant"] + list(samples)
@@ -128,21 +139,75 @@ def vcf_to_gt_csv(vcf_file, csv_file):
 
         for record in vcf:
             mutation_name = f"{record.chrom}_{record.pos}"
-            genotypes = []
+            genotypes = [
+                genotype_to_str(record.samples[sample]["GT"]) for sample in samples
+            ]
+
+            line = [mutation_name] + genotypes
+            f.write(",".join(line) + "\n")
 
-            for sample in samples:
-                genotype = record.samples[sample]["GT"]
-                g1, g2 = genotype
+            if cache_file:
+                variants.append(mutation_name)
+                codes.append(
+                    np.array(
+                        [
+                            categories.setdefault(genotype, len(categories))
+                            for genotype in genotypes
+                        ],
+                        dtype=np.int8,
+                    )
+                )
 
-                if g1 is None:
-                    genotype_str = "NA"
-                else:
-                    genotype_str = "/".join([str(g1), str(g2)])
+    vcf.close()
+    if cache_file:
+        np.savez_compressed(
+            cache_file,
+            variants=np.array(variants, dtype=str),
+            cells=np.array(list(samples), dtype=str),
+            categories=np.array(list(categories), dtype=str),
+            codes=np.vstack(codes)
+            if codes
+            else np.zeros((0, len(samples)), dtype=np.int8),
+        )
 
-                genotypes.append(genotype_str)
 
-            line = [mutation_name] + genotypes
-            f.write(",".join(line) + "\n")
+def read_gt_cache(cache_file, rows=None):
+    """
+    Read genotypes from the cache of `vcf_to_gt_csv`.
+    Args:
+        rows: if set, only read these variant rows.
+    Returns:
+        df with the same content as `pd.read_csv(csv_file, keep_default_na=False, index_col=0)`
+    """
+    with np.load(cache_file, allow_pickle=False) as data:
+        codes = data["codes"]
+        variants = data["variants"]
+        if rows is not None:
+            codes = codes[rows]
+            variants = variants[rows]
+        categories = data["categories"]
+        df = pd.DataFrame(
+            categories[codes] if len(categories) else codes.astype(str),
+            index=pd.Index(variants, name="variant"),
+            columns=data["cells"],
+        )
+    return df
+
+
+def gt_cache_to_ncell(cache_file):
+    """
+    Number of cells with each genotype. NA genotypes are not counted.
+    """
+    with np.load(cache_file, allow_pickle=False) as data:
+        codes = data["codes"]
+        categories = data["categories"].tolist()
+        variants = data["variants"]
+    ncell = {}
+    for genotype in sorted(categories):
+        if genotype == GT_NA:
+            continue
+        ncell[genotype] = (codes == categories.index(genotype)).sum(axis=1)
+    return pd.DataFrame(ncell, index=pd.Index(variants, name="variant"))
 
 
 class Analysis_snp(Step):
@@ -152,6 +217,7 @@ class Analysis_snp(Step):
 
     ## Output
     - `{sample}_gt.csv` Genotypes of variants of each cell. Rows are variants and columns are cells.
+    - `{sample}_gt.npz` The same genotypes as an int8 code matrix. Used to build the variant tables and plots.
     - `{sample}_variant_ncell.csv` Number of cells with each genotype.
     - `{sample}_variant_table.csv` annotated with snpEff.
 
@@ -176,20 +242,20 @@ class Analysis_snp(Step):
         self.plot_snp_dir = f"{self.outdir}/{self.sample}_plot_snp/"
 
         self.gt_file = f"{self.out_prefix}_gt.csv"
+        self.gt_cache_file = f"{self.out_prefix}_gt.npz"
         self.ncell_file = f"{self.out_prefix}_variant_ncell.csv"
         self.variant_table_file = f"{self.out_prefix}_variant_table.csv"
 
     @utils.add_log
     def write_gt(self):
-        vcf_to_gt_csv(self.final_vcf_file, self.gt_file)
+        vcf_to_gt_csv(self.final_vcf_file, self.gt_file, self.gt_cache_file)
 
     @utils.add_log
     def write_ncell(self):
         """
-        parse gt_file to collect each genotype cell count into ncell_file
+        collect each genotype cell count into ncell_file
         """
-        df = pd.read_csv(self.gt_file, index_col=0)
-        df_ncell = df.apply(pd.Series.value_counts, axis=1).fillna(0).astype(int)
+        df_ncell = gt_cache_to_ncell(self.gt_cache_file)
         df_ncell.to_csv(self.ncell_file, index=True)
 
     @utils.add_log
@@ -290,11 +356,10 @@ class Analysis_snp(Step):
             return
 
         utils.check_mkdir(self.plot_snp_dir)
-        df_gt = pd.read_csv(self.gt_file, keep_default_na=False, index_col=0)
         df_v = self.variant_table.copy()
         df_v["n_variants"] = df_v["0/1"] + df_v["1/1"]
         indices = df_v.nlargest(self.args.plot_top_n, "n_variants").index
-        df_top = df_gt.iloc[indices,]
+        df_top = read_gt_cache(self.gt_cache_file, rows=indices)
         df_top = df_top.transpose()
         variants = df_top.columns
         for c in variants:
@@ -1,22 +1,197 @@
+import gzip
+import os
+import shutil
+from multiprocessing import Pool
+
+import numpy as np
 import pysam
+import scipy.sparse
 
 from celescope.tools import utils
-from celescope.tools.capture.threshold import Threshold
+from celescope.tools.capture.threshold import Otsu, threshold_batch
 from celescope.tools.step import Step, s_common
 from celescope.__init__ import HELP_DICT
 
 # variant allele frequency (VAF) threshold
 VAF = 0.2
+# number of records processed together in a worker
+BATCH_SIZE = 1000
+# genotype code to GT string
+GT_STRINGS = np.array(["0/0", "0/1", "1/1", "./."])
+
+
+def get_genotype_code(ref_count, alt_count):
+    """
+    Args:
+        ref_count, alt_count: filtered allele count arrays
+    Returns:
+        genotype code array. 0: (0, 0); 1: (0, 1); 2: (1, 1); 3: (None, None)
+
+    >>> get_genotype_code(np.array([10, 5, 1, 10, 0, 0]), np.array([10, 0, 9, 1, 3, 0])).tolist()
+    [1, 0, 2, 0, 2, 3]
+    """
+    ref_count = np.asarray(ref_count)
+    alt_count = np.asarray(alt_count)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        af = alt_count / (alt_count + ref_count)
+    code = np.where(af < VAF, 0, np.where(af <= 1 - VAF, 1, 2))
+    code = np.where((ref_count > 0) & (alt_count == 0), 0, code)
+    code = np.where((ref_count == 0) & (alt_count > 0), 2, code)
+    code = np.where((ref_count == 0) & (alt_count == 0), 3, code)
+    return code
+
+
+def get_contig_ranges(vcf_file):
+    """
+    Records of the same contig are continuous in a sorted VCF.
+    Returns:
+        list of (contig, start_offset, end_offset) of records
+    """
+    ranges = []
+    with open(vcf_file, "rb") as f:
+        offset = 0
+        contig = None
+        start = None
+        for line in f:
+            if not line.startswith(b"#"):
+                line_contig = line.split(b"\t", 1)[0]
+                if line_contig != contig:
+                    if contig is not None:
+                        ranges.append((contig.decode(), start, offset))
+                    contig = line_contig
+                    start = offset
+            offset += len(line)
+        if contig is not None:
+            ranges.append((contig.decode(), start, offset))
+    return ranges
+
+
+def parse_allele_count(fields):
+    """
+    Returns:
+        format keys, sample fields, ref and alt count array of one VCF record
+    """
+    format_keys = fields[8].split(":")
+    ad_index = format_keys.index("AD")
+    sample_fields = [sample.split(":") for sample in fields[9:]]
+    n_allele = len(fields[4].split(",")) + 1
+    missing = ",".join(["0"] * n_allele)
+    ad = [
+        sample[ad_index]
+        if len(sample) > ad_index and sample[ad_index] != "."
+        else missing
+        for sample in sample_fields
+    ]
+    ad_array = np.array(",".join(ad).split(","), dtype=np.int64).reshape(-1, n_allele)
+    return format_keys, sample_fields, ad_array[:, 0], ad_array[:, 1]
+
+
+def filter_records(lines, params):
+    """
+    Filter allele counts and set genotypes of a batch of VCF record lines.
+    Returns:
+        output lines, raw ref and alt read sums of each record
+    """
+    records = [line.rstrip("\n").split("\t") for line in lines]
+    parsed = [parse_allele_count(fields) for fields in records]
+    ref_count = np.vstack([x[2] for x in parsed])
+    alt_count = np.vstack([x[3] for x in parsed])
+    ref_sums = ref_count.sum(axis=1).tolist()
+    alt_sums = alt_count.sum(axis=1).tolist()
+
+    ref_threshold = np.maximum(
+        threshold_batch(
+            scipy.sparse.csr_matrix(ref_count),
+            threshold_method=params["ref_threshold_method"],
+        ),
+        params["ref_min_support_read"],
+    )
+    alt_threshold = np.maximum(
+        threshold_batch(
+            scipy.sparse.csr_matrix(alt_count),
+            threshold_method=params["alt_threshold_method"],
+        ),
+        params["alt_min_support_read"],
+    )
+    ref_count = np.where(ref_count >= ref_threshold[:, None], ref_count, 0)
+    alt_count = np.where(alt_count >= alt_threshold[:, None], alt_count, 0)
+    gt_strings = GT_STRINGS[get_genotype_code(ref_count, alt_count)]
+
+    out_lines = []
+    for i, (fields, (format_keys, sample_fields, _, _)) in enumerate(
+        zip(records, parsed)
+    ):
+        info = f"REF_T={ref_threshold[i]};ALT_T={alt_threshold[i]}"
+        if fields[7] != ".":
+            info = f"{fields[7]};{info}"
+        gt_index = format_keys.index("GT")
+        ad_index = format_keys.index("AD")
+        n_key = len(format_keys)
+        samples = []
+        for sample, gt, ref, alt in zip(
+            sample_fields,
+            gt_strings[i].tolist(),
+            ref_count[i].tolist(),
+            alt_count[i].tolist(),
+        ):
+            if len(sample) < n_key:
+                sample = sample + ["."] * (n_key - len(sample))
+            sample[gt_index] = gt
+            ad = sample[ad_index].split(",")
+            ad[:2] = [str(ref), str(alt)]
+            sample[ad_index] = ",".join(ad)
+            samples.append(":".join(sample))
+        out_lines.append("\t".join(fields[:7] + [info, fields[8]] + samples) + "\n")
+
+    return out_lines, ref_sums, alt_sums
+
+
+def filter_contig(vcf_file, start, end, out_file, params):
+    """
+    Filter records in [start, end) bytes of vcf_file and write them to out_file.
+    Returns:
+        record offsets, raw ref and alt read sums of each record
+    """
+    offsets = []
+    ref_sums = []
+    alt_sums = []
+
+    def write_batch(lines, out):
+        out_lines, batch_ref_sums, batch_alt_sums = filter_records(lines, params)
+        out.writelines(out_lines)
+        ref_sums.extend(batch_ref_sums)
+        alt_sums.extend(batch_alt_sums)
+
+    with open(vcf_file, "rb") as f, open(out_file, "w") as out:
+        f.seek(start)
+        offset = start
+        lines = []
+        while offset < end:
+            line = f.readline()
+            offsets.append(offset)
+            offset += len(line)
+            lines.append(line.decode())
+            if len(lines) == BATCH_SIZE:
+                write_batch(lines, out)
+                lines = []
+        if lines:
+            write_batch(lines, out)
+
+    return offsets, ref_sums, alt_sums
 
 
 class Filter_snp(Step):
     """
     ## Features
     - Filter out `ref` and `alt` alleles that do not have enough reads to support.
+    - Allele counts are loaded into sparse variant x cell matrices in batches and filtered with vectorized thresholds.
+    Otsu plots are only drawn for the top `--otsu_plot_top_n` variants.
+    - Contigs are filtered in parallel and the filtered VCF keeps the record order of the input VCF.
 
     ## Output
     - `{sample}_test1_filtered.vcf` VCF file after filtering. Alleles read counts that do not have enough reads to support are set to zero.
     Genotypes are changed accordingly.
+    - `ref_otsu_plots/` and `alt_otsu_plots/` Otsu plots of the top variants. Only produced when `--otsu_plot_top_n` > 0.
     """
 
     def __init__(self, args, display_title="Filtering"):
@@ -33,69 +208,22 @@ class Filter_snp(Step):
             self.args.alt_threshold_method,
         )
 
+        self.params = {
+            "ref_threshold_method": self.args.ref_threshold_method,
+            "alt_threshold_method": self.args.alt_threshold_method,
+            "ref_min_support_read": self.args.ref_min_support_read,
+            "alt_min_support_read": self.args.alt_min_support_read,
+        }
+
         # out
         self.out_vcf_file = f"{self.out_prefix}_filtered.vcf"
-
-    @staticmethod
-    def get_count_array(record):
-        """
-        get allele count array
-
-        Args
-            record: pysam vcf record
-            entry: str, 'ref' or 'alt'
-        Return
-            (ref_count_array, alt_count_array)
-        """
-        ref_count_array = []
-        alt_count_array = []
-        for sample in record.samples:
-            ad = record.samples[sample]["AD"]
-            ref_count_array.append(ad[0])
-            alt_count_array.append(ad[1])
-
-        return ref_count_array, alt_count_array
-
-    def get_threshold(self, count_array, threshold_method, otsu_plot_path=None):
-        runner = Threshold(
-            count_array,
-            threshold_method=threshold_method,
-            otsu_plot_path=otsu_plot_path,
-        )
-        threshold = runner.run()
-        return threshold
-
-    @staticmethod
-    def filter_array(count_array, threshold):
-        return [x if x >= threshold else 0 for x in count_array]
-
-    @staticmethod
-    def get_genotype(ref_count, alt_count):
-        if ref_count > 0 and alt_count > 0:
-            af = alt_count / (alt_count + ref_count)
-            if VAF <= af <= 1 - VAF:
-                return (0, 1)
-            elif af < VAF:
-                return (0, 0)
-            else:
-                return (1, 1)
-        elif ref_count > 0 and alt_count == 0:
-            return (0, 0)
-        elif ref_count == 0 and alt_count > 0:
-            return (1, 1)
-        elif ref_count == 0 and alt_count == 0:
-            return (None, None)
+        # uncompressed input vcf, records are read by byte offsets
+        self.plain_vcf = self.vcf
+        if self.vcf.endswith(".gz"):
+            self.plain_vcf = f"{self.out_prefix}_input.vcf"
 
     @utils.add_log
-    def run(self):
-        if self.args.ref_threshold_method == "otsu":
-            ref_otsu_plot_dir = f"{self.outdir}/ref_otsu_plots/"
-            utils.check_mkdir(ref_otsu_plot_dir)
-
-        if self.args.alt_threshold_method == "otsu":
-            alt_otsu_plot_dir = f"{self.outdir}/alt_otsu_plots/"
-            utils.check_mkdir(alt_otsu_plot_dir)
-
+    def write_header(self):
         with pysam.VariantFile(self.vcf) as vcf_in:
             header = vcf_in.header
             header.add_meta(
@@ -122,52 +250,77 @@ class Filter_snp(Step):
                     ("Description", "Alternate allele count threshold"),
                 ],
             )
-            with pysam.VariantFile(
-                self.out_vcf_file, "w", header=vcf_in.header
-            ) as vcf_out:
-                for record in vcf_in.fetch():
-                    name = f"{record.chrom}_{record.pos}"
-                    ref_count_array, alt_count_array = self.get_count_array(record)
-                    ref_otsu_plot_path = (
-                        f"{ref_otsu_plot_dir}/{name}_ref.pdf"
-                        if self.args.ref_threshold_method == "otsu"
-                        else None
-                    )
-                    ref_threshold = self.get_threshold(
-                        ref_count_array,
-                        self.args.ref_threshold_method,
-                        ref_otsu_plot_path,
-                    )
-                    alt_otsu_plot_path = (
-                        f"{alt_otsu_plot_dir}/{name}_alt.pdf"
-                        if self.args.alt_threshold_method == "otsu"
-                        else None
-                    )
-                    alt_threshold = self.get_threshold(
-                        alt_count_array,
-                        self.args.alt_threshold_method,
-                        alt_otsu_plot_path,
-                    )
-                    ref_threshold = max(ref_threshold, self.args.ref_min_support_read)
-                    alt_threshold = max(alt_threshold, self.args.alt_min_support_read)
-                    ref_filtered_count_array = self.filter_array(
-                        ref_count_array, ref_threshold
-                    )
-                    alt_filtered_count_array = self.filter_array(
-                        alt_count_array, alt_threshold
-                    )
-
-                    new_record = record.copy()
-                    new_record.info.__setitem__("REF_T", ref_threshold)
-                    new_record.info.__setitem__("ALT_T", alt_threshold)
-                    for index, sample in enumerate(record.samples):
-                        ref_count = ref_filtered_count_array[index]
-                        alt_count = alt_filtered_count_array[index]
-                        new_record.samples[sample]["AD"] = (ref_count, alt_count)
-                        genotype = self.get_genotype(ref_count, alt_count)
-                        new_record.samples[sample]["GT"] = genotype
-
-                    vcf_out.write(new_record)
+            with open(self.out_vcf_file, "w") as out:
+                out.write(str(header))
+
+    @utils.add_log
+    def filter_vcf(self):
+        """
+        Each contig is filtered in a worker and written to a temporary file.
+        Temporary files are concatenated in the input order.
+        Returns:
+            record offsets, raw ref and alt read sums of all records
+        """
+        ranges = get_contig_ranges(self.plain_vcf)
+        tmp_files = [f"{self.out_prefix}_{i}.vcf.tmp" for i in range(len(ranges))]
+        args_list = [
+            (self.plain_vcf, start, end, tmp_file, self.params)
+            for (_contig, start, end), tmp_file in zip(ranges, tmp_files)
+        ]
+        if self.thread > 1 and len(ranges) > 1:
+            with Pool(min(self.thread, len(ranges))) as pool:
+                results = pool.starmap(filter_contig, args_list)
+        else:
+            results = [filter_contig(*args) for args in args_list]
+
+        with open(self.out_vcf_file, "a") as out:
+            for tmp_file in tmp_files:
+                with open(tmp_file) as f:
+                    shutil.copyfileobj(f, out)
+                os.remove(tmp_file)
+
+        offsets, ref_sums, alt_sums = [], [], []
+        for contig_offsets, contig_ref_sums, contig_alt_sums in results:
+            offsets += contig_offsets
+            ref_sums += contig_ref_sums
+            alt_sums += contig_alt_sums
+        return offsets, np.array(ref_sums), np.array(alt_sums)
+
+    @utils.add_log
+    def plot_otsu(self, offsets, read_sums, threshold_method, entry):
+        """
+        Draw otsu plots of the top `--otsu_plot_top_n` variants with the most reads.
+        """
+        top_n = self.args.otsu_plot_top_n
+        if threshold_method != "otsu" or not top_n or not offsets:
+            return
+        otsu_plot_dir = f"{self.outdir}/{entry}_otsu_plots/"
+        utils.check_mkdir(otsu_plot_dir)
+        top_index = np.argsort(-read_sums, kind="stable")[:top_n]
+        with open(self.plain_vcf, "rb") as f:
+            for index in top_index:
+                f.seek(offsets[index])
+                fields = f.readline().decode().rstrip("\n").split("\t")
+                _format_keys, _samples, ref, alt = parse_allele_count(fields)
+                name = f"{fields[0]}_{fields[1]}"
+                Otsu(
+                    ref if entry == "ref" else alt,
+                    otsu_plot_path=f"{otsu_plot_dir}/{name}_{entry}.pdf",
+                ).run()
+
+    @utils.add_log
+    def run(self):
+        if self.plain_vcf != self.vcf:
+            with gzip.open(self.vcf, "rb") as f_in, open(self.plain_vcf, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+        self.write_header()
+        offsets, ref_sums, alt_sums = self.filter_vcf()
+        self.plot_otsu(offsets, ref_sums, self.args.ref_threshold_method, "ref")
+        self.plot_otsu(offsets, alt_sums, self.args.alt_threshold_method, "alt")
+
+        if self.plain_vcf != self.vcf:
+            os.remove(self.plain_vcf)
 
 
 def filter_snp(args):
@@ -200,6 +353,12 @@ def get_opts_filter_snp(parser, sub_program):
         help="minimum supporting read number for alt.",
         default=2,
     )
+    parser.add_argument(
+        "--otsu_plot_top_n",
+        type=int,
+        help="Otsu plots are only drawn for the top N variants with the most reads. 0 means no plot.",
+        default=0,
+    )
     if sub_program:
         parser.add_argument("--vcf", help="norm vcf file")
         s_common(parser)
@@ -1,4 +1,8 @@
-from celescope.snp.__init__ import __ASSAY__
+from celescope.snp.__init__ import (
+    __ASSAY__,
+    SPLIT_N_CIGAR_HEAP,
+    VARIANT_CALLING_MEM_OVERHEAD,
+)
 from celescope.tools.multi import Multi
 from celescope.tools.__init__ import TAG_BAM_SUFFIX
 
@@ -71,14 +75,16 @@ class Multi_snp(Multi):
             f'{self.outdir_dic[sample]["target_metrics"]}/{sample}_filtered_sorted.bam'
         )
         cmd = f"{cmd_line} " f"--bam {bam} " f"--match_dir {self.col4_dict[sample]} "
-        self.process_cmd(cmd, step, sample, m=8, x=1)
+        # up to `thread` SplitNCigarReads shards run at the same time
+        mem = SPLIT_N_CIGAR_HEAP * int(self.args.thread) + VARIANT_CALLING_MEM_OVERHEAD
+        self.process_cmd(cmd, step, sample, m=mem, x=self.args.thread)
 
     def filter_snp(self, sample):
         step = "filter_snp"
         vcf = f'{self.outdir_dic[sample]["variant_calling"]}/{sample}_norm.vcf'
         cmd_line = self.get_cmd_line(step, sample)
         cmd = f"{cmd_line} " f"--vcf {vcf} "
-        self.process_cmd(cmd, step, sample, m=1, x=1)
+        self.process_cmd(cmd, step, sample, m=2, x=self.args.thread)
 
     def analysis_snp(self, sample):
         step = "analysis_snp"
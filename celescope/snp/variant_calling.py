@@ -1,14 +1,132 @@
+import os
+import subprocess
+from multiprocessing import Pool
+
+import pysam
+
 from celescope.tools import utils
 from celescope.__init__ import HELP_DICT
 from celescope.tools.step import Step, s_common
 from celescope.rna.mkref import Mkref_rna
-from celescope.snp.__init__ import PANEL
+from celescope.snp.__init__ import PANEL, SPLIT_N_CIGAR_HEAP
+from celescope.tools.split_bam import REGION_WINDOW, SHARD_PER_THREAD, split_regions
+
+
+def read_bed(bed_file):
+    """
+    Returns:
+        list of (contig, start, end)
+    """
+    regions = []
+    with open(bed_file) as f:
+        for line in f:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            items = line.split("\t")
+            regions.append((items[0], int(items[1]), int(items[2])))
+    return regions
+
+
+def get_regions(bam_file, bed_file=None):
+    """
+    Regions are sorted by the contig order in the bam header. Overlapping bed regions are merged.
+    Without bed, contigs with mapped reads are cut into REGION_WINDOW windows.
+    Returns:
+        list of (contig, start, end, n_read)
+    """
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        contig_index = {contig: i for i, contig in enumerate(bam.references)}
+        if bed_file:
+            intervals = sorted(
+                (region for region in read_bed(bed_file) if region[0] in contig_index),
+                key=lambda x: (contig_index[x[0]], x[1], x[2]),
+            )
+            merged = []
+            for contig, start, end in intervals:
+                if merged and merged[-1][0] == contig and start <= merged[-1][2]:
+                    merged[-1][2] = max(merged[-1][2], end)
+                else:
+                    merged.append([contig, start, end])
+            regions = [
+                (contig, start, end, bam.count(contig, start, end))
+                for contig, start, end in merged
+            ]
+        else:
+            mapped = {stat.contig: stat.mapped for stat in bam.get_index_statistics()}
+            regions = []
+            for contig, length in zip(bam.references, bam.lengths):
+                if mapped.get(contig, 0) == 0:
+                    continue
+                for start in range(0, length, REGION_WINDOW):
+                    end = min(start + REGION_WINDOW, length)
+                    regions.append(
+                        (
+                            contig,
+                            start,
+                            end,
+                            bam.count(contig, start, end, read_callback="nofilter"),
+                        )
+                    )
+    return regions
+
+
+def write_bed(regions, bed_file):
+    with open(bed_file, "w") as f:
+        for contig, start, end in regions:
+            f.write(f"{contig}\t{start}\t{end}\n")
+
+
+def run_cmd(cmd):
+    if cmd.find("2>&1") == -1:
+        cmd += " 2>&1 "
+    subprocess.check_call(cmd, shell=True)
+
+
+@utils.add_log
+def call_shard(fasta, bam, shard_bed, shard_prefix):
+    """
+    SplitNCigarReads and call variants in the regions of shard_bed.
+    Returns:
+        shard raw vcf file
+    """
+    splitN_bam = f"{shard_prefix}_splitN.bam"
+    raw_bcf_file = f"{shard_prefix}_raw.bcf"
+    raw_vcf_file = f"{shard_prefix}_raw.vcf"
+    cmds = [
+        (
+            f"gatk "
+            f'--java-options "-Xmx{SPLIT_N_CIGAR_HEAP}g" '
+            f"SplitNCigarReads "
+            f"--do-not-fix-overhangs "
+            f"-R {fasta} "
+            f"-I {bam} "
+            f"-L {shard_bed} "
+            f"-O {splitN_bam} "
+        ),
+        (
+            f"bcftools mpileup "
+            f"-f {fasta} "
+            f"--annotate DP,AD "
+            f"--max-depth 2000000 --max-idepth 2000000 --no-BAQ "
+            f"--regions-file {shard_bed} "
+            f"-o {raw_bcf_file} "
+            f"{splitN_bam} "
+        ),
+        (f"bcftools call -mv -Ov -o {raw_vcf_file} {raw_bcf_file} "),
+    ]
+    for cmd in cmds:
+        call_shard.logger.info(cmd)
+        run_cmd(cmd)
+    return raw_vcf_file
 
 
 class Variant_calling(Step):
     """
     ## Features
     - Perform variant calling at single cell level.
+    - When `--thread` > 1, the genome(or the panel bed) is split into shards with similar read numbers.
+    SplitNCigarReads and variant calling run on shards in parallel and the shard VCFs are concatenated in order.
+    Each SplitNCigarReads of a shard uses a java heap of 4GB.
 
     ## Output
     - `{sample}_raw.vcf` Variants are called with bcftools default settings.
@@ -33,6 +151,7 @@ class Variant_calling(Step):
         self.raw_vcf_file = f"{self.out_prefix}_raw.vcf"
         self.fixed_header_vcf = f"{self.out_prefix}_fixed.vcf"
         self.norm_vcf_file = f"{self.out_prefix}_norm.vcf"
+        self.shard_dir = f"{self.outdir}/shards/"
 
     @utils.add_log
     def SplitNCigarReads(self):
@@ -83,6 +202,43 @@ class Variant_calling(Step):
         )
         self.debug_subprocess_call(cmd)
 
+    @utils.add_log
+    def call_variants_sharded(self):
+        regions = get_regions(self.args.bam, self.bed)
+        if not regions:
+            self.call_variants_sharded.logger.warning("No region has reads.")
+            self.SplitNCigarReads()
+            self.call_variants()
+            return
+        shards = split_regions(regions, self.thread * SHARD_PER_THREAD)
+        self.call_variants_sharded.logger.info(
+            f"{len(regions)} regions are split into {len(shards)} shards"
+        )
+
+        utils.check_mkdir(self.shard_dir)
+        args_list = []
+        for i, shard in enumerate(shards):
+            shard_prefix = f"{self.shard_dir}/shard{i}"
+            shard_bed = f"{shard_prefix}.bed"
+            write_bed(shard, shard_bed)
+            args_list.append((self.fasta, self.args.bam, shard_bed, shard_prefix))
+
+        with Pool(min(self.thread, len(shards))) as pool:
+            shard_vcf_files = pool.starmap(call_shard, args_list)
+
+        cmd = (
+            f"bcftools concat "
+            f"-Ov "
+            f"-o {self.raw_vcf_file} "
+            f"{' '.join(shard_vcf_files)} "
+        )
+        self.debug_subprocess_call(cmd)
+
+        if not self.debug:
+            for f in os.listdir(self.shard_dir):
+                os.remove(f"{self.shard_dir}/{f}")
+            os.rmdir(self.shard_dir)
+
     def bcftools_norm(self):
         cmd = (
             "bcftools norm "
@@ -96,8 +252,11 @@ class Variant_calling(Step):
         self.debug_subprocess_call(cmd)
 
     def run(self):
-        self.SplitNCigarReads()
-        self.call_variants()
+        if self.thread > 1:
+            self.call_variants_sharded()
+        else:
+            self.SplitNCigarReads()
+            self.call_variants()
         self.bcftools_norm()
 
 
@@ -21,7 +21,7 @@ class Multi_sweetseq(Multi):
         fq = f'{self.outdir_dic[sample]["barcode"]}/{sample}_2.fq'
         cmd_line = self.get_cmd_line(step, sample)
         cmd = f"{cmd_line} " f"--fq {fq} "
-        self.process_cmd(cmd, step, sample, m=2, x=1)
+        self.process_cmd(cmd, step, sample, m=2, x=self.args.thread)
 
     def count_tag(self, sample):
         step = "count_tag"
@@ -119,10 +119,6 @@ class Count_tag(Step):
                 f"{self.outdir}/{self.sample}_combine_cluster_plot.pdf"
             )
 
-    @staticmethod
-    def get_UMI(row):
-        return row.sum()
-
     @staticmethod
     def get_UMI_min(df_cell_UMI, UMI_min):
         if UMI_min == "auto":
@@ -135,19 +131,38 @@ class Count_tag(Step):
             return int(UMI_min)
 
     @staticmethod
-    def get_SNR(row, dim):
-        row_sorted = sorted(row, reverse=True)
-        noise = row_sorted[dim]
-        signal = row_sorted[dim - 1]
-        if signal == 0:
-            return 0
-        if noise == 0:
-            return np.inf
-        return float(signal) / noise
+    def get_SNRs(counts, dim):
+        """
+        Signal is the dim-th largest UMI count of each cell and noise is the (dim+1)-th largest.
+
+        Args:
+            counts: cells x tags UMI array
+        Returns:
+            SNR array. 0 if signal is 0; inf if noise is 0.
+
+        >>> counts = np.array([[10, 2, 0], [5, 0, 0], [0, 0, 0], [3, 3, 1]])
+        >>> Count_tag.get_SNRs(counts, dim=1).tolist()
+        [5.0, inf, 0.0, 1.0]
+        >>> Count_tag.get_SNRs(counts, dim=2).tolist()
+        [inf, 0.0, 0.0, 3.0]
+        """
+        n_tag = counts.shape[1]
+        if n_tag <= dim:
+            signal = np.sort(counts, axis=1)[:, max(n_tag - dim, 0)]
+            noise = np.zeros(len(counts))
+        else:
+            top = np.partition(counts, (n_tag - dim - 1, n_tag - dim), axis=1)
+            signal = top[:, n_tag - dim]
+            noise = top[:, n_tag - dim - 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            SNRs = signal / noise
+        SNRs[noise == 0] = np.inf
+        SNRs[signal == 0] = 0
+        return SNRs
 
     @utils.add_log
     def get_SNR_min(self, df_cell_UMI, SNR_min, UMI_min):
-        UMIs = df_cell_UMI.apply(Count_tag.get_UMI, axis=1)
+        UMIs = df_cell_UMI.sum(axis=1)
         df_valid_cell_UMI = df_cell_UMI[UMIs >= UMI_min]
         if SNR_min == "auto":
             # no noise
@@ -155,7 +170,7 @@ class Count_tag(Step):
                 Count_tag.get_SNR_min.logger.warning("*** No NOISE FOUND! ***")
                 self.no_noise = True
                 return 0
-            SNRs = df_valid_cell_UMI.apply(Count_tag.get_SNR, dim=self.dim, axis=1)
+            SNRs = Count_tag.get_SNRs(df_valid_cell_UMI.to_numpy(), self.dim)
             if np.median(SNRs) == np.inf:
                 return 10
             return max(np.median(SNRs) * self.coefficient, 2)
@@ -163,20 +178,37 @@ class Count_tag(Step):
             return float(SNR_min)
 
     @staticmethod
-    def tag_type(row, UMI_min, SNR_min, dim, no_noise=False):
+    def get_tag_types(df_cell_UMI, UMI_min, SNR_min, dim, no_noise=False):
+        """
+        Returns:
+            tag of each cell: "Undetermined" if UMI < UMI_min; "Multiplet" if SNR < SNR_min;
+            otherwise the top dim tag names sorted and joined by "_".
+
+        >>> df = pd.DataFrame([[10, 2, 0], [5, 4, 0], [1, 0, 0]], columns=["a", "b", "c"])
+        >>> Count_tag.get_tag_types(df, UMI_min=2, SNR_min=2, dim=1).tolist()
+        ['a', 'Multiplet', 'Undetermined']
+        >>> Count_tag.get_tag_types(df, UMI_min=2, SNR_min=2, dim=2).tolist()
+        ['a_b', 'a_b', 'Undetermined']
+        """
+        counts = df_cell_UMI.to_numpy()
+        tag_names = np.asarray(df_cell_UMI.columns, dtype=str)
         if no_noise:
-            SNR = 1
+            SNRs = np.ones(len(counts))
         else:
-            SNR = Count_tag.get_SNR(row, dim)
-        UMI = Count_tag.get_UMI(row)
-        if UMI < UMI_min:
-            return "Undetermined"
-        if SNR < SNR_min:
-            return "Multiplet"
-        # get tag
-        signal_tags = sorted(row.sort_values(ascending=False).index[0:dim])
-        signal_tags_str = "_".join(signal_tags)
-        return signal_tags_str
+            SNRs = Count_tag.get_SNRs(counts, dim)
+        UMIs = counts.sum(axis=1)
+
+        tags = np.full(len(counts), "Multiplet", dtype=object)
+        tags[UMIs < UMI_min] = "Undetermined"
+        assigned = (UMIs >= UMI_min) & (SNRs >= SNR_min)
+        if assigned.any():
+            # the same argsort as pandas sort_values(ascending=False), so ties resolve identically
+            n_tag = counts.shape[1]
+            ascending_index = np.argsort(counts[assigned][:, ::-1], axis=1)
+            top_index = n_tag - 1 - ascending_index[:, ::-1][:, :dim]
+            signal_tags = np.sort(tag_names[top_index], axis=1)
+            tags[assigned] = ["_".join(row) for row in signal_tags.tolist()]
+        return pd.Series(tags, index=df_cell_UMI.index)
 
     @utils.add_log
     def write_and_plot(self, df, column_name, count_file, plot_file):
@@ -252,7 +284,7 @@ class Count_tag(Step):
         df_UMI_cell = df_UMI_cell.astype(int)
 
         # UMI
-        UMIs = df_UMI_cell.apply(sum, axis=1)
+        UMIs = df_UMI_cell.sum(axis=1)
         umi_median = round(np.median(UMIs), 2)
         umi_mean = round(np.mean(UMIs), 2)
         self.add_metric(
@@ -271,13 +303,12 @@ class Count_tag(Step):
         Count_tag.run.logger.info(f"UMI_min: {UMI_min}")
         SNR_min = self.get_SNR_min(df_UMI_cell, self.SNR_min, UMI_min)
         Count_tag.run.logger.info(f"SNR_min: {SNR_min}")
-        df_UMI_cell["tag"] = df_UMI_cell.apply(
-            Count_tag.tag_type,
+        df_UMI_cell["tag"] = Count_tag.get_tag_types(
+            df_UMI_cell,
             UMI_min=UMI_min,
             SNR_min=SNR_min,
             dim=self.dim,
             no_noise=self.no_noise,
-            axis=1,
         )
         df_UMI_cell.to_csv(self.UMI_tag_file, sep="\t")
 
@@ -25,7 +25,7 @@ class Multi_tag(Multi):
         fq = f'{self.outdir_dic[sample]["barcode"]}/{sample}_2.fq'
         cmd_line = self.get_cmd_line(step, sample)
         cmd = f"{cmd_line} " f"--fq {fq} "
-        self.process_cmd(cmd, step, sample, m=5, x=1)
+        self.process_cmd(cmd, step, sample, m=5, x=self.args.thread)
 
     def count_tag(self, sample):
         step = "count_tag"
@@ -60,7 +60,7 @@ class Multi_tag(Multi):
             f"--match_dir {self.col4_dict[sample]} "
             f"--umi_tag_file {umi_tag_file} "
         )
-        self.process_cmd(cmd, step, sample, m=5, x=1)
+        self.process_cmd(cmd, step, sample, m=5, x=self.args.thread)
 
 
 def main():
@@ -5,9 +5,11 @@ split scRNA-Seq fastq file(01.barcode/{sample}_2.fq)
 import glob
 import os
 import itertools
-from collections import defaultdict
+from array import array
+from collections import OrderedDict
 import sys
 
+import numpy as np
 import pysam
 import pandas as pd
 
@@ -16,11 +18,65 @@ from celescope.tools.step import Step, s_common
 from celescope.tools.__init__ import FILTERED_MATRIX_DIR_SUFFIX
 from celescope.__init__ import HELP_DICT
 from celescope.tools.matrix import CountMatrix
+from celescope.tools.split_bam import split_bam_by_barcode
 from celescope.flv_trust4.annotation import (
     gen_vj_annotation_metrics,
     gen_clonotypes_table,
 )
 
+# at most this many split fastq files are open at the same time
+MAX_OPEN_FILES = 256
+
+
+class Handle_pool:
+    """
+    Text files opened for writing. At most max_open files are open at the same time.
+    The least recently used file is closed when the limit is reached and reopened in append mode when needed.
+
+    >>> import tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> files = [f"{tmp}/{i}.txt" for i in range(3)]
+    >>> with Handle_pool(files, max_open=2) as pool:
+    ...     for i in (0, 1, 2, 0):
+    ...         pool.write(files[i], f"{i}\\n")
+    >>> [open(f).read() for f in files]
+    ['0\\n0\\n', '1\\n', '2\\n']
+    """
+
+    def __init__(self, file_names, max_open=MAX_OPEN_FILES):
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        # create or empty all files, so files without any record also exist
+        for file_name in file_names:
+            open(file_name, "w").close()
+
+    def write(self, file_name, text):
+        handle = self.handles.get(file_name)
+        if handle is None:
+            if len(self.handles) >= self.max_open:
+                _, lru_handle = self.handles.popitem(last=False)
+                lru_handle.close()
+            handle = open(file_name, "a")
+            self.handles[file_name] = handle
+        else:
+            self.handles.move_to_end(file_name)
+        handle.write(text)
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def has_gene_tag(seg):
+    return seg.has_tag("XT")
+
 
 def get_clonotypes_table(df):
     chains = sorted(set(df["chain"].tolist()))
@@ -54,6 +110,9 @@ class Split_tag(Step):
     """
     ## Features
     - Split scRNA-Seq fastq according to tag assignment.
+    - Each of R1, R2 and bam is read once. Every record goes to its tag file by a barcode to tag lookup.
+    - With `--thread` > 1, a coordinate-sorted and indexed bam is split by genome region shards in parallel.
+    Split bams are coordinate-sorted and indexed.
 
     ## Output
     - `matrix/` Matrix files of each tag.(Optional)
@@ -77,6 +136,13 @@ class Split_tag(Step):
         self.tag_barcode_dict = {
             tag: set(row["barcode"].tolist()) for tag, row in df_umi_tag.groupby("tag")
         }
+        self.tags = list(self.tag_barcode_dict)
+        # each barcode is assigned to one tag
+        self.barcode_tag_dict = {
+            barcode: tag_code
+            for tag_code, tag in enumerate(self.tags)
+            for barcode in self.tag_barcode_dict[tag]
+        }
 
         if args.split_matrix:
             self.matrix_outdir = f"{args.outdir}/matrix/"
@@ -97,18 +163,18 @@ class Split_tag(Step):
         if args.split_fastq:
             self.rna_fq_file = glob.glob(f"{args.match_dir}/*barcode/*_2.fq*")[0]
 
-            fastq_outdir = f"{args.outdir}/fastqs/"
-            os.system(f"mkdir -p {fastq_outdir}")
-
-            self.r2_fastq_files_handle = {}
-            self.r1_fastq_files_handle = {}
-            for tag in self.tag_barcode_dict:
-                r2_fastq_file_name = f"{fastq_outdir}/{tag}_2.fq"
-                self.r2_fastq_files_handle[tag] = open(r2_fastq_file_name, "w")
-                r1_fastq_file_name = f"{fastq_outdir}/{tag}_1.fq"
-                self.r1_fastq_files_handle[tag] = open(r1_fastq_file_name, "w")
+            self.fastq_outdir = f"{args.outdir}/fastqs/"
+            os.system(f"mkdir -p {self.fastq_outdir}")
+            self.r2_fastq_files = [
+                f"{self.fastq_outdir}/{tag}_2.fq" for tag in self.tags
+            ]
+            self.r1_fastq_files = [
+                f"{self.fastq_outdir}/{tag}_1.fq" for tag in self.tags
+            ]
 
-            self.tag_read_index_dict = defaultdict(set)
+            # R1 read index and tag code of R2 reads written to split fastq
+            self.tag_read_index = array("q")
+            self.tag_read_code = array("i")
 
         if args.split_vdj:
             self.cell_confident_vdj = glob.glob(
@@ -134,36 +200,52 @@ class Split_tag(Step):
     @utils.add_log
     def write_r2_fastq_files(self):
         read_num = 0
-        with pysam.FastxFile(self.rna_fq_file, "r") as rna_fq:
+        with Handle_pool(self.r2_fastq_files) as pool, pysam.FastxFile(
+            self.rna_fq_file, "r"
+        ) as rna_fq:
             for read in rna_fq:
                 read_num += 1
                 attr = read.name.strip("@").split(":")
-                barcode = attr[0]
-                read_index = int(attr[2])
-                for tag in self.tag_barcode_dict:
-                    if barcode in self.tag_barcode_dict[tag]:
-                        self.tag_read_index_dict[tag].add(read_index)
-                        self.r2_fastq_files_handle[tag].write(str(read) + "\n")
+                tag_code = self.barcode_tag_dict.get(attr[0])
+                if tag_code is not None:
+                    self.tag_read_index.append(int(attr[2]))
+                    self.tag_read_code.append(tag_code)
+                    pool.write(self.r2_fastq_files[tag_code], str(read) + "\n")
 
                 if read_num % 1000000 == 0:
                     self.write_r2_fastq_files.logger.info(f"{read_num} done")
 
-        for tag in self.r2_fastq_files_handle:
-            self.r2_fastq_files_handle[tag].close()
-
     @utils.add_log
     def write_r1_fastq_files(self):
+        """
+        R1 reads are matched to the sorted R2 read indexes in one pass.
+        """
+        read_index = np.frombuffer(self.tag_read_index, dtype=np.int64)
+        read_code = np.frombuffer(self.tag_read_code, dtype=np.intc)
+        if np.any(read_index[1:] < read_index[:-1]):
+            order = np.argsort(read_index, kind="stable")
+            read_index, read_code = read_index[order], read_code[order]
+        n_tag_read = len(read_index)
+        # a sentinel larger than any read index
+        read_index = np.append(read_index, np.iinfo(np.int64).max)
+
         file_handles = [pysam.FastxFile(r1, "r") for r1 in self.args.R1_read.split(",")]
         r1_read = itertools.chain(*file_handles)
-        for read_index, read in enumerate(r1_read, start=1):
-            for tag in self.tag_read_index_dict:
-                if read_index in self.tag_read_index_dict[tag]:
-                    self.r1_fastq_files_handle[tag].write(str(read) + "\n")
+        i = 0
+        next_index = int(read_index[0])
+        with Handle_pool(self.r1_fastq_files) as pool:
+            for index, read in enumerate(r1_read, start=1):
+                if i == n_tag_read:
+                    break
+                if index != next_index:
+                    continue
+                pool.write(self.r1_fastq_files[read_code[i]], str(read) + "\n")
+                while read_index[i] == index:
+                    i += 1
+                next_index = int(read_index[i])
 
         for r1 in file_handles:
             r1.close()
-        for tag in self.r1_fastq_files_handle:
-            self.r1_fastq_files_handle[tag].close()
 
     @utils.add_log
     def split_matrix(self):
@@ -181,30 +263,14 @@ class Split_tag(Step):
 
     @utils.add_log
     def split_bam(self):
-        barcode_tag_dict = {}
-        tags = self.tag_barcode_dict.keys()
-        for tag in tags:
-            for barcode in self.tag_barcode_dict[tag]:
-                barcode_tag_dict[barcode] = tag
-
-        with pysam.AlignmentFile(self.args.bam_file, "r") as bam_in:
-            bam_handle_dict = {}
-            for tag in tags:
-                bam_file = f"{self.bam_outdir}/{tag}.bam"
-                bam_handle_dict[tag] = pysam.AlignmentFile(
-                    bam_file, "wb", header=bam_in.header
-                )
-
-            for seg in bam_in:
-                if not seg.has_tag("XT"):
-                    continue
-                barcode = seg.get_tag("CB")
-                if barcode in barcode_tag_dict:
-                    tag = barcode_tag_dict[barcode]
-                    bam_handle_dict[tag].write(seg)
-
-        for h in bam_handle_dict.values():
-            h.close()
+        split_bam_by_barcode(
+            self.args.bam_file,
+            self.barcode_tag_dict,
+            [f"{self.bam_outdir}/{tag}.bam" for tag in self.tags],
+            thread=self.thread,
+            barcode_tag="CB",
+            read_filter=has_gene_tag,
+        )
 
     @utils.add_log
     def split_vdj(self):
@@ -1,10 +1,13 @@
-import json
+import heapq
+from collections import defaultdict
+from multiprocessing import Pool
 
 import pysam
 import numpy as np
 
 from celescope.tools import utils
 from celescope.tools.step import Step, s_common
+from celescope.tools.capture.read_count import Read_count
 from celescope.__init__ import HELP_DICT, HELP_INFO_DICT
 
 
@@ -17,6 +20,53 @@ def get_opts_count_bam(parser, sub_program):
         s_common(parser)
 
 
+def count_reads(bam_file, contigs, match_barcode, min_query_length):
+    """
+    Args:
+        contigs: if None, read the whole bam in file order. Otherwise fetch these contigs from the indexed bam.
+        match_barcode: set
+    Returns:
+        {(barcode, ref, umi): read_count}
+    """
+    counts = defaultdict(int)
+    with pysam.AlignmentFile(bam_file, "rb") as samfile:
+        if contigs is None:
+            reads_list = [samfile]
+        else:
+            reads_list = [samfile.fetch(contig) for contig in contigs]
+        for reads in reads_list:
+            for read in reads:
+                attr = read.query_name.split(":")
+                barcode = attr[0]
+                if barcode not in match_barcode:
+                    continue
+                if read.infer_query_length() >= min_query_length:
+                    counts[(barcode, read.reference_name, attr[1])] += 1
+    return counts
+
+
+def split_contigs(bam_file, n_shard):
+    """
+    split contigs with mapped reads into n_shard shards with similar mapped read numbers.
+    Returns:
+        list of contig list
+    """
+    with pysam.AlignmentFile(bam_file, "rb") as samfile:
+        stats = [
+            (stat.mapped, stat.contig)
+            for stat in samfile.get_index_statistics()
+            if stat.mapped > 0
+        ]
+    stats.sort(reverse=True)
+    shards = [[] for _ in range(n_shard)]
+    heap = [(0, i) for i in range(n_shard)]
+    for mapped, contig in stats:
+        n_read, i = heapq.heappop(heap)
+        shards[i].append(contig)
+        heapq.heappush(heap, (n_read + mapped, i))
+    return [shard for shard in shards if shard]
+
+
 class Count_bam(Step):
     def __init__(self, args, display_title="Count"):
         super().__init__(args, display_title)
@@ -27,7 +77,7 @@ class Count_bam(Step):
 
         # read barcodes
         match_dir_dict = utils.parse_match_dir(args.match_dir)
-        self.match_barcode = match_dir_dict["match_barcode"]
+        self.match_barcode = set(match_dir_dict["match_barcode"])
         self.n_match_barcode = match_dir_dict["n_match_barcode"]
         self.add_metric(
             name=HELP_INFO_DICT["matched_barcode_number"]["display"],
@@ -40,22 +90,34 @@ class Count_bam(Step):
         self.count_dict = utils.genDict(dim=3)
 
         # out
-        self.raw_read_count_file = f"{self.out_prefix}_raw_read_count.json"
+        self.raw_read_count_file = f"{self.out_prefix}_raw_read_count.npz"
 
     @utils.add_log
     def process_bam(self):
-        # process bam
-        samfile = pysam.AlignmentFile(self.args.capture_bam, "rb")
-        for read in samfile:
-            ref = read.reference_name
-            query_length = read.infer_query_length()
-            attr = read.query_name.split(":")
-            barcode = attr[0]
-            umi = attr[1]
-            if (barcode in self.match_barcode) and (
-                query_length >= self.min_query_length
-            ):
-                self.count_dict[barcode][ref][umi] += 1
+        """
+        If the capture bam is indexed, contigs are counted in `thread` parallel shards.
+        """
+        with pysam.AlignmentFile(self.capture_bam, "rb") as samfile:
+            has_index = samfile.has_index()
+
+        if self.thread > 1 and has_index:
+            shards = split_contigs(self.capture_bam, self.thread)
+            args_list = [
+                (self.capture_bam, shard, self.match_barcode, self.min_query_length)
+                for shard in shards
+            ]
+            with Pool(len(shards)) as pool:
+                counts_list = pool.starmap(count_reads, args_list)
+        else:
+            counts_list = [
+                count_reads(
+                    self.capture_bam, None, self.match_barcode, self.min_query_length
+                )
+            ]
+
+        for counts in counts_list:
+            for (barcode, ref, umi), read_count in counts.items():
+                self.count_dict[barcode][ref][umi] += read_count
 
     @utils.add_log
     def add_some_metrics(self):
@@ -81,8 +143,7 @@ class Count_bam(Step):
 
     @utils.add_log
     def write_count_file(self):
-        with open(self.raw_read_count_file, "w") as fp:
-            json.dump(self.count_dict, fp, indent=4)
+        Read_count.from_count_dict(self.count_dict).to_file(self.raw_read_count_file)
 
     @utils.add_log
     def run(self):
@@ -1,11 +1,12 @@
-import json
-
+import numpy as np
 import pandas as pd
+import scipy.sparse
 
 from celescope.tools import utils
 from celescope.tools.featureCounts import correct_umi
 from celescope.tools.step import Step, s_common
-from celescope.tools.capture.threshold import Threshold
+from celescope.tools.capture.threshold import Otsu, threshold_batch, top_rows
+from celescope.tools.capture.read_count import Read_count
 from celescope.__init__ import HELP_DICT
 from celescope.tools.capture.__init__ import SUM_UMI_COLNAME
 
@@ -47,6 +48,12 @@ def get_opts_filter(parser, sub_program):
         default=10,
         type=int,
     )
+    parser.add_argument(
+        "--otsu_plot_top_n",
+        help="Otsu plots are only drawn for the top N refs with the most reads or UMIs. 0 means no plot.",
+        default=10,
+        type=int,
+    )
 
     if sub_program:
         parser.add_argument("--match_dir", help=HELP_DICT["match_dir"], required=True)
@@ -65,8 +72,8 @@ class Filter(Step):
         - 'hard' : Using User provided UMI threshold.
 
     ## Output
-    - `{sample}_corrected_read_count.json` Read counts after UMI correction.
-    - `{sample}_filtered_read_count.json` Filtered read counts.
+    - `{sample}_corrected_read_count.npz` Read counts after UMI correction.
+    - `{sample}_filtered_read_count.npz` Filtered read counts. UMIs filtered by the read threshold have read count 0.
     - `{sample}_filtered_UMI.csv` Filtered UMI counts.
 
     """
@@ -75,8 +82,7 @@ class Filter(Step):
         super().__init__(args, display_title)
 
         # data
-        with open(args.raw_read_count_file) as f:
-            self.count_dict = json.load(f)
+        self.read_count = Read_count.from_file(args.raw_read_count_file)
 
         self.raw_umi = 0
         self.total_corrected_umi = 0
@@ -84,8 +90,10 @@ class Filter(Step):
         self.read_threshold_dict = {}
         self.umi_threshold_dict = {}  # if not set explicitly, use 1 as default
 
-        self.barcode_ref_umi_dict = utils.genDict(dim=2)
-        self.ref_barcode_umi_dict = utils.genDict(dim=2)
+        # (barcode, ref) pairs with at least one UMI
+        self.pair_barcode_code = None
+        self.pair_ref_code = None
+        self.pair_umi = None
 
         match_dir_dict = utils.parse_match_dir(args.match_dir)
         self.match_barcode = match_dir_dict["match_barcode"]
@@ -94,21 +102,84 @@ class Filter(Step):
         )
 
         # out
-        self.corrected_read_count_file = f"{self.out_prefix}_corrected_read_count.json"
-        self.filter_read_count_file = f"{self.out_prefix}_filtered_read_count.json"
+        self.corrected_read_count_file = f"{self.out_prefix}_corrected_read_count.npz"
+        self.filter_read_count_file = f"{self.out_prefix}_filtered_read_count.npz"
         self.filter_umi_file = f"{self.out_prefix}_filtered_UMI.csv"
 
+    @staticmethod
+    def ordered_codes(codes):
+        """
+        Returns:
+            unique codes ordered by their first occurrence
+        """
+        uniq_code, first_index = np.unique(codes, return_index=True)
+        return uniq_code[np.argsort(first_index)].tolist()
+
+    def get_ref_thresholds(
+        self, ref_code, values, threshold_method, hard_threshold, name
+    ):
+        """
+        Thresholds of all refs are calculated together on a csr matrix(row: ref).
+        Otsu plots are drawn only for the top `--otsu_plot_top_n` refs.
+        Returns:
+            {ref: threshold}, refs are ordered by their first occurrence
+        """
+        refs = self.read_count.refs
+        matrix = scipy.sparse.csr_matrix(
+            (values, (ref_code, np.arange(len(values)))),
+            shape=(len(refs), len(values)),
+        )
+        thresholds = threshold_batch(
+            matrix,
+            threshold_method=threshold_method,
+            hard_threshold=hard_threshold,
+            coef=self.args.auto_coef,
+            log_base=self.args.otsu_log_base,
+        )
+
+        if threshold_method == "otsu":
+            for code in top_rows(matrix, self.args.otsu_plot_top_n):
+                Otsu(
+                    matrix.getrow(code).data,
+                    log_base=self.args.otsu_log_base,
+                    otsu_plot_path=f"{self.out_prefix}_{refs[code]}_{name}_otsu.png",
+                ).run()
+
+        return {
+            refs[code]: int(thresholds[code]) for code in Filter.ordered_codes(ref_code)
+        }
+
     @utils.add_log
     def correct_umi(self):
-        for barcode in self.count_dict:
-            for ref in self.count_dict[barcode]:
-                self.raw_umi += len(self.count_dict[barcode][ref])
-                n_corrected_umi, _n_corrected_read, _ = correct_umi(
-                    self.count_dict[barcode][ref]
-                )
-                if self.debug:
-                    print(f"{barcode} {ref} {n_corrected_umi}")
+        """
+        Only (barcode, ref) groups with more than one UMI need correction.
+        Merged UMIs are removed and the remaining rows keep their order.
+        """
+        rc = self.read_count
+        self.raw_umi = len(rc)
+        read_count = rc.read_count.copy()
+        keep = np.ones(len(rc), dtype=bool)
+
+        starts, ends = rc.group_bounds()
+        multi = (ends - starts) > 1
+        for start, end in zip(starts[multi].tolist(), ends[multi].tolist()):
+            umis = rc.umis[rc.umi_code[start:end]].tolist()
+            umi_dict = dict(zip(umis, read_count[start:end].tolist()))
+            n_corrected_umi, _n_corrected_read, _ = correct_umi(umi_dict)
+            if self.debug:
+                barcode = rc.barcodes[rc.barcode_code[start]]
+                ref = rc.refs[rc.ref_code[start]]
+                print(f"{barcode} {ref} {n_corrected_umi}")
+            if n_corrected_umi:
                 self.total_corrected_umi += n_corrected_umi
+                for index, umi in enumerate(umis, start):
+                    if umi in umi_dict:
+                        read_count[index] = umi_dict[umi]
+                    else:
+                        keep[index] = False
+
+        rc.read_count = read_count
+        self.read_count = rc.take(keep)
 
         self.add_metric(
             name="Number of Raw UMI",
@@ -124,9 +195,8 @@ class Filter(Step):
         )
 
     @utils.add_log
-    def write_correct_umi_json(self):
-        with open(self.corrected_read_count_file, "w") as fp:
-            json.dump(self.count_dict, fp, indent=4)
+    def write_correct_umi_file(self):
+        self.read_count.to_file(self.corrected_read_count_file)
 
     @utils.add_log
     def get_read_threshold(self):
@@ -146,28 +216,15 @@ class Filter(Step):
                 help_info="threshold = top 1% positive cell count / auto_coef",
             )
 
-        read_dict = utils.genDict(dim=1, valType=list)
-
-        for barcode in self.count_dict:
-            for ref in self.count_dict[barcode]:
-                read_dict[ref] += list(self.count_dict[barcode][ref].values())
-
-        if self.debug:
-            print(read_dict)
-
-        for ref in read_dict:
-            otsu_plot_path = f"{self.out_prefix}_{ref}_read_otsu.png"
-            runner = Threshold(
-                array=read_dict[ref],
-                threshold_method=self.args.read_threshold_method,
-                otsu_plot_path=otsu_plot_path,
-                hard_threshold=self.args.read_hard_threshold,
-                coef=self.args.auto_coef,
-                log_base=self.args.otsu_log_base,
-            )
-            read_threshold = runner.run()
-
-            self.read_threshold_dict[ref] = read_threshold
+        rc = self.read_count
+        self.read_threshold_dict = self.get_ref_thresholds(
+            rc.ref_code,
+            rc.read_count,
+            self.args.read_threshold_method,
+            self.args.read_hard_threshold,
+            "read",
+        )
+        for ref, read_threshold in self.read_threshold_dict.items():
             self.add_metric(
                 f"{ref} Read Threshold",
                 read_threshold,
@@ -175,43 +232,24 @@ class Filter(Step):
 
     @utils.add_log
     def filter_read(self):
-        for barcode in self.count_dict:
-            for ref in self.count_dict[barcode]:
-                for umi in self.count_dict[barcode][ref]:
-                    read_count = self.count_dict[barcode][ref][umi]
-                    if read_count < self.read_threshold_dict[ref]:
-                        self.del_umi += 1
-                        self.count_dict[barcode][ref][umi] = 0
-
-        """
-        self.add_metric(
-            name='Number of Total Filtered UMI',
-            value=self.del_umi,
-            total=self.raw_umi,
+        rc = self.read_count
+        ref_threshold = np.array(
+            [self.read_threshold_dict.get(ref, 0) for ref in rc.refs], dtype=np.int64
         )
-        """
+        del_mask = rc.read_count < ref_threshold[rc.ref_code]
+        self.del_umi += int(del_mask.sum())
+        rc.read_count = np.where(del_mask, 0, rc.read_count)
 
-    def write_filter_read_json(self):
-        with open(self.filter_read_count_file, "w") as fp:
-            json.dump(self.count_dict, fp, indent=4)
+    def write_filter_read_file(self):
+        self.read_count.to_file(self.filter_read_count_file)
 
     @utils.add_log
-    def set_barcode_ref_umi_dict(self):
-        for barcode in self.count_dict:
-            for ref in self.count_dict[barcode]:
-                for umi in self.count_dict[barcode][ref]:
-                    if self.count_dict[barcode][ref][umi] > 0:
-                        self.barcode_ref_umi_dict[barcode][ref] += 1
-        if self.debug:
-            print(dict(self.barcode_ref_umi_dict))
-
-    @utils.add_log
-    def set_ref_barcode_umi_dict(self):
-        for barcode in self.barcode_ref_umi_dict:
-            for ref in self.barcode_ref_umi_dict[barcode]:
-                self.ref_barcode_umi_dict[ref][barcode] = self.barcode_ref_umi_dict[
-                    barcode
-                ][ref]
+    def set_barcode_ref_umi(self):
+        (
+            self.pair_barcode_code,
+            self.pair_ref_code,
+            self.pair_umi,
+        ) = self.read_count.barcode_ref_umi()
 
     def get_umi_threshold(self):
         self.add_metric(
@@ -227,38 +265,39 @@ class Filter(Step):
                 help_info="threshold = top 1% positive cell count / auto_coef",
             )
 
-        for ref in self.ref_barcode_umi_dict:
-            umi_array = list(self.ref_barcode_umi_dict[ref].values())
-            otsu_plot_path = f"{self.out_prefix}_{ref}_UMI_otsu.png"
-            runner = Threshold(
-                umi_array,
-                threshold_method=self.args.umi_threshold_method,
-                otsu_plot_path=otsu_plot_path,
-                hard_threshold=self.args.umi_hard_threshold,
-                coef=self.args.auto_coef,
-                log_base=self.args.otsu_log_base,
-            )
-            umi_threshold = runner.run()
-
+        umi_threshold_dict = self.get_ref_thresholds(
+            self.pair_ref_code,
+            self.pair_umi,
+            self.args.umi_threshold_method,
+            self.args.umi_hard_threshold,
+            "UMI",
+        )
+        for ref, umi_threshold in umi_threshold_dict.items():
             umi_threshold = max(1, umi_threshold)
             self.umi_threshold_dict[ref] = umi_threshold
             self.add_metric(f"{ref} UMI Threshold", umi_threshold)
 
     @utils.add_log
     def filter_umi(self):
-        for ref in self.ref_barcode_umi_dict:
-            for barcode in self.ref_barcode_umi_dict[ref]:
-                if (
-                    self.ref_barcode_umi_dict[ref][barcode]
-                    < self.umi_threshold_dict[ref]
-                ):
-                    self.ref_barcode_umi_dict[ref][barcode] = 0
+        refs = self.read_count.refs
+        ref_threshold = np.array(
+            [self.umi_threshold_dict.get(ref, 1) for ref in refs], dtype=np.int64
+        )
+        self.pair_umi = np.where(
+            self.pair_umi < ref_threshold[self.pair_ref_code], 0, self.pair_umi
+        )
 
     @utils.add_log
     def add_umi_write_csv(self):
+        rc = self.read_count
+        ref_code_dict = {ref: code for code, ref in enumerate(rc.refs.tolist())}
         for ref in self.umi_threshold_dict:
-            self.df_filter_umi[ref] = pd.Series(self.ref_barcode_umi_dict[ref])
-            self.df_filter_umi[ref].fillna(0, inplace=True)
+            is_ref = self.pair_ref_code == ref_code_dict[ref]
+            barcode_umi = pd.Series(
+                self.pair_umi[is_ref], index=rc.barcodes[self.pair_barcode_code[is_ref]]
+            )
+            self.df_filter_umi[ref] = barcode_umi
+            self.df_filter_umi[ref] = self.df_filter_umi[ref].fillna(0)
 
         refs = list(self.umi_threshold_dict.keys())
         self.df_filter_umi[SUM_UMI_COLNAME] = self.df_filter_umi[refs].sum(axis=1)
@@ -280,14 +319,13 @@ class Filter(Step):
     def run(self):
         if not self.args.not_correct_UMI:
             self.correct_umi()
-            self.write_correct_umi_json()
+            self.write_correct_umi_file()
 
         self.get_read_threshold()
         self.filter_read()
-        self.write_filter_read_json()
+        self.write_filter_read_file()
 
-        self.set_barcode_ref_umi_dict()
-        self.set_ref_barcode_umi_dict()
+        self.set_barcode_ref_umi()
         self.get_umi_threshold()
         self.filter_umi()
 
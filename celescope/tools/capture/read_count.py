@@ -0,0 +1,154 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+
+class Read_count:
+    """
+    Columnar read counts of (barcode, ref, UMI).
+    barcode, ref and UMI sequences are stored once and each row stores their integer codes.
+    Saved as a `.npz` file.
+
+    >>> count_dict = {"AAA": {"virus": {"U1": 3, "U2": 1}}, "CCC": {"virus": {"U1": 2}}}
+    >>> read_count = Read_count.from_count_dict(count_dict)
+    >>> list(read_count.barcodes), list(read_count.umis), list(read_count.umi_code)
+    (['AAA', 'CCC'], ['U1', 'U2'], [0, 1, 0])
+    >>> read_count.to_count_dict() == count_dict
+    True
+    """
+
+    ARRAY_NAMES = [
+        "barcodes",
+        "refs",
+        "umis",
+        "barcode_code",
+        "ref_code",
+        "umi_code",
+        "read_count",
+    ]
+
+    def __init__(
+        self, barcodes, refs, umis, barcode_code, ref_code, umi_code, read_count
+    ):
+        self.barcodes = np.asarray(barcodes, dtype=str)
+        self.refs = np.asarray(refs, dtype=str)
+        self.umis = np.asarray(umis, dtype=str)
+        self.barcode_code = np.asarray(barcode_code, dtype=np.int32)
+        self.ref_code = np.asarray(ref_code, dtype=np.int32)
+        self.umi_code = np.asarray(umi_code, dtype=np.int32)
+        self.read_count = np.asarray(read_count, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.read_count)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Args:
+            records: iterable of (barcode, ref, umi, read_count)
+        """
+        df = pd.DataFrame(
+            list(records), columns=["barcode", "ref", "UMI", "read_count"]
+        )
+        barcode_code, barcodes = pd.factorize(df["barcode"])
+        ref_code, refs = pd.factorize(df["ref"])
+        umi_code, umis = pd.factorize(df["UMI"])
+        return cls(
+            barcodes, refs, umis, barcode_code, ref_code, umi_code, df["read_count"]
+        )
+
+    @classmethod
+    def from_count_dict(cls, count_dict):
+        """
+        Args:
+            count_dict: {barcode: {ref: {umi: read_count}}}
+        """
+        records = (
+            (barcode, ref, umi, read_count)
+            for barcode in count_dict
+            for ref in count_dict[barcode]
+            for umi, read_count in count_dict[barcode][ref].items()
+        )
+        return cls.from_records(records)
+
+    @classmethod
+    def from_file(cls, read_count_file):
+        """
+        `.json` file({barcode: {ref: {umi: read_count}}}) from older versions is also supported.
+        """
+        if read_count_file.endswith(".json"):
+            with open(read_count_file) as f:
+                return cls.from_count_dict(json.load(f))
+        with np.load(read_count_file, allow_pickle=False) as data:
+            return cls(*[data[name] for name in cls.ARRAY_NAMES])
+
+    def to_file(self, read_count_file):
+        np.savez_compressed(
+            read_count_file, **{name: getattr(self, name) for name in self.ARRAY_NAMES}
+        )
+
+    def to_count_dict(self):
+        count_dict = {}
+        for barcode, ref, umi, read_count in zip(
+            self.barcodes[self.barcode_code],
+            self.refs[self.ref_code],
+            self.umis[self.umi_code],
+            self.read_count.tolist(),
+        ):
+            count_dict.setdefault(barcode, {}).setdefault(ref, {})[umi] = read_count
+        return count_dict
+
+    def take(self, index):
+        """
+        Returns:
+            Read_count with rows selected by index(bool mask or int index). The codes are unchanged.
+        """
+        return Read_count(
+            self.barcodes,
+            self.refs,
+            self.umis,
+            self.barcode_code[index],
+            self.ref_code[index],
+            self.umi_code[index],
+            self.read_count[index],
+        )
+
+    def group_bounds(self):
+        """
+        Rows of each (barcode, ref) group must be contiguous, which is true for files written from count_dict.
+        Returns:
+            starts, ends of each (barcode, ref) group
+        """
+        n = len(self)
+        if n == 0:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        is_start = np.ones(n, dtype=bool)
+        is_start[1:] = (self.barcode_code[1:] != self.barcode_code[:-1]) | (
+            self.ref_code[1:] != self.ref_code[:-1]
+        )
+        starts = np.flatnonzero(is_start)
+        ends = np.append(starts[1:], n)
+        return starts, ends
+
+    def barcode_ref_umi(self):
+        """
+        Returns:
+            barcode_code, ref_code, UMI count of (barcode, ref) pairs with at least one UMI(read_count > 0),
+            ordered by their first row.
+        """
+        positive = self.read_count > 0
+        pair_code = (
+            self.barcode_code[positive].astype(np.int64) * len(self.refs)
+            + self.ref_code[positive]
+        )
+        uniq_code, first_index, umi_count = np.unique(
+            pair_code, return_index=True, return_counts=True
+        )
+        order = np.argsort(first_index, kind="stable")
+        uniq_code = uniq_code[order]
+        return (
+            uniq_code // len(self.refs),
+            uniq_code % len(self.refs),
+            umi_count[order],
+        )
@@ -3,6 +3,7 @@ import math
 import matplotlib.pyplot as plt
 import matplotlib
 import numpy as np
+import scipy.sparse
 
 import celescope.tools.utils as utils
 
@@ -187,3 +188,151 @@ class Threshold:
             raise ValueError(f"Unknown threshold method: {self.threshold_method}")
 
         return threshold
+
+
+def _sorted_rows(matrix):
+    """
+    Returns:
+        row index and data of positive values in csr matrix, sorted by (row, value)
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    row = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    data = matrix.data
+    positive = data > 0
+    row, data = row[positive], data[positive]
+    order = np.lexsort((data, row))
+    return row[order], data[order], matrix.shape[0]
+
+
+def otsu_batch(matrix, log_base=10, otsu_min_len=50, bin_width=0.2, **kwargs):
+    """
+    Otsu threshold of each row in a csr matrix. Same result as `Otsu(row).run()`.
+    Rows with less than otsu_min_len positive values get threshold 1.
+
+    >>> rng = np.random.default_rng(0)
+    >>> array = np.vstack([rng.integers(0, 1000, 200), rng.integers(0, 10, 200), rng.integers(0, 3, 200)])
+    >>> otsu_batch(scipy.sparse.csr_matrix(array)).tolist()
+    [100, 3, 1]
+    >>> [Otsu(row).run() for row in array]
+    [100, 3, 1]
+    """
+    log_base = int(log_base)
+    row, data, n_row = _sorted_rows(matrix)
+    thresholds = np.ones(n_row, dtype=np.int64)
+    n_positive = np.bincount(row, minlength=n_row)
+    valid_row = n_positive >= otsu_min_len
+    keep = valid_row[row]
+    row, data = row[keep], data[keep]
+    if len(data) == 0:
+        return thresholds
+
+    # same bins as np.arange(0, max + bin_width, bin_width) in each row
+    log_data = np.log(data) / np.log(log_base)
+    row_max = np.zeros(n_row)
+    np.maximum.at(row_max, row, log_data)
+    n_edge = np.ceil((row_max + bin_width) / bin_width).astype(np.int64)
+    edges = np.arange(0, row_max.max() + bin_width, bin_width)
+    if len(edges) < 2:
+        edges = np.array([0, bin_width])
+    n_bin = len(edges) - 1
+    bin_index = np.searchsorted(edges, log_data, side="right") - 1
+    bin_index = np.clip(bin_index, 0, np.maximum(n_edge[row] - 2, 0))
+    counts = np.zeros((n_row, n_bin))
+    np.add.at(counts, (row, bin_index), 1)
+
+    # Otsu in all rows. Zero counts after the last bin of a row do not change the result.
+    bin_centers = edges[:-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight1 = np.cumsum(counts, axis=1)
+        weight2 = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+        mean1 = np.cumsum(counts * bin_centers, axis=1) / weight1
+        mean2 = (np.cumsum((counts * bin_centers)[:, ::-1], axis=1) / weight2[:, ::-1])[
+            :, ::-1
+        ]
+        variance12 = (
+            weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:]) ** 2
+        )
+    # a row with n bins has n - 1 candidates. Otsu keeps the initial threshold 1 when there is no candidate.
+    is_candidate = np.arange(n_bin - 1) < (n_edge - 2)[:, None]
+    variance12 = np.where(is_candidate & ~np.isnan(variance12), variance12, -np.inf)
+    exponent = np.ones(n_row)
+    if n_bin > 1:
+        has_candidate = valid_row & np.isfinite(variance12.max(axis=1))
+        idx = np.argmax(variance12, axis=1)
+        exponent[has_candidate] = bin_centers[idx[has_candidate]]
+    thresholds[valid_row] = np.ceil(log_base ** exponent[valid_row]).astype(np.int64)
+    return thresholds
+
+
+def auto_batch(matrix, percentile=99, coef=3, expected_cell_num=None, **kwargs):
+    """
+    Auto threshold of each row in a csr matrix. Same result as `Auto(row).run()`.
+
+    >>> matrix = scipy.sparse.csr_matrix([[50] * 4 + [4] * 4, [1, 2, 20, 30, 40, 0, 0, 0], [0] * 8])
+    >>> auto_batch(matrix, coef=10).tolist()
+    [5, 3, 1]
+    >>> [Auto(row, coef=10).run() for row in matrix.toarray()]
+    [5, 3, 1]
+    """
+    coef = int(coef)
+    row, data, n_row = _sorted_rows(matrix)
+    thresholds = np.ones(n_row, dtype=np.int64)
+    n_positive = np.bincount(row, minlength=n_row)
+    row_end = np.cumsum(n_positive)
+    n_use = n_positive
+    if expected_cell_num:
+        n_use = np.minimum(n_positive, expected_cell_num)
+    has_value = n_positive > 0
+    if len(data) == 0:
+        return thresholds
+
+    # linear interpolation as np.percentile, on the top n_use values of each row
+    row_start = row_end - n_use
+    virtual_index = (n_use - 1) * (percentile / 100)
+    previous = np.floor(virtual_index).astype(np.int64)
+    gamma = virtual_index - previous
+    next_ = np.minimum(previous + 1, n_use - 1)
+    a = data[np.clip(row_start + previous, 0, len(data) - 1)][has_value]
+    b = data[np.clip(row_start + next_, 0, len(data) - 1)][has_value]
+    gamma = gamma[has_value]
+    diff = b - a
+    value = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+    thresholds[has_value] = (value / coef).astype(np.int64)
+    return thresholds
+
+
+def threshold_batch(matrix, threshold_method="auto", hard_threshold=None, **kwargs):
+    """
+    Thresholds of all rows in a csr matrix. Same result as `Threshold(row, ...).run()` for each row.
+    Otsu plots are not drawn. Use `Threshold` with `otsu_plot_path` for rows that need plots.
+    """
+    n_row = matrix.shape[0]
+    if threshold_method == "otsu":
+        thresholds = otsu_batch(matrix, **kwargs)
+    elif threshold_method == "auto":
+        thresholds = auto_batch(matrix, **kwargs)
+    elif threshold_method == "hard":
+        if hard_threshold:
+            thresholds = np.full(n_row, int(hard_threshold), dtype=np.int64)
+        else:
+            raise Exception("hard_threshold must be set")
+    elif threshold_method == "none":
+        thresholds = np.ones(n_row, dtype=np.int64)
+    else:
+        raise ValueError(f"Unknown threshold method: {threshold_method}")
+
+    # rows without positive values
+    empty = np.diff(scipy.sparse.csr_matrix(matrix > 0).indptr) == 0
+    thresholds[empty] = 1
+    return thresholds
+
+
+def top_rows(matrix, top_n):
+    """
+    Returns:
+        index of top_n rows with the largest sums
+    """
+    if not top_n:
+        return []
+    row_sum = np.asarray(matrix.sum(axis=1)).ravel()
+    return np.argsort(-row_sum, kind="stable")[:top_n].tolist()
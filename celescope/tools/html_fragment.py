@@ -0,0 +1,168 @@
+"""
+Render the HTML report from cached fragments.
+"""
+
+import hashlib
+import json
+import os
+
+from jinja2 import meta, nodes
+
+from celescope.tools import utils
+
+# directory of cached fragments in the sample directory
+FRAGMENT_DIR = ".report_fragments"
+# file of fragment keys in FRAGMENT_DIR
+KEY_FILE = "keys.json"
+# included files with these suffixes are static text and are not parsed
+STATIC_SUFFIXES = (".js", ".css")
+
+
+class Fragment_renderer:
+    """
+    Split a report template into fragments and render only the fragments whose input changed.
+
+    The top level nodes of the template are fragments. Included html templates at the top level are inlined recursively,
+    so each `{% if {step}_summary is defined %}` section is a fragment.
+    The key of a fragment is the hash of its template sources and the context variables used in them.
+    A fragment is rendered only if its key is different from the cached key.
+    Concatenated fragments are the same as the whole template rendered at once.
+    """
+
+    def __init__(self, env, template_name, fragment_dir):
+        self.env = env
+        self.template_name = template_name
+        self.fragment_dir = fragment_dir
+        self.key_file = f"{fragment_dir}/{KEY_FILE}"
+
+        # {template name: source}
+        self.sources = {}
+        # {template name: (variables, referenced template names)}
+        self.refs = {}
+        # list of (template name, node)
+        self.fragments = []
+        self._split(template_name)
+
+    def get_source(self, name):
+        if name not in self.sources:
+            self.sources[name] = self.env.loader.get_source(self.env, name)[0]
+        return self.sources[name]
+
+    @staticmethod
+    def is_inline_include(node):
+        return (
+            isinstance(node, nodes.Include)
+            and isinstance(node.template, nodes.Const)
+            and node.template.value.endswith(".html")
+            and node.with_context
+            and not node.ignore_missing
+        )
+
+    def _split(self, name):
+        ast = self.env.parse(self.get_source(name), name)
+        for node in ast.body:
+            if self.is_inline_include(node):
+                self._split(node.template.value)
+            else:
+                self.fragments.append((name, node))
+
+    def _node_template(self, node):
+        template = nodes.Template([node], lineno=1)
+        template.set_environment(self.env)
+        return template
+
+    def get_refs(self, name):
+        """
+        Returns:
+            undeclared variables and referenced template names of template name. Static files have none.
+        """
+        if name not in self.refs:
+            if name.endswith(STATIC_SUFFIXES):
+                self.refs[name] = (set(), [])
+            else:
+                ast = self.env.parse(self.get_source(name), name)
+                self.refs[name] = (
+                    meta.find_undeclared_variables(ast),
+                    list(meta.find_referenced_templates(ast)),
+                )
+        return self.refs[name]
+
+    def get_key(self, index, context):
+        """
+        Returns:
+            hash of the fragment source, sources of all templates it includes and the context variables they use.
+            If a template name is not constant, all context variables are used.
+        """
+        name, node = self.fragments[index]
+        template = self._node_template(node)
+        variables = set(meta.find_undeclared_variables(template))
+        templates = list(meta.find_referenced_templates(template))
+        included = set()
+        all_context = False
+        while templates:
+            included_name = templates.pop()
+            if included_name is None:
+                all_context = True
+                continue
+            if included_name in included:
+                continue
+            included.add(included_name)
+            included_variables, included_templates = self.get_refs(included_name)
+            variables |= included_variables
+            templates.extend(included_templates)
+        if all_context:
+            variables = set(context)
+
+        sha1 = hashlib.sha1()
+        sha1.update(f"{index}\0{name}\0{self.get_source(name)}".encode())
+        for included_name in sorted(included):
+            sha1.update(f"\0{included_name}\0{self.get_source(included_name)}".encode())
+        used_context = {var: context[var] for var in variables if var in context}
+        sha1.update(json.dumps(used_context, sort_keys=True, default=str).encode())
+        return sha1.hexdigest()
+
+    def render_fragment(self, index, context):
+        name, node = self.fragments[index]
+        code = self.env.compile(self._node_template(node), name)
+        template = self.env.template_class.from_code(
+            self.env, code, self.env.make_globals(None)
+        )
+        return template.render(context)
+
+    def _load_keys(self):
+        if not os.path.exists(self.key_file):
+            return {}
+        with open(self.key_file) as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                return {}
+
+    @utils.add_log
+    def write(self, context, html_file):
+        """
+        Render changed fragments into fragment_dir and concatenate all fragments into html_file.
+        """
+        utils.check_mkdir(self.fragment_dir)
+        old_keys = self._load_keys()
+        keys = {}
+        n_render = 0
+        for index in range(len(self.fragments)):
+            fragment_file = f"{self.fragment_dir}/{index}.html"
+            key = self.get_key(index, context)
+            keys[str(index)] = key
+            if old_keys.get(str(index)) == key and os.path.exists(fragment_file):
+                continue
+            with open(fragment_file, "w", encoding="utf8") as f:
+                f.write(self.render_fragment(index, context))
+            n_render += 1
+        with open(self.key_file, "w") as f:
+            json.dump(keys, f, indent=4)
+        self.write.logger.info(
+            f"{n_render} of {len(self.fragments)} fragments rendered"
+        )
+
+        with open(html_file, "w", encoding="utf8") as out:
+            for index in range(len(self.fragments)):
+                with open(f"{self.fragment_dir}/{index}.html", encoding="utf8") as f:
+                    out.write(f.read())
@@ -0,0 +1,172 @@
+"""
+Run the step graph of multi_{assay} on the local machine.
+"""
+
+import json
+import os
+import subprocess
+import time
+
+from celescope.tools import utils
+
+# seconds between checks of running jobs
+POLL_INTERVAL = 1
+# job status
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+def get_total_mem():
+    """
+    Returns:
+        physical memory in GB
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+
+
+class Local_executor:
+    """
+    Run jobs concurrently when their dependencies are done and their threads(x) and memory(m, GB)
+    fit in the free cores and memory. Jobs are started in the order they are added, and smaller jobs
+    may start before a larger job that does not fit yet.
+    A job larger than the budget is run alone.
+    A failed job is retried up to `retry` times. Jobs depending on a failed job are skipped.
+
+    Args:
+        job_dict: {job name: {"cmd": str, "m": memory GB, "x": threads, "after": [job names]}}
+        log_dir: stdout and stderr of each job are written to `{log_dir}/{job name}.log`.
+            Status, attempts and time of each job are written to `{log_dir}/local_status.json`.
+    """
+
+    def __init__(self, job_dict, cores, mem, log_dir, retry=0):
+        self.job_dict = job_dict
+        self.cores = cores
+        self.mem = mem
+        self.log_dir = log_dir
+        self.retry = retry
+        self.status_file = f"{log_dir}/local_status.json"
+
+        self.status_dict = {
+            name: {
+                "status": PENDING,
+                "attempts": 0,
+                "start": None,
+                "end": None,
+                "wall_time": None,
+                "returncode": None,
+                "m": job["m"],
+                "x": job["x"],
+            }
+            for name, job in job_dict.items()
+        }
+        # {job name: (Popen, log handle, start time)}
+        self.running = {}
+
+    def get_resource(self, name):
+        """
+        Returns:
+            threads, memory of the job, capped by the budget.
+        """
+        job = self.job_dict[name]
+        return min(int(job["x"]), self.cores), min(float(job["m"]), self.mem)
+
+    def is_ready(self, name):
+        return self.status_dict[name]["status"] == PENDING and all(
+            self.status_dict[after]["status"] == DONE
+            for after in self.job_dict[name]["after"]
+        )
+
+    def write_status(self):
+        tmp_file = f"{self.status_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.status_dict, f, indent=4)
+        os.replace(tmp_file, self.status_file)
+
+    def start(self, name):
+        status = self.status_dict[name]
+        status["status"] = RUNNING
+        status["attempts"] += 1
+        status["start"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        log_handle = open(f"{self.log_dir}/{name}.log", "a")
+        log_handle.write(
+            f"# attempt {status['attempts']}: {self.job_dict[name]['cmd']}\n"
+        )
+        log_handle.flush()
+        proc = subprocess.Popen(
+            self.job_dict[name]["cmd"],
+            shell=True,
+            stdout=log_handle,
+            stderr=subprocess.STDOUT,
+        )
+        self.running[name] = (proc, log_handle, time.time())
+        self.run.logger.info(f"start {name}")
+
+    def skip_downstream(self, failed_name):
+        failed = {failed_name}
+        changed = True
+        while changed:
+            changed = False
+            for name, job in self.job_dict.items():
+                if self.status_dict[name]["status"] == PENDING and failed & set(
+                    job["after"]
+                ):
+                    self.status_dict[name]["status"] = SKIPPED
+                    failed.add(name)
+                    changed = True
+
+    def finish(self, name, returncode):
+        proc, log_handle, start_time = self.running.pop(name)
+        log_handle.close()
+        status = self.status_dict[name]
+        status["end"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        status["wall_time"] = round(time.time() - start_time, 1)
+        status["returncode"] = returncode
+        if returncode == 0:
+            status["status"] = DONE
+            self.run.logger.info(f"{name} done. time used: {status['wall_time']}s")
+        elif status["attempts"] <= self.retry:
+            status["status"] = PENDING
+            self.run.logger.warning(f"{name} failed with {returncode}. Retry.")
+        else:
+            status["status"] = FAILED
+            self.run.logger.error(f"{name} failed with {returncode}.")
+            self.skip_downstream(name)
+
+    @utils.add_log
+    def run(self):
+        """
+        Returns:
+            names of jobs that are not done
+        """
+        utils.check_mkdir(self.log_dir)
+        self.write_status()
+        while True:
+            used_cores = sum(self.get_resource(name)[0] for name in self.running)
+            used_mem = sum(self.get_resource(name)[1] for name in self.running)
+            for name in self.job_dict:
+                if not self.is_ready(name):
+                    continue
+                x, m = self.get_resource(name)
+                if used_cores + x <= self.cores and used_mem + m <= self.mem:
+                    self.start(name)
+                    used_cores += x
+                    used_mem += m
+            self.write_status()
+            if not self.running:
+                break
+
+            time.sleep(POLL_INTERVAL)
+            for name, (proc, _log_handle, _start_time) in list(self.running.items()):
+                returncode = proc.poll()
+                if returncode is not None:
+                    self.finish(name, returncode)
+
+        self.write_status()
+        return [
+            name
+            for name, status in self.status_dict.items()
+            if status["status"] != DONE
+        ]
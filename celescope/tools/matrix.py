@@ -168,8 +168,25 @@ class CountMatrix:
         return self.__str__()
 
     def concat_by_barcodes(self, other):
+        """
+        Append features of other. Columns of other are aligned to the barcodes of self by index.
+
+        >>> m1 = CountMatrix(Features(["g1"]), ["A", "B"], scipy.sparse.coo_matrix([[1, 2]]))
+        >>> m2 = CountMatrix(Features(["t1"]), ["B", "A"], scipy.sparse.coo_matrix([[3, 0]]))
+        >>> m1.concat_by_barcodes(m2).get_matrix().toarray().tolist()
+        [[1, 2], [0, 3]]
+        """
+        other_matrix = other.get_matrix().tocsc()
         if other.get_barcodes() != self.get_barcodes():
-            raise ValueError("barcodes are not the same")
+            barcode_index = pd.Index(other.get_barcodes()).get_indexer(
+                self.get_barcodes()
+            )
+            if (
+                len(other.get_barcodes()) != len(self.get_barcodes())
+                or (barcode_index < 0).any()
+            ):
+                raise ValueError("barcodes are not the same")
+            other_matrix = other_matrix[:, barcode_index]
 
         if inter := set(self.get_features().gene_id).intersection(
             set(other.get_features().gene_id)
@@ -183,7 +200,9 @@ class CountMatrix:
             gene_type = self.get_features().gene_type + other.get_features().gene_type
         features = Features(gene_id, gene_name, gene_type)
 
-        matrix = scipy.sparse.vstack([self.get_matrix(), other.get_matrix()])
+        matrix = scipy.sparse.vstack(
+            [self.get_matrix().tocsc(), other_matrix], format="csc"
+        )
 
         return CountMatrix(features, self.__barcodes, matrix)
 
@@ -1,37 +1,213 @@
 import argparse
+import hashlib
 import json
 import os
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 from celescope.tools import utils
 
+# columnar cache of sample metrics in outdir
+CACHE_FILE = ".merge_table_cache.npz"
+# default number of threads to read `.data.json`. Reading is I/O-bound.
+READ_THREAD = 16
+
+
+def get_sample_metrics(sample_data_dict):
+    """
+    Returns:
+        {step: {metric_name: display}} of all summaries in `.data.json`.
+        Steps without metrics are not included.
+
+    >>> sample_data_dict = {
+    ...     "barcode_summary": {
+    ...         "metric_list": [{"name": "Raw Reads", "display": "100"}],
+    ...         "comment_metric_list": [{"name": "Valid Reads", "display": "90(90.0%)"}],
+    ...     },
+    ...     "cells_summary": {"metric_list": [], "comment_metric_list": []},
+    ...     "sample_summary": {"metric_list": [{"name": "Assay", "display": "rna"}]},
+    ... }
+    >>> get_sample_metrics(sample_data_dict)
+    {'barcode': {'Raw_Reads': '100', 'Valid_Reads': '90(90.0%)'}}
+    """
+    sample_metrics = {}
+    for title, summary in sample_data_dict.items():
+        if not title.endswith("_summary") or not isinstance(summary, dict):
+            continue
+        if "metric_list" not in summary or "comment_metric_list" not in summary:
+            continue
+        metric_list = summary["metric_list"] + summary["comment_metric_list"]
+        if metric_list:
+            step = title[: -len("_summary")]
+            sample_metrics[step] = {
+                metric["name"].replace(" ", "_"): metric["display"]
+                for metric in metric_list
+            }
+    return sample_metrics
+
+
+def get_file_hash(data_file):
+    with open(data_file, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_sample(data_file, cached=None):
+    """
+    Read metrics from data_file unless it is unchanged since cached.
+    A file is unchanged if its mtime and size are the same, or if its content hash is the same.
+
+    Args:
+        cached: (mtime_ns, size, file_hash, sample_metrics) from the cache or None.
+    Returns:
+        (mtime_ns, size, file_hash, sample_metrics), whether the file is read
+    """
+    stat = os.stat(data_file)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached, False
+    file_hash = get_file_hash(data_file)
+    if cached is not None and cached[2] == file_hash:
+        return (stat.st_mtime_ns, stat.st_size, file_hash, cached[3]), False
+    with open(data_file) as f:
+        sample_metrics = get_sample_metrics(json.load(f))
+    return (stat.st_mtime_ns, stat.st_size, file_hash, sample_metrics), True
+
+
+def save_cache(cache_file, cache):
+    """
+    Save cache as columns. Metrics are stored in long format: one row per (sample, step, metric).
+    Sample, step and metric names are stored once and each row stores their integer codes.
+    Displays are json encoded so that their types are kept.
+
+    Args:
+        cache: {sample: (mtime_ns, size, file_hash, sample_metrics)}
+    """
+    samples = list(cache)
+    steps = {}
+    names = {}
+    sample_code, step_code, name_code, displays = [], [], [], []
+    for i, sample in enumerate(samples):
+        for step, metric_dict in cache[sample][3].items():
+            for name, display in metric_dict.items():
+                sample_code.append(i)
+                step_code.append(steps.setdefault(step, len(steps)))
+                name_code.append(names.setdefault(name, len(names)))
+                displays.append(json.dumps(display))
+
+    tmp_file = cache_file[: -len(".npz")] + ".tmp.npz"
+    np.savez_compressed(
+        tmp_file,
+        samples=np.array(samples, dtype=str),
+        mtime_ns=np.array([cache[sample][0] for sample in samples], dtype=np.int64),
+        size=np.array([cache[sample][1] for sample in samples], dtype=np.int64),
+        file_hash=np.array([cache[sample][2] for sample in samples], dtype=str),
+        steps=np.array(list(steps), dtype=str),
+        names=np.array(list(names), dtype=str),
+        sample_code=np.array(sample_code, dtype=np.int32),
+        step_code=np.array(step_code, dtype=np.int32),
+        name_code=np.array(name_code, dtype=np.int32),
+        displays=np.array(displays, dtype=str),
+    )
+    os.replace(tmp_file, cache_file)
+
 
 @utils.add_log
-def append_sample_data(sample, sample_data_dict, all_data_dict, steps):
+def load_cache(cache_file):
     """
-    append sample data to all_data_dict
+    Returns:
+        {sample: (mtime_ns, size, file_hash, sample_metrics)}. Empty if cache_file does not exist or is broken.
+    """
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with np.load(cache_file, allow_pickle=False) as data:
+            samples = data["samples"].tolist()
+            cache = {
+                sample: (mtime_ns, size, file_hash, {})
+                for sample, mtime_ns, size, file_hash in zip(
+                    samples,
+                    data["mtime_ns"].tolist(),
+                    data["size"].tolist(),
+                    data["file_hash"].tolist(),
+                )
+            }
+            steps = data["steps"]
+            names = data["names"]
+            for sample_code, step, name, display in zip(
+                data["sample_code"].tolist(),
+                steps[data["step_code"]].tolist(),
+                names[data["name_code"]].tolist(),
+                data["displays"].tolist(),
+            ):
+                cache[samples[sample_code]][3].setdefault(step, {})[name] = json.loads(
+                    display
+                )
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        load_cache.logger.warning(f"Ignore broken cache {cache_file}: {e}")
+        return {}
+    return cache
+
+
+@utils.add_log
+def read_samples(samples, cache, thread):
+    """
+    Read `{sample}/.data.json` of samples in parallel threads. Unchanged samples are taken from cache.
+
+    Returns:
+        {sample: (mtime_ns, size, file_hash, sample_metrics)}, number of samples read
+    """
+
+    def read_one(sample):
+        return read_sample(f"{sample}/.data.json", cache.get(sample))
+
+    with ThreadPoolExecutor(max_workers=max(1, thread)) as executor:
+        results = list(executor.map(read_one, samples))
+
+    n_read = sum(is_read for _entry, is_read in results)
+    read_samples.logger.info(
+        f"{n_read} samples read, {len(samples) - n_read} samples unchanged"
+    )
+    return {
+        sample: entry for sample, (entry, _is_read) in zip(samples, results)
+    }, n_read
+
+
+def get_step_tables(samples, metrics_dict, steps):
+    """
+    Build the summary table of each step in one construction.
+    Samples without metrics of a step are not included in its table.
+
     Args:
-        all_data_dict - key: step, value: list of sample series
+        metrics_dict: {sample: {step: {metric_name: display}}}
+    Returns:
+        {step: DataFrame with sample column first}
+
+    >>> metrics_dict = {
+    ...     "s1": {"barcode": {"Raw_Reads": "100"}},
+    ...     "s2": {"barcode": {"Raw_Reads": "50", "Q30": "90%"}, "cells": {"Cells": "10"}},
+    ... }
+    >>> tables = get_step_tables(["s1", "s2"], metrics_dict, ["barcode", "cells", "count"])
+    >>> list(tables)
+    ['barcode', 'cells']
+    >>> tables["barcode"]
+      sample Raw_Reads  Q30
+    0     s1       100  NaN
+    1     s2        50  90%
     """
+    tables = {}
     for step in steps:
-        title = step + "_summary"
-        if title in sample_data_dict:
-            metric_list = (
-                sample_data_dict[title]["metric_list"]
-                + sample_data_dict[title]["comment_metric_list"]
-            )
-            if metric_list:
-                metric_dict = {"sample": sample}
-                for metric in metric_list:
-                    name = metric["name"].replace(" ", "_")
-                    metric_dict[name] = metric["display"]
-
-                all_data_dict[step].append(pd.Series(metric_dict))
+        records = [
+            {"sample": sample, **metrics_dict[sample][step]}
+            for sample in samples
+            if step in metrics_dict[sample]
+        ]
+        if records:
+            tables[step] = pd.DataFrame.from_records(records).astype(object)
+    return tables
 
 
 @utils.add_log
-def write_merge_report(all_data_dict, merge_report_handle, steps):
+def write_merge_report(tables, merge_report_handle):
     """
     merge_report:
         ## sample_summary
@@ -40,15 +216,13 @@ def write_merge_report(all_data_dict, merge_report_handle, steps):
         ## barcode_summary
 
     Args:
-        all_data_dict - key: title, value: list of sample series
+        tables - key: step, value: summary table of the step
     """
 
-    for step in steps:
-        if all_data_dict[step]:
-            merge_report_handle.write(f"## {step}_summary\n")
-            df = pd.concat(all_data_dict[step], axis=1).T
-            df.to_csv(merge_report_handle, index=False, mode="a", sep="\t")
-            merge_report_handle.write("\n")
+    for step, df in tables.items():
+        merge_report_handle.write(f"## {step}_summary\n")
+        df.to_csv(merge_report_handle, index=False, mode="a", sep="\t")
+        merge_report_handle.write("\n")
 
 
 @utils.add_log
@@ -57,16 +231,19 @@ def run(args):
     os.chdir(args.outdir)
     out_file = "merge.xls"
 
-    all_data_dict = defaultdict(list)
     steps = args.steps.split(",")
     samples = args.samples.split(",")
     run.logger.info(f"samples: {samples}")
 
-    for sample in samples:
-        sample_data_dict = json.load(open(f"{sample}/.data.json", "r"))
-        append_sample_data(sample, sample_data_dict, all_data_dict, steps)
+    cache = {} if args.no_cache else load_cache(CACHE_FILE)
+    sample_cache, n_read = read_samples(samples, cache, int(args.thread))
+    if not args.no_cache and (n_read or sample_cache.keys() != cache.keys()):
+        save_cache(CACHE_FILE, sample_cache)
 
-    write_merge_report(all_data_dict, open(out_file, "w"), steps)
+    metrics_dict = {sample: entry[3] for sample, entry in sample_cache.items()}
+    tables = get_step_tables(samples, metrics_dict, steps)
+    with open(out_file, "w") as merge_report_handle:
+        write_merge_report(tables, merge_report_handle)
 
 
 def main():
@@ -74,6 +251,16 @@ def main():
     parser.add_argument("--outdir", help="outdir", required=True)
     parser.add_argument("--samples", help="samples, seperated by comma", required=True)
     parser.add_argument("--steps", help="steps", required=True)
+    parser.add_argument(
+        "--thread",
+        help="Number of threads to read `.data.json` files.",
+        default=READ_THREAD,
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help=f"Read all samples and do not use or write `{CACHE_FILE}`.",
+    )
     parser.add_argument(
         "--rm_files", action="store_true", help="remove all fq and bam after running"
     )
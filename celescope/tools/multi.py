@@ -11,6 +11,7 @@ from celescope.tools import utils
 from celescope.celescope import ArgFormatter
 from celescope.__init__ import HELP_DICT
 from celescope.tools.make_ref import MakeRef
+from celescope.tools.local_executor import Local_executor, get_total_mem
 
 TOOLS_DIR = os.path.dirname(celescope.tools.__file__)
 
@@ -54,6 +55,8 @@ class Multi:
         self.sjm_cmd = ""
         self.sjm_order = ""
         self.shell_dict = defaultdict(str)
+        # step graph. {job name: {"cmd": str, "m": memory GB, "x": threads, "after": [job names]}}
+        self.job_dict = {}
 
         self.outdir_dic = {}
 
@@ -106,11 +109,30 @@ fastq_prefix2_1.fq.gz	fastq_prefix2_2.fq.gz
         )
         parser.add_argument(
             "--mod",
-            help="Which type of script to generate, `sjm` or `shell`.",
-            choices=["sjm", "shell"],
+            help="Which type of script to generate, `sjm` or `shell`. `local` runs all samples and steps on this machine "
+            "concurrently within `--local_cores` and `--local_mem`.",
+            choices=["sjm", "shell", "local"],
             default="sjm",
         )
         parser.add_argument("--queue", help="Only works if the `--mod` selects `sjm`.")
+        parser.add_argument(
+            "--local_cores",
+            help="Only works if the `--mod` selects `local`. Total threads of running steps. Default all cores.",
+            type=int,
+            default=os.cpu_count(),
+        )
+        parser.add_argument(
+            "--local_mem",
+            help="Only works if the `--mod` selects `local`. Total memory(GB) of running steps. Default physical memory.",
+            type=float,
+            default=round(get_total_mem()),
+        )
+        parser.add_argument(
+            "--local_retry",
+            help="Only works if the `--mod` selects `local`. Number of retries of a failed step.",
+            type=int,
+            default=0,
+        )
         parser.add_argument(
             "--rm_files",
             action="store_true",
@@ -133,6 +155,8 @@ use `--steps_run barcode,cutadapt`
             action="store_true",
         )
         parser.add_argument("--debug", help=HELP_DICT["debug"], action="store_true")
+        parser.add_argument("--profile", help=HELP_DICT["profile"], action="store_true")
+        parser.add_argument("--resume", help=HELP_DICT["resume"], action="store_true")
         self.parser = parser
         return parser
 
@@ -196,11 +220,12 @@ use `--steps_run barcode,cutadapt`
         if self.args.steps_run != "all":
             self.steps_run = self.args.steps_run.strip().split(",")
 
+        if self.args.mod in ("sjm", "local"):
+            self.logdir = self.args.outdir + "/log"
+            utils.check_mkdir(self.logdir)
         if self.args.mod == "sjm":
             self.sjm_dir = f"{self.args.outdir}/sjm/"
             utils.check_mkdir(self.sjm_dir)
-            self.logdir = self.args.outdir + "/log"
-            utils.check_mkdir(self.logdir)
 
             self.sjm_file = f"{self.sjm_dir}/sjm.job"
             self.sjm_cmd = f"log_dir {self.logdir}\n"
@@ -223,6 +248,7 @@ use `--steps_run barcode,cutadapt`
     def generate_cmd(self, cmd, step, sample, m=1, x=1):
         if sample:
             sample = "_" + sample
+        self.job_dict[f"{step}{sample}"] = {"cmd": cmd, "m": m, "x": x, "after": []}
         sched_options = f"sched_options -w n -cwd -V -l vf={m}g,p={x}"
         if self.args.queue:
             sched_options += f" -q {self.args.queue} "
@@ -238,9 +264,13 @@ job_end
         self.generate_cmd(cmd, step, sample, m=m, x=x)
         self.shell_dict[sample] += cmd + "\n"
         if self.last_step:
-            self.sjm_order += f"order {step}_{sample} after {self.last_step}_{sample}\n"
+            self.add_order(f"{step}_{sample}", f"{self.last_step}_{sample}")
         self.last_step = step
 
+    def add_order(self, job, after):
+        self.sjm_order += f"order {job} after {after}\n"
+        self.job_dict[job]["after"].append(after)
+
     def parse_step_args(self, step):
         step_module = utils.find_step_module(self.__ASSAY__, step)
         func_opts = getattr(step_module, f"get_opts_{step}")
@@ -264,6 +294,10 @@ job_end
         cmd_line = step_prefix
         if self.args.debug:
             cmd_line += " --debug "
+        if self.args.profile:
+            cmd_line += " --profile "
+        if self.args.resume:
+            cmd_line += " --resume "
         for arg in args_dict:
             if args_dict[arg] is False:
                 continue
@@ -389,7 +423,7 @@ job_end
             cmd += " --rm_files"
         self.generate_cmd(cmd, step, sample="")
         for sample in self.fq_dict:
-            self.sjm_order += f"order {step} after {self.last_step}_{sample}\n"
+            self.add_order(step, f"{self.last_step}_{sample}")
 
     def end(self):
         if self.args.mod == "sjm":
@@ -397,6 +431,18 @@ job_end
             with open(self.sjm_file, "w") as fh:
                 fh.write(self.sjm_cmd + "\n")
                 fh.write(self.sjm_order)
+        if self.args.mod == "local":
+            self.merge_report()
+            executor = Local_executor(
+                self.job_dict,
+                cores=self.args.local_cores,
+                mem=self.args.local_mem,
+                log_dir=self.logdir,
+                retry=self.args.local_retry,
+            )
+            not_done = executor.run()
+            if not_done:
+                sys.exit(f"Steps not done: {','.join(not_done)}")
         if self.args.mod == "shell":
             os.system("mkdir -p ./shell/")
             for sample in self.shell_dict:
@@ -0,0 +1,103 @@
+"""
+Resource usage of steps and `utils.add_log` decorated functions.
+
+Usage of child processes(STAR, featureCounts, igblast...) is counted after they exit and are waited for.
+Bytes read/written are `rchar`/`wchar` in `/proc/self/io`, which include reaped child processes.
+"""
+
+import resource
+import sys
+import time
+
+# /proc file of I/O counters
+PROC_IO_FILE = "/proc/self/io"
+# ru_maxrss is in bytes on macOS and in kilobytes on Linux
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+MB = 1024 * 1024
+
+# records of add_log decorated functions in this process
+_function_records = []
+
+
+def read_proc_io(proc_io_file=PROC_IO_FILE):
+    """
+    Returns:
+        bytes read, bytes written. None, None if proc_io_file is not available.
+    """
+    try:
+        with open(proc_io_file) as f:
+            io_dict = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io_dict["rchar"]), int(io_dict["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def get_usage():
+    """
+    Returns:
+        cumulative usage of this process and its reaped child processes.
+    """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = read_proc_io()
+    return {
+        "time": time.time(),
+        "user_time": self_usage.ru_utime,
+        "sys_time": self_usage.ru_stime,
+        "children_user_time": children_usage.ru_utime,
+        "children_sys_time": children_usage.ru_stime,
+        "maxrss": self_usage.ru_maxrss * MAXRSS_UNIT,
+        "children_maxrss": children_usage.ru_maxrss * MAXRSS_UNIT,
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes,
+    }
+
+
+def get_usage_diff(start, end):
+    """
+    Returns:
+        usage between start and end. Peak RSS is the high-water mark at end:
+        of this process and of the largest child process.
+
+    >>> start = {"time": 0, "user_time": 1, "sys_time": 0, "children_user_time": 0, "children_sys_time": 0,
+    ...          "maxrss": MB, "children_maxrss": 0, "read_bytes": 10, "write_bytes": None}
+    >>> end = dict(start, time=3.5, user_time=2.5, children_user_time=4, maxrss=3 * MB, read_bytes=110)
+    >>> diff = get_usage_diff(start, end)
+    >>> diff["wall_time"], diff["user_time"], diff["children_user_time"], diff["peak_rss_mb"]
+    (3.5, 1.5, 4, 3.0)
+    >>> diff["read_bytes"], diff["write_bytes"]
+    (100, None)
+    """
+    diff = {"start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start["time"]))}
+    for key in (
+        "time",
+        "user_time",
+        "sys_time",
+        "children_user_time",
+        "children_sys_time",
+    ):
+        diff["wall_time" if key == "time" else key] = round(end[key] - start[key], 3)
+    diff["peak_rss_mb"] = round(end["maxrss"] / MB, 1)
+    diff["children_peak_rss_mb"] = round(end["children_maxrss"] / MB, 1)
+    for key in ("read_bytes", "write_bytes"):
+        if start[key] is None or end[key] is None:
+            diff[key] = None
+        else:
+            diff[key] = end[key] - start[key]
+    return diff
+
+
+def add_function_record(name, start):
+    _function_records.append({"name": name, **get_usage_diff(start, get_usage())})
+
+
+def get_function_records(start_index=0):
+    """
+    Returns:
+        records of add_log decorated functions finished after start_index, in the order they finish.
+    """
+    return _function_records[start_index:]
+
+
+def get_function_index():
+    return len(_function_records)
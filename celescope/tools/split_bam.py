@@ -0,0 +1,290 @@
+"""
+Split a bam into one bam per barcode group(tag, cluster, cell...).
+"""
+
+import math
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+
+import pysam
+
+from celescope.tools import utils
+
+
+# number of region shards per thread. More shards than threads keep all workers busy.
+SHARD_PER_THREAD = 4
+# window size of regions
+REGION_WINDOW = 1_000_000
+# region of reads without coordinate
+UNMAPPED_REGION = ("*", 0, 0)
+# total compression threads of all output bam files in one-pass mode
+MAX_BAM_WRITER_THREADS = 64
+# at most this many group bams are open at the same time in all processes.
+# Groups are written in batches and the input is read once per batch.
+MAX_OPEN_FILES = 256
+
+
+def split_regions(regions, n_shard):
+    """
+    Split regions into about n_shard shards of consecutive regions with similar read numbers.
+    A region with more reads than a shard is cut into equal length pieces.
+    Returns:
+        list of shards. Each shard is a list of (contig, start, end)
+
+    >>> regions = [("chr1", 0, 1000, 600), ("chr2", 0, 100, 100), ("chr3", 0, 100, 0), ("chr4", 0, 100, 200)]
+    >>> for shard in split_regions(regions, 3): print(shard)
+    [('chr1', 0, 500)]
+    [('chr1', 500, 1000)]
+    [('chr2', 0, 100), ('chr3', 0, 100), ('chr4', 0, 100)]
+    """
+    total = sum(region[3] for region in regions)
+    if n_shard <= 1 or total == 0:
+        return [[region[:3] for region in regions]]
+
+    target = total / n_shard
+    shards = []
+    current = []
+    current_read = 0
+    for contig, start, end, n_read in regions:
+        n_piece = max(1, min(math.ceil(n_read / target), end - start))
+        step = math.ceil((end - start) / n_piece)
+        for piece_start in range(start, end, step):
+            current.append((contig, piece_start, min(piece_start + step, end)))
+            current_read += n_read / n_piece
+            if current_read >= target:
+                shards.append(current)
+                current = []
+                current_read = 0
+    if current:
+        shards.append(current)
+    return shards
+
+
+def get_index_regions(bam_file):
+    """
+    Cut contigs with mapped reads into REGION_WINDOW windows.
+    Read numbers of windows are estimated from the index statistics without reading the bam.
+    Returns:
+        list of (contig, start, end, n_read)
+    """
+    regions = []
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        lengths = dict(zip(bam.references, bam.lengths))
+        for stat in bam.get_index_statistics():
+            n_read = stat.mapped + stat.unmapped
+            if n_read == 0:
+                continue
+            length = lengths[stat.contig]
+            for start in range(0, length, REGION_WINDOW):
+                end = min(start + REGION_WINDOW, length)
+                regions.append(
+                    (stat.contig, start, end, n_read * (end - start) / length)
+                )
+    return regions
+
+
+def is_sorted_and_indexed(bam_file):
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        sort_order = bam.header.to_dict().get("HD", {}).get("SO")
+        return sort_order == "coordinate" and bam.has_index()
+
+
+def get_barcode(seg, barcode_tag):
+    """
+    Returns:
+        barcode in barcode_tag. If barcode_tag is None, barcode is the first field of the read name.
+        None if the read has no barcode_tag.
+    """
+    if barcode_tag is None:
+        return seg.query_name.split(":")[0]
+    if seg.has_tag(barcode_tag):
+        return seg.get_tag(barcode_tag)
+    return None
+
+
+def split_shard(
+    bam_file,
+    regions,
+    barcode_group,
+    group_bams,
+    barcode_tag="CB",
+    read_filter=None,
+    threads=1,
+    max_open=MAX_OPEN_FILES,
+):
+    """
+    Write reads of barcode groups to group bams. Group bams without reads are not created.
+    At most max_open group bams are open at the same time. If there are more groups,
+    they are written in batches of max_open groups and the regions are read once per batch.
+
+    Args:
+        regions: list of (contig, start, end). Only reads starting in the regions are written,
+            so a read is written once even if it overlaps several regions. None means the whole bam in file order.
+        barcode_group: {barcode: group code}. group code is the index of group_bams.
+        read_filter: reads with read_filter(read) False are skipped. Must be picklable.
+        threads: BGZF threads of the input bam and each group bam.
+    Returns:
+        sorted group codes with reads
+    """
+    groups_with_reads = set()
+    for batch_start in range(0, len(group_bams), max_open):
+        batch_end = batch_start + max_open
+        batch_group = {
+            barcode: group
+            for barcode, group in barcode_group.items()
+            if batch_start <= group < batch_end
+        }
+        if not batch_group:
+            continue
+        handles = {}
+        with pysam.AlignmentFile(bam_file, "rb", threads=threads) as bam:
+            if regions is None:
+                reads_list = [(bam, None)]
+            else:
+                reads_list = [
+                    (bam.fetch(contig), None)
+                    if contig == UNMAPPED_REGION[0]
+                    else (bam.fetch(contig, start, end), start)
+                    for contig, start, end in regions
+                ]
+            for reads, start in reads_list:
+                for seg in reads:
+                    if start is not None and seg.reference_start < start:
+                        continue
+                    if read_filter is not None and not read_filter(seg):
+                        continue
+                    group = batch_group.get(get_barcode(seg, barcode_tag))
+                    if group is None:
+                        continue
+                    handle = handles.get(group)
+                    if handle is None:
+                        handle = pysam.AlignmentFile(
+                            group_bams[group], "wb", header=bam.header, threads=threads
+                        )
+                        handles[group] = handle
+                    handle.write(seg)
+
+        for handle in handles.values():
+            handle.close()
+        groups_with_reads.update(handles)
+    return sorted(groups_with_reads)
+
+
+def merge_shards(bam_file, shard_bams, out_bam, index):
+    """
+    Concatenate shard bams in order. An empty bam with the header of bam_file is written if there is no shard.
+    """
+    if not shard_bams:
+        with pysam.AlignmentFile(bam_file, "rb") as bam:
+            pysam.AlignmentFile(out_bam, "wb", header=bam.header).close()
+    elif len(shard_bams) == 1:
+        shutil.move(shard_bams[0], out_bam)
+    else:
+        pysam.cat("-o", out_bam, *shard_bams)
+    if index:
+        pysam.index(out_bam)
+
+
+@utils.add_log
+def split_bam_by_barcode(
+    bam_file,
+    barcode_group,
+    out_bams,
+    thread=1,
+    barcode_tag="CB",
+    read_filter=None,
+    tmp_dir=None,
+):
+    """
+    Split bam_file into one bam per barcode group. Every bam in out_bams is created even if it has no read.
+
+    If bam_file is coordinate-sorted and indexed and thread > 1, contig windows are split into shards with
+    similar read numbers. Each shard is split by a worker process, then shard bams of each group are
+    concatenated in order. Output bams are coordinate-sorted and indexed.
+    Otherwise bam_file is read in one pass with multi-threaded BGZF.
+    With more than MAX_OPEN_FILES groups, the bam or each shard is read once per batch of groups.
+
+    Args:
+        barcode_group: {barcode: group code}. group code is the index of out_bams.
+        barcode_tag: bam tag of barcode. If None, barcode is the first field of the read name.
+        read_filter: reads with read_filter(read) False are skipped. Must be picklable.
+        tmp_dir: directory for shard bams. Default is a temporary directory next to the first output bam.
+    """
+    if not out_bams:
+        return
+
+    sorted_and_indexed = is_sorted_and_indexed(bam_file)
+    regions = get_index_regions(bam_file) if sorted_and_indexed else []
+    if thread <= 1 or not regions:
+        n_open = min(len(out_bams), MAX_OPEN_FILES)
+        writer_threads = max(1, min(thread, MAX_BAM_WRITER_THREADS // n_open))
+        groups = set(
+            split_shard(
+                bam_file,
+                None,
+                barcode_group,
+                out_bams,
+                barcode_tag=barcode_tag,
+                read_filter=read_filter,
+                threads=writer_threads,
+                max_open=MAX_OPEN_FILES,
+            )
+        )
+        for group, out_bam in enumerate(out_bams):
+            if group not in groups:
+                merge_shards(bam_file, [], out_bam, sorted_and_indexed)
+            elif sorted_and_indexed:
+                pysam.index(out_bam)
+        return
+
+    shards = split_regions(regions, thread * SHARD_PER_THREAD)
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        if bam.nocoordinate > 0:
+            shards.append([UNMAPPED_REGION])
+    split_bam_by_barcode.logger.info(
+        f"{len(regions)} regions are split into {len(shards)} shards"
+    )
+
+    work_dir = tempfile.mkdtemp(
+        prefix="split_bam_",
+        dir=tmp_dir or os.path.dirname(os.path.abspath(out_bams[0])),
+    )
+    try:
+        n_worker = min(thread, len(shards))
+        max_open = max(1, MAX_OPEN_FILES // n_worker)
+        args_list = []
+        for i, shard in enumerate(shards):
+            group_bams = [
+                f"{work_dir}/shard{i}_group{group}.bam"
+                for group in range(len(out_bams))
+            ]
+            args_list.append(
+                (
+                    bam_file,
+                    shard,
+                    barcode_group,
+                    group_bams,
+                    barcode_tag,
+                    read_filter,
+                    1,
+                    max_open,
+                )
+            )
+        with Pool(n_worker) as pool:
+            shard_groups = [
+                set(groups) for groups in pool.starmap(split_shard, args_list)
+            ]
+
+            merge_args = []
+            for group, out_bam in enumerate(out_bams):
+                shard_bams = [
+                    args_list[i][3][group]
+                    for i, groups in enumerate(shard_groups)
+                    if group in groups
+                ]
+                merge_args.append((bam_file, shard_bams, out_bam, True))
+            pool.starmap(merge_shards, merge_args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
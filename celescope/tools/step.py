@@ -1,14 +1,15 @@
 import abc
 import sys
-import io
 import json
 import numbers
 import os
 import subprocess
 
+import pandas as pd
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
-from celescope.tools import utils
+from celescope.tools import profiler, utils
+from celescope.tools.html_fragment import FRAGMENT_DIR, Fragment_renderer
 from celescope.__init__ import HELP_DICT, __version__
 
 
@@ -42,6 +43,8 @@ def s_common(parser):
     parser.add_argument("--sample", help="Sample name.", required=True)
     parser.add_argument("--thread", help=HELP_DICT["thread"], default=4)
     parser.add_argument("--debug", help=HELP_DICT["debug"], action="store_true")
+    parser.add_argument("--profile", help=HELP_DICT["profile"], action="store_true")
+    parser.add_argument("--resume", help=HELP_DICT["resume"], action="store_true")
     return parser
 
 
@@ -65,12 +68,17 @@ class Step:
         self.thread = int(args.thread)
         self.thread = min(self.thread, 20)
         self.debug = args.debug
+        self.profile = args.profile
         self.out_prefix = f"{self.outdir}/{self.sample}"
         self.display_title = display_title
 
         # metrics index
         self.metric_index = 0
 
+        # resource usage
+        self._start_usage = profiler.get_usage()
+        self._function_index = profiler.get_function_index()
+
         # important! make outdir before path_dict because path_dict use relative path.
         utils.check_mkdir(self.outdir)
         utils.check_mkdir(self.outs_dir)
@@ -82,7 +90,7 @@ class Step:
         else:
             self._display_title = display_title
         self._step_name = class_name[0].lower() + class_name[1:]
-        self.__slots = ["data", "metrics"]
+        self.__slots = ["data", "metrics", "profile"]
         self._step_summary_name = f"{self._step_name}_summary"
 
         self.__metric_list = []
@@ -94,18 +102,11 @@ class Step:
 
         self.__content_dict = {}
         self.old_step_dict = {}
+        # keys written by this step. Other keys are reloaded from the json file before dump.
+        self.__slot_keys = {}
         for slot, path in self._path_dict.items():
-            if not os.path.exists(path):
-                self.__content_dict[slot] = {}
-            else:
-                with open(path) as f:
-                    try:
-                        self.__content_dict[slot] = json.load(f)
-                    except ValueError:
-                        print(
-                            f'WARNING: Decoding "{path}" as json has failed. Will create empty json file.'
-                        )
-                        self.__content_dict[slot] = {}
+            self.__content_dict[slot] = self._load_slot(path)
+            self.__slot_keys[slot] = {self._step_summary_name}
             # clear step_summary
             if self._step_summary_name in self.__content_dict[slot]:
                 self.old_step_dict[slot] = self.__content_dict[slot][
@@ -122,6 +123,9 @@ class Step:
         # out file
         self.__stat_file = f"{self.outdir}/stat.txt"
         self.report_html = f"{self.outdir}/../{self.sample}_report.html"
+        self.fragment_dir = f"{self.outdir}/../{FRAGMENT_DIR}"
+        # utils.file_lock appends `.lock`, so the lock file `.report.lock` is hidden
+        self.report_lock = f"{self.outdir}/../.report"
 
         # move file to outs
         self.outs = []
@@ -191,19 +195,52 @@ class Step:
                     line = f"{name}: {display}"
                     writer.write(line + "\n")
 
+    @staticmethod
+    def _load_slot(path):
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                print(
+                    f'WARNING: Decoding "{path}" as json has failed. Will create empty json file.'
+                )
+                return {}
+
     def _dump_content(self):
-        """dump content to json file"""
+        """
+        dump content to json file.
+        Steps of the same sample may run at the same time, so only the keys written by this step are updated:
+        the json file is locked, reloaded, updated and replaced by a temporary file.
+        `.data.json` contains large plots and is written without indent.
+        """
         for slot, path in self._path_dict.items():
-            if self.__content_dict[slot]:
-                with open(path, "w") as f:
-                    json.dump(self.__content_dict[slot], f, indent=4)
+            if not self.__content_dict[slot]:
+                continue
+            with utils.file_lock(path):
+                content = self._load_slot(path)
+                for key in self.__slot_keys[slot]:
+                    content[key] = self.__content_dict[slot][key]
+                fd, tmp_path = utils.mkstemp_for(path)
+                with os.fdopen(fd, "w") as f:
+                    if slot == "data":
+                        json.dump(content, f, separators=(",", ":"))
+                    else:
+                        json.dump(content, f, indent=4)
+                os.replace(tmp_path, path)
+            self.__content_dict[slot] = content
 
     @utils.add_log
     def _render_html(self):
-        template = self.env.get_template(f"html/{self.assay}/base.html")
-        with io.open(self.report_html, "w", encoding="utf8") as f:
-            html = template.render(self.__content_dict["data"])
-            f.write(html)
+        """
+        Only the report sections changed by this step are rendered. Other sections are read from the fragment cache.
+        """
+        renderer = Fragment_renderer(
+            self.env, f"html/{self.assay}/base.html", self.fragment_dir
+        )
+        with utils.file_lock(self.report_lock):
+            renderer.write(self.__content_dict["data"], self.report_html)
 
     def _add_content_data(self):
         step_summary = {}
@@ -233,6 +270,35 @@ class Step:
 
         self.__content_dict["metrics"][self._step_summary_name].update(metric_dict)
 
+    def _add_content_profile(self):
+        """
+        Resource usage of the step(before clean up) and its add_log decorated functions.
+        If `--profile` is used, the resource usage of all steps run so far is shown in the HTML report.
+        """
+        step_profile = profiler.get_usage_diff(self._start_usage, profiler.get_usage())
+        step_profile["functions"] = profiler.get_function_records(self._function_index)
+        self.__content_dict["profile"][self._step_summary_name] = step_profile
+
+        if self.profile:
+            rows = []
+            for step_summary_name, profile in self.__content_dict["profile"].items():
+                if not profile:
+                    continue
+                row = {"step": step_summary_name[: -len("_summary")]}
+                row.update(
+                    (key, value) for key, value in profile.items() if key != "functions"
+                )
+                rows.append(row)
+            self.__slot_keys["data"].add("profile_summary")
+            self.__content_dict["data"]["profile_summary"] = {
+                "display_title": "Resource Usage",
+                "table_dict": self.get_table_dict(
+                    title="Wall time and CPU time are in seconds.",
+                    table_id="profile",
+                    df_table=pd.DataFrame(rows),
+                ),
+            }
+
     def add_data(self, **kwargs):
         """
         add data(other than metrics) to self.content_dict['data']
@@ -268,6 +334,7 @@ class Step:
     def add_slot_step(self, slot, step_name, val):
         """add slot to json"""
         self.__content_dict[slot][step_name + "_summary"] = val
+        self.__slot_keys[slot].add(step_name + "_summary")
 
     @utils.add_log
     def get_slot_step(self, slot, step_name):
@@ -333,4 +400,5 @@ class Step:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type is None:
+            self._add_content_profile()
             self._clean_up()
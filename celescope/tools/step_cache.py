@@ -0,0 +1,206 @@
+"""
+Skip steps whose inputs, arguments and celescope version are unchanged since their last successful run.
+
+Each sample directory has a manifest of successful step runs, in run order.
+When a step runs, its entry and the entries of all steps recorded after it(downstream steps) are removed,
+so downstream steps are run again after an upstream step changes.
+"""
+
+import hashlib
+import json
+import os
+
+from celescope.__init__ import __VERSION__
+from celescope.tools import utils
+
+# manifest of successful step runs in the sample directory
+MANIFEST_FILE = ".step_manifest.json"
+# arguments that do not change step outputs
+IGNORED_ARGS = {"func", "thread", "debug", "profile", "resume"}
+# (assay, step) whose outputs depend on --thread. flv_trust4 assemble splits candidate reads into --thread chunks.
+THREAD_DEPENDENT_STEPS = {("flv_trust4", "assemble")}
+
+
+def get_path_signature(path):
+    """
+    Returns:
+        [size, mtime_ns] of a file. {relative path: [size, mtime_ns]} of all files in a directory.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    signature = {}
+    for root, _dirs, files in os.walk(path):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            if os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                signature[os.path.relpath(file_path, path)] = [
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ]
+    return signature
+
+
+def is_ancestor(path, other):
+    """
+    Returns:
+        True if path is other or a parent directory of other.
+
+    >>> is_ancestor("/a/b", "/a/b/c"), is_ancestor("/a/b", "/a/b"), is_ancestor("/a/b", "/a/bc")
+    (True, True, False)
+    """
+    path = os.path.abspath(path)
+    other = os.path.abspath(other)
+    return os.path.commonpath([path, other]) == path
+
+
+def get_step_key(args):
+    """
+    Returns:
+        hash of celescope version, step arguments and signatures of input files and directories in arguments.
+        Comma separated arguments are checked for paths one by one.
+        Paths containing the step outdir(outdir, sample directory...) or in the step outdir are not inputs.
+        `--thread` is only in the key of THREAD_DEPENDENT_STEPS.
+    """
+    ignored_args = IGNORED_ARGS
+    if (args.subparser_assay, args.func.__name__) in THREAD_DEPENDENT_STEPS:
+        ignored_args = IGNORED_ARGS - {"thread"}
+    step_args = {}
+    inputs = {}
+    for arg, value in sorted(vars(args).items()):
+        if arg in ignored_args:
+            continue
+        step_args[arg] = value
+        if not isinstance(value, str):
+            continue
+        for path in value.split(","):
+            if (
+                path
+                and os.path.exists(path)
+                and not is_ancestor(path, args.outdir)
+                and not is_ancestor(args.outdir, path)
+            ):
+                inputs[path] = get_path_signature(path)
+    content = {
+        "version": __VERSION__,
+        "assay": args.subparser_assay,
+        "args": step_args,
+        "inputs": inputs,
+    }
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def get_outputs(outdir, outs_dir, outs_before):
+    """
+    Returns:
+        {path: signature} of outdir and files in outs_dir that are created or changed by the step.
+    """
+    outputs = {outdir: get_path_signature(outdir)}
+    outs_after = get_path_signature(outs_dir) if os.path.isdir(outs_dir) else {}
+    for file_name, signature in outs_after.items():
+        if outs_before.get(file_name) != signature:
+            outputs[os.path.join(outs_dir, file_name)] = signature
+    return outputs
+
+
+def outputs_exist(outputs):
+    """
+    Returns:
+        True if all outputs exist and are unchanged.
+    """
+    for path, signature in outputs.items():
+        if not os.path.exists(path):
+            return False
+        current = get_path_signature(path)
+        if isinstance(signature, dict):
+            if any(current.get(name) != value for name, value in signature.items()):
+                return False
+        elif current != signature:
+            return False
+    return True
+
+
+def load_manifest(manifest_file):
+    """
+    Returns:
+        {step: {"key": step key, "outputs": {path: signature}}} in run order
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+
+def save_manifest(manifest_file, manifest):
+    """
+    Write to a temporary file of this process and replace manifest_file.
+    Must be called with `utils.file_lock(manifest_file)` held.
+    """
+    fd, tmp_file = utils.mkstemp_for(manifest_file)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_file, manifest_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def remove_downstream(manifest, step):
+    """
+    Remove step and all steps recorded after it.
+
+    >>> remove_downstream({"sample": 1, "barcode": 2, "cutadapt": 3}, "barcode")
+    {'sample': 1}
+    >>> remove_downstream({"sample": 1}, "barcode")
+    {'sample': 1}
+    """
+    steps = list(manifest)
+    if step not in steps:
+        return manifest
+    return {name: manifest[name] for name in steps[: steps.index(step)]}
+
+
+@utils.add_log
+def run_step(args):
+    """
+    Run args.func(args) and record it in the manifest.
+    With `--resume`, the step is skipped if its key is the same as the manifest and its outputs exist.
+    Steps of the same sample may run at the same time, so the manifest is read and written under a file lock.
+    Commands without `--outdir` and `--sample`(mkref...) are always run and not recorded.
+    """
+    if not hasattr(args, "resume") or not hasattr(args, "outdir"):
+        args.func(args)
+        return
+
+    step = args.func.__name__
+    sample_dir = os.path.dirname(os.path.abspath(args.outdir))
+    manifest_file = f"{sample_dir}/{MANIFEST_FILE}"
+    outs_dir = f"{sample_dir}/outs"
+    key = get_step_key(args)
+    utils.check_mkdir(sample_dir)
+
+    with utils.file_lock(manifest_file):
+        manifest = load_manifest(manifest_file)
+        if args.resume and step in manifest:
+            entry = manifest[step]
+            if entry["key"] == key and outputs_exist(entry["outputs"]):
+                run_step.logger.info(f"{step} is unchanged since last run. Skipped.")
+                return
+        save_manifest(manifest_file, remove_downstream(manifest, step))
+
+    outs_before = get_path_signature(outs_dir) if os.path.isdir(outs_dir) else {}
+    args.func(args)
+    outputs = get_outputs(os.path.abspath(args.outdir), outs_dir, outs_before)
+
+    with utils.file_lock(manifest_file):
+        manifest = remove_downstream(load_manifest(manifest_file), step)
+        manifest[step] = {"key": key, "outputs": outputs}
+        save_manifest(manifest_file, manifest)
@@ -1,5 +1,9 @@
+import math
+import os
+from collections import Counter
+from multiprocessing import Pool
+
 import pandas as pd
-import pysam
 
 from celescope.tools import utils
 from celescope.tools.barcode import Barcode
@@ -7,6 +11,8 @@ from celescope.tools.step import Step, s_common
 
 # n_mismatch = 1 if n_tag_barcode > N_TAG_BARCODE_THRESHOLD else 2
 N_TAG_BARCODE_THRESHOLD = 10000
+# linker neighbors with more mismatches than this are checked with hamming distance
+LINKER_INDEX_MISMATCH = 2
 
 
 def get_opts_mapping_tag(parser, sub_program):
@@ -74,6 +80,140 @@ with all linker sequence in linker_fasta. If no mismatch < len(linker) / 10 + 1,
         parser.add_argument("--fq", help="R2 read fastq.", required=True)
 
 
+def get_linker_index(linker_seqs):
+    """
+    Precompute linker sequences accepted by `utils.hamming_correct`.
+
+    Returns:
+        linker_index: set of sequences within LINKER_INDEX_MISMATCH mismatches of any linker
+        max_mismatch: the largest mismatch accepted by `utils.hamming_correct`
+
+    >>> linker_index, max_mismatch = get_linker_index(["AAAAA"])
+    >>> max_mismatch, "AAAAC" in linker_index, "AAACC" in linker_index
+    (1, True, False)
+    """
+    linker_length = len(linker_seqs[0])
+    max_mismatch = math.ceil(linker_length / 10 + 1) - 1
+    linker_index = set()
+    for seq in linker_seqs:
+        linker_index.update(
+            Barcode.findall_mismatch(
+                seq, n_mismatch=min(max_mismatch, LINKER_INDEX_MISMATCH)
+            )
+        )
+    return linker_index, max_mismatch
+
+
+def get_chunk_offsets(fq, n_chunk):
+    """
+    Split an uncompressed fastq file into n_chunk byte ranges. Each range starts at a record header.
+
+    Returns:
+        list of (start, end)
+    """
+    file_size = os.path.getsize(fq)
+    offsets = [0]
+    with open(fq, "rb") as f:
+        for i in range(1, n_chunk):
+            pos = max(file_size * i // n_chunk, offsets[-1])
+            f.seek(pos)
+            if pos > 0:
+                # skip the partial line
+                f.readline()
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                # a quality line can also start with "@", but the line after next is "+" only for a header
+                if line.startswith(b"@"):
+                    f.readline()
+                    plus = f.readline()
+                    if plus.startswith(b"+"):
+                        break
+                    f.seek(pos)
+                    f.readline()
+            offsets.append(pos)
+    offsets.append(file_size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+
+def iter_fastq(fq, start=0, end=None):
+    """
+    Yields:
+        (name, sequence) of records in the byte range [start, end). end=None means the end of the file.
+    """
+    f = utils.generic_open(fq, "rb")
+    if not fq.endswith(".gz"):
+        f.seek(start)
+    with f:
+        pos = start
+        while end is None or pos < end:
+            header = f.readline()
+            if not header:
+                break
+            pos += len(header)
+            if not header.strip():
+                continue
+            seq = f.readline()
+            plus = f.readline()
+            qual = f.readline()
+            pos += len(seq) + len(plus) + len(qual)
+            yield header[1:].split(None, 1)[0].decode(), seq.rstrip().decode()
+
+
+def map_chunk(fq, start, end, pattern_dict, linker_info, tag_code_dict):
+    """
+    Map R2 reads in the byte range [start, end) of fq.
+
+    Args:
+        linker_info: None if there is no linker. Otherwise (linker_seqs, linker_index, max_mismatch).
+        tag_code_dict: {tag barcode sequence with mismatches: tag code}
+
+    Returns:
+        counts: {(barcode, tag_code, umi): read_count}
+        invalid_barcode_counts: {seq_barcode: read_count}
+        total_reads
+        reads_unmapped_invalid_linker
+    """
+    counts = Counter()
+    invalid_barcode_counts = Counter()
+    total_reads = 0
+    reads_unmapped_invalid_linker = 0
+    linker_sub_pattern = pattern_dict.get("L")
+    barcode_sub_pattern = pattern_dict["C"]
+    if linker_info:
+        linker_seqs, linker_index, max_mismatch = linker_info
+        check_all_linkers = max_mismatch > LINKER_INDEX_MISMATCH
+
+    for name, seq in iter_fastq(fq, start, end):
+        total_reads += 1
+        attr = name.strip("@").split(":")
+        barcode = attr[0]
+        umi = attr[1]
+
+        if linker_info:
+            seq_linker = Barcode.get_seq_str_no_exception(seq, linker_sub_pattern)
+            if seq_linker not in linker_index and not (
+                check_all_linkers
+                and len(seq_linker) == len(linker_seqs[0])
+                and any(
+                    utils.hamming_correct(linker, seq_linker) for linker in linker_seqs
+                )
+            ):
+                reads_unmapped_invalid_linker += 1
+                continue
+
+        seq_barcode = Barcode.get_seq_str_no_exception(seq, barcode_sub_pattern)
+        tag_code = tag_code_dict.get(seq_barcode)
+        if tag_code is None:
+            invalid_barcode_counts[seq_barcode] += 1
+        else:
+            counts[(barcode, tag_code, umi)] += 1
+
+    return counts, invalid_barcode_counts, total_reads, reads_unmapped_invalid_linker
+
+
 @utils.add_log
 def mapping_tag(args):
     with Mapping_tag(args, display_title="Mapping") as runner:
@@ -84,6 +224,8 @@ class Mapping_tag(Step):
     """
     ## Features
     - Align R2 reads to the tag barcode fasta.
+    - Linker and tag barcode sequences with mismatches are precomputed, so each read only needs dict lookups.
+    - Uncompressed R2 fastq is split into record-aligned chunks and mapped with `--thread` processes.
 
     ## Output
 
@@ -131,18 +273,22 @@ class Mapping_tag(Step):
             self.linker_dict, self.linker_length = {}, 0
 
         # mismatch
-        self.mismatch_dict = self.get_tag_barcode_mismatch_dict()
+        self.tag_names = list(self.barcode_dict)
+        self.tag_code_dict = self.get_tag_barcode_mismatch_dict()
+        if self.linker_dict:
+            linker_seqs = list(self.linker_dict.values())
+            linker_index, max_mismatch = get_linker_index(linker_seqs)
+            self.linker_info = (linker_seqs, linker_index, max_mismatch)
+        else:
+            self.linker_info = None
 
         # variables
         self.total_reads = 0
-        self.reads_unmapped_too_short = 0
         self.reads_unmapped_invalid_linker = 0
         self.reads_unmapped_invalid_barcode = 0
         self.reads_mapped = 0
         self.res_dic = utils.genDict()
-        self.res_sum_dic = utils.genDict(dim=2)
-        self.match_barcode = []
-        self.invalid_barcode_dict = utils.genDict(dim=1)
+        self.invalid_barcode_dict = Counter()
 
         # out files
         self.read_count_file = f"{self.outdir}/{self.sample}_read_count.tsv"
@@ -150,66 +296,53 @@ class Mapping_tag(Step):
 
     @utils.add_log
     def get_tag_barcode_mismatch_dict(self):
+        """
+        Returns:
+            {tag barcode sequence with mismatches: index of tag name in self.tag_names}
+        """
         mismatch_dict = {}
         n_mismatch = 1 if len(self.barcode_dict) > N_TAG_BARCODE_THRESHOLD else 2
-        for seq_id, seq in self.barcode_dict.items():
+        for tag_code, seq in enumerate(self.barcode_dict.values()):
             for mismatch_seq in Barcode.findall_mismatch(seq, n_mismatch=n_mismatch):
-                mismatch_dict[mismatch_seq] = seq_id
+                mismatch_dict[mismatch_seq] = tag_code
 
         return mismatch_dict
 
-    def check_barcode_with_mismatch(self, barcode, seq_barcode, umi):
+    @utils.add_log
+    def process_read(self):
         """
-        Args:
-            barcode: cell barcode
-            seq_barcode: tag barcode sequence
-            umi: UMI sequence
+        Uncompressed fastq is split into `thread` record-aligned chunks which are mapped in parallel.
+        Chunk results are merged in file order.
         """
-        if seq_barcode in self.mismatch_dict:
-            seq_id = self.mismatch_dict[seq_barcode]
-            self.res_dic[barcode][seq_id][umi] += 1
-            self.reads_mapped += 1
+        if self.thread > 1 and not self.fq.endswith(".gz"):
+            chunks = get_chunk_offsets(self.fq, self.thread)
         else:
-            self.reads_unmapped_invalid_barcode += 1
-            self.invalid_barcode_dict[seq_barcode] += 1
-
-    def process_read(self):
-        with pysam.FastxFile(self.fq) as infile:
-            for record in infile:
-                self.total_reads += 1
-                attr = str(record.name).strip("@").split(":")
-                barcode = str(attr[0])
-                umi = str(attr[1])
-                seq = record.sequence
-
-                if self.linker_length != 0:
-                    seq_linker = Barcode.get_seq_str_no_exception(
-                        seq, self.pattern_dict["L"]
-                    )
-
-                if self.barcode_dict:
-                    seq_barcode = Barcode.get_seq_str_no_exception(
-                        seq, self.pattern_dict["C"]
-                    )
-
-                # check linker
-                if self.linker_length != 0:
-                    valid_linker = False
-                    for linker_name in self.linker_dict:
-                        if utils.hamming_correct(
-                            self.linker_dict[linker_name], seq_linker
-                        ):
-                            valid_linker = True
-                            break
-                else:
-                    valid_linker = True
-
-                if not valid_linker:
-                    self.reads_unmapped_invalid_linker += 1
-                    continue
-
-                # check barcode
-                self.check_barcode_with_mismatch(barcode, seq_barcode, umi)
+            chunks = [(0, None)]
+        args_list = [
+            (
+                self.fq,
+                start,
+                end,
+                self.pattern_dict,
+                self.linker_info,
+                self.tag_code_dict,
+            )
+            for start, end in chunks
+        ]
+        if len(chunks) > 1:
+            with Pool(len(chunks)) as pool:
+                results = pool.starmap(map_chunk, args_list)
+        else:
+            results = [map_chunk(*args_list[0])]
+
+        for counts, invalid_barcode_counts, total_reads, n_invalid_linker in results:
+            for (barcode, tag_code, umi), read_count in counts.items():
+                self.res_dic[barcode][self.tag_names[tag_code]][umi] += read_count
+                self.reads_mapped += read_count
+            self.invalid_barcode_dict.update(invalid_barcode_counts)
+            self.reads_unmapped_invalid_barcode += sum(invalid_barcode_counts.values())
+            self.total_reads += total_reads
+            self.reads_unmapped_invalid_linker += n_invalid_linker
 
     def write_files(self):
         # write dic to pandas df
@@ -1,9 +1,10 @@
-import numpy as np
-import pysam
+import os
 import sys
-import subprocess
 from collections import defaultdict
 
+import numpy as np
+import pysam
+
 from celescope.tools import utils
 from celescope.tools.step import Step, s_common
 from celescope.__init__ import HELP_DICT
@@ -20,6 +21,24 @@ def get_gene_list(args):
     return set(gene_list), n_gene
 
 
+# UMI bases to base-5 digits
+UMI_TRANS = str.maketrans("ACGTN", "01234")
+
+
+def encode_umi(umi):
+    """
+    Encode UMI to int. The leading 1 keeps UMIs of different lengths apart.
+    UMIs with other characters are kept as str.
+
+    >>> encode_umi("ACGT"), encode_umi("AACGT"), encode_umi("ACG-")
+    (663, 3163, 'ACG-')
+    """
+    try:
+        return int("1" + umi.translate(UMI_TRANS), 5)
+    except ValueError:
+        return umi
+
+
 class Target_metrics(Step):
     """
     ## Features
@@ -29,8 +48,11 @@ class Target_metrics(Step):
 
     - Collect enrichment metrics.
 
+    - Duplicate reads are counted while streaming the bam. For coordinate-sorted input, counts are flushed at each new position;
+    for barcode-grouped input(`--barcode_grouped`), counts are flushed at each new barcode.
+
     ## Output
-    - `filtered.bam` BAM file after filtering. Reads that are not cell-associated or not mapped to target genes are filtered.
+    - `{sample}_filtered_sorted.bam` BAM file after filtering. Reads that are not cell-associated or not mapped to target genes are filtered.
     """
 
     def __init__(self, args, display_title=None):
@@ -41,15 +63,23 @@ class Target_metrics(Step):
             args.match_dir
         )
         self.match_barcode = set(self.match_barcode_list)
+        self.barcode_index = {
+            barcode: i for i, barcode in enumerate(self.match_barcode_list)
+        }
 
         self.gene_list, self.n_gene = get_gene_list(args)
 
         if not self.gene_list:
             sys.exit("You must provide either --panel or --gene_list!")
 
-        self.count_dict = utils.genDict(dim=3, valType=int)
-        self.dup_dict = utils.genDict(dim=4, valType=int)
-        self.used_dict = defaultdict(int)
+        # read counts
+        self.total_reads = 0
+        self.enriched_reads = 0
+        self.enriched_reads_in_cells = 0
+        # index: barcode index
+        self.cell_enriched_reads = np.zeros(self.n_cell, dtype=np.int64)
+        self.cell_used_reads = np.zeros(self.n_cell, dtype=np.int64)
+        self.cell_seen = np.zeros(self.n_cell, dtype=bool)
 
         self.add_metric(
             name="Number of Target Genes",
@@ -63,16 +93,17 @@ class Target_metrics(Step):
         # out file
         self.out_bam_file = f"{self.out_prefix}_filtered.bam"
         self.out_bam_file_sorted = f"{self.out_prefix}_filtered_sorted.bam"
+        self.coordinate_sorted = False
 
     @utils.add_log
     def read_bam_write_filtered(self):
         """
         for each (barcode,UMI,reference_name,reference_start), keep at most max_duplicate_reads
         """
-        sam_temp = f"{self.out_bam_file}.temp"
         max_duplicate = self.args.max_duplicate
         with pysam.AlignmentFile(self.args.bam, "rb") as reader:
             header = reader.header.to_dict()
+            self.coordinate_sorted = header.get("HD", {}).get("SO") == "coordinate"
             # add RG to header
             if self.args.add_RG:
                 header["RG"] = []
@@ -83,7 +114,19 @@ class Target_metrics(Step):
                             "SM": barcode,
                         }
                     )
-            with pysam.AlignmentFile(sam_temp, "w", header=header) as writer:
+            # filtering keeps the order of a coordinate-sorted bam
+            out_bam = (
+                self.out_bam_file_sorted
+                if self.coordinate_sorted
+                else self.out_bam_file
+            )
+
+            # {(barcode index, UMI code, reference id, start): read count} of the current flush unit
+            dup_dict = defaultdict(int)
+            flush_unit = None
+            with pysam.AlignmentFile(
+                out_bam, "wb", header=header, threads=self.thread
+            ) as writer:
                 for record in reader:
                     try:
                         gene_name = record.get_tag("GN")
@@ -95,50 +138,50 @@ class Target_metrics(Step):
                         UMI = record.get_tag("UB")
                     except KeyError:
                         continue
-                    self.count_dict[barcode][gene_name][UMI] += 1
-                    if barcode in self.match_barcode and gene_name in self.gene_list:
-                        rn, rs = record.reference_name, record.reference_start
-                        self.dup_dict[barcode][UMI][rn][rs] += 1
-                        if self.dup_dict[barcode][UMI][rn][rs] > max_duplicate:
-                            continue
-                        self.used_dict[barcode] += 1
-                        if self.args.add_RG:
-                            record.set_tag(
-                                tag="RG", value=record.get_tag("CB"), value_type="Z"
-                            )
-                        writer.write(record)
-
-            cmd = f"samtools view -b {sam_temp} -o {self.out_bam_file}; rm {sam_temp}"
-            subprocess.check_call(cmd, shell=True)
+                    self.total_reads += 1
+                    barcode_index = self.barcode_index.get(barcode)
+                    if barcode_index is not None:
+                        self.cell_seen[barcode_index] = True
+                    if gene_name not in self.gene_list:
+                        continue
+                    self.enriched_reads += 1
+                    if barcode_index is None:
+                        continue
+                    self.enriched_reads_in_cells += 1
+                    self.cell_enriched_reads[barcode_index] += 1
+
+                    tid, rs = record.reference_id, record.reference_start
+                    if self.coordinate_sorted:
+                        unit = (tid, rs)
+                    elif self.args.barcode_grouped:
+                        unit = barcode_index
+                    else:
+                        unit = None
+                    if unit != flush_unit:
+                        dup_dict.clear()
+                        flush_unit = unit
+
+                    key = (barcode_index, encode_umi(UMI), tid, rs)
+                    dup_dict[key] += 1
+                    if dup_dict[key] > max_duplicate:
+                        continue
+                    self.cell_used_reads[barcode_index] += 1
+                    if self.args.add_RG:
+                        record.set_tag(tag="RG", value=barcode, value_type="Z")
+                    writer.write(record)
 
     @utils.add_log
-    def parse_count_dict_add_metrics(self):
-        total_reads = 0
-        enriched_reads = 0
-        enriched_reads_in_cells = 0
-        enriched_reads_per_cell_list = []
-
-        for barcode in self.count_dict:
-            cell_enriched_read = 0
-            for gene_name in self.count_dict[barcode]:
-                gene_read = sum(self.count_dict[barcode][gene_name].values())
-                total_reads += gene_read
-                if gene_name in self.gene_list:
-                    enriched_reads += gene_read
-                    if barcode in self.match_barcode:
-                        enriched_reads_in_cells += gene_read
-                        cell_enriched_read += gene_read
-            if barcode in self.match_barcode:
-                enriched_reads_per_cell_list.append(cell_enriched_read)
-
-        self.parse_count_dict_add_metrics.logger.debug(
+    def add_enrichment_metrics(self):
+        enriched_reads_per_cell_list = self.cell_enriched_reads[self.cell_seen]
+
+        self.add_enrichment_metrics.logger.debug(
             f"enriched_reads_per_cell_list: "
             f"{sorted(enriched_reads_per_cell_list)}"
             f"len: {len(enriched_reads_per_cell_list)}"
         )
 
-        valid_enriched_reads_per_cell_list = [
-            cell for cell in enriched_reads_per_cell_list if cell > 0
+        valid_enriched_reads_per_cell_list = enriched_reads_per_cell_list[
+            enriched_reads_per_cell_list > 0
         ]
         n_valid_cell = len(valid_enriched_reads_per_cell_list)
         self.add_metric(
@@ -149,13 +192,13 @@ class Target_metrics(Step):
         )
         self.add_metric(
             name="Enriched Reads",
-            value=enriched_reads,
-            total=total_reads,
+            value=self.enriched_reads,
+            total=self.total_reads,
         )
         self.add_metric(
             name="Enriched Reads in Cells",
-            value=enriched_reads_in_cells,
-            total=total_reads,
+            value=self.enriched_reads_in_cells,
+            total=self.total_reads,
         )
         self.add_metric(
             name="Median Enriched Reads per Valid Cell",
@@ -164,19 +207,21 @@ class Target_metrics(Step):
 
         self.add_metric(
             name="Median Used Reads per Valid Cell",
-            value=np.median(list(self.used_dict.values())),
+            value=np.median(self.cell_used_reads[self.cell_used_reads > 0]),
         )
 
     def run(self):
         self.read_bam_write_filtered()
-        self.parse_count_dict_add_metrics()
+        self.add_enrichment_metrics()
         samtools_runner = utils.Samtools(
             self.out_bam_file,
             self.out_bam_file_sorted,
             self.args.thread,
             debug=self.debug,
         )
-        samtools_runner.sort_bam()
+        if not self.coordinate_sorted:
+            samtools_runner.sort_bam()
+            os.remove(self.out_bam_file)
         samtools_runner.index_bam()
 
 
@@ -198,4 +243,10 @@ def get_opts_target_metrics(parser, sub_program):
             help="Add tag read group: RG. RG is the same as CB(cell barcode)",
             action="store_true",
         )
+        parser.add_argument(
+            "--barcode_grouped",
+            help="Input bam is grouped by cell barcode(CB). Duplicate counts are flushed at each new barcode to save memory. "
+            "Not needed for coordinate-sorted bam.",
+            action="store_true",
+        )
         parser = s_common(parser)
@@ -4,6 +4,9 @@
 
 import sys
 import math
+import random
+import time
+import io
 
 
 def GetChainType(v, j, c):
@@ -80,7 +83,80 @@ def GetFather(tag, father):
     return father[tag]
 
 
-def LargerCluster(rawCdr3List, similarity, prefix, useRepresentative, mode):
+def GetSegments(length, diffMax):
+    # Pigeonhole: two sequences with at most diffMax mismatches share at least one of the diffMax + 1 segments.
+    k = diffMax + 1
+    return [(s * length // k, (s + 1) * length // k) for s in range(k)]
+
+
+def PairwiseUnion(cdr3IdList, cdr3List, similarity, father):
+    size = len(cdr3IdList)
+    for i in range(size):
+        fi = GetFather(cdr3IdList[i], father)
+        for j in range(i + 1, size):
+            fj = GetFather(cdr3IdList[j], father)
+            if fi != fj and CompatibleSequence(
+                cdr3List[cdr3IdList[i]][8],
+                cdr3List[cdr3IdList[j]][8],
+                similarity,
+            ):
+                father[fj] = fi
+
+
+def IndexedUnion(cdr3IdList, cdr3List, similarity, father):
+    # Same clusters as PairwiseUnion: the clusters are the connected components of compatible CDR3s,
+    # so only the candidate pairs sharing a pigeonhole segment need to be compared.
+    seqToIds = {}
+    for cdr3Id in cdr3IdList:
+        seq = cdr3List[cdr3Id][8]
+        if seq not in seqToIds:
+            seqToIds[seq] = []
+        seqToIds[seq].append(cdr3Id)
+    uniqSeqs = list(seqToIds.keys())
+
+    # Identical CDR3s are always compatible.
+    for seq in uniqSeqs:
+        ids = seqToIds[seq]
+        fi = GetFather(ids[0], father)
+        for cdr3Id in ids[1:]:
+            fj = GetFather(cdr3Id, father)
+            if fi != fj:
+                father[fj] = fi
+
+    length = len(uniqSeqs[0])
+    diffMax = length - int(math.ceil(length * similarity))
+    if diffMax < 0:
+        return
+
+    segments = GetSegments(length, diffMax)
+    segmentIndex = {}
+    for k in range(len(uniqSeqs)):
+        seq = uniqSeqs[k]
+        checked = set()
+        for s in range(len(segments)):
+            key = (s, seq[segments[s][0] : segments[s][1]])
+            if key not in segmentIndex:
+                segmentIndex[key] = []
+            for m in segmentIndex[key]:
+                if m in checked:
+                    continue
+                checked.add(m)
+                fi = GetFather(seqToIds[uniqSeqs[m]][0], father)
+                fj = GetFather(seqToIds[seq][0], father)
+                if fi != fj and CompatibleSequence(uniqSeqs[m], seq, similarity):
+                    father[fj] = fi
+            segmentIndex[key].append(k)
+
+
+def LargerCluster(
+    rawCdr3List,
+    similarity,
+    prefix,
+    useRepresentative,
+    mode,
+    indexed=True,
+    output=sys.stdout,
+):
     vjCDR3LenList = {}
     clusterNameToId = {}
     clusterIdToName = []
@@ -132,20 +208,10 @@ def LargerCluster(rawCdr3List, similarity, prefix, useRepresentative, mode):
     if mode == "aggressive":
         for key in vjCDR3LenList.keys():
             cdr3IdList = vjCDR3LenList[key]
-            size = len(cdr3IdList)
-            for i in range(size):
-                fi = GetFather(cdr3IdList[i], father)
-                for j in range(i + 1, size):
-                    fj = GetFather(cdr3IdList[j], father)
-                    if fi != fj and CompatibleSequence(
-                        cdr3List[cdr3IdList[i]][8],
-                        cdr3List[cdr3IdList[j]][8],
-                        similarity,
-                    ):
-                        # if (cdr3List[cdr3IdList[j]][8] == "TGCCAACAGTATATTAGTTACTCGTACACTTTT"):
-                        # print(i, cdr3List[cdr3IdList[i]])
-                        # print(j, cdr3List[cdr3IdList[j]])
-                        father[fj] = fi
+            if indexed:
+                IndexedUnion(cdr3IdList, cdr3List, similarity, father)
+            else:
+                PairwiseUnion(cdr3IdList, cdr3List, similarity, father)
     elif mode == "center":
         for key in vjCDR3LenList.keys():
             rawCdr3IdList = vjCDR3LenList[key][:]
@@ -211,12 +277,68 @@ def LargerCluster(rawCdr3List, similarity, prefix, useRepresentative, mode):
                 prefix + "_" + str(i)
             )  # + "_" + cdr3List[cdr3Id][0] + "_" + str(cdr3List[cdr3Id][1])
             cdr3List[cdr3Id][1] = j
-            print("\t".join(str(x) for x in cdr3List[cdr3Id]))
+            print("\t".join(str(x) for x in cdr3List[cdr3Id]), file=output)
             j += 1
 
     return
 
 
+def BenchmarkFixture(size, cdr3Len=45, cloneCnt=50, seed=0):
+    # A synthetic cdr3 list with one large V/J/length bucket: mutated copies of a few public clones.
+    rand = random.Random(seed)
+    clones = [
+        "".join(rand.choice("ACGT") for _ in range(cdr3Len)) for _ in range(cloneCnt)
+    ]
+    cdr3List = []
+    for i in range(size):
+        seq = list(rand.choice(clones))
+        for _ in range(rand.randint(0, cdr3Len // 5)):
+            seq[rand.randrange(cdr3Len)] = rand.choice("ACGT")
+        cdr3List.append(
+            [
+                "assemble" + str(i),
+                0,
+                "TRBV1*01",
+                "*",
+                "TRBJ1-1*01",
+                "TRBC1*01",
+                "*",
+                "*",
+                "".join(seq),
+                1.0,
+                float(rand.randint(1, 100)),
+            ]
+        )
+    return cdr3List
+
+
+def Benchmark(size, similarity=0.8):
+    result = {}
+    for indexed in [True, False]:
+        output = io.StringIO()
+        start = time.time()
+        LargerCluster(
+            BenchmarkFixture(size),
+            similarity,
+            "cluster",
+            False,
+            "aggressive",
+            indexed,
+            output,
+        )
+        result[indexed] = output.getvalue()
+        print(
+            ("indexed" if indexed else "pairwise")
+            + ": %.2f seconds" % (time.time() - start),
+            file=sys.stderr,
+        )
+    if result[True] != result[False]:
+        print(
+            "Different clusters between indexed and pairwise search.", file=sys.stderr
+        )
+        exit(1)
+
+
 if __name__ == "__main__":
     if len(sys.argv) <= 1:
         print(
@@ -226,16 +348,23 @@ if __name__ == "__main__":
             + "\t--prefix STRING: prefix to new cluster name (default: cluster)\n"
             + "\t--center: use the center of the cluster for similarity comparison (default: no)\n"
             + "\t--representative: use representative CDR3 from each contig for cluster (default: no)\n"
-            + "\t--format [cdr3, simplerep]: the input format type (default: cdr3)"
+            + "\t--format [cdr3, simplerep]: the input format type (default: cdr3)\n"
+            + "\t--pairwise: compare every CDR3 pair instead of using the segment index (default: no)\n"
+            + "usage: a.py --benchmark INT: compare indexed and pairwise search on INT synthetic CDR3s"
         )
         exit(1)
 
+    if sys.argv[1] == "--benchmark":
+        Benchmark(int(sys.argv[2]))
+        exit(0)
+
     cdr3List = []
     similarity = 0.8
     prefix = "cluster"
     useRepresentative = False
     mode = "aggressive"
     inputFormat = "cdr3"
+    indexed = True
     i = 2
     while i < len(sys.argv):
         if sys.argv[i] == "-s":
@@ -248,6 +377,8 @@ if __name__ == "__main__":
             useRepresentative = True
         elif sys.argv[i] == "--center":
             mode = "center"
+        elif sys.argv[i] == "--pairwise":
+            indexed = False
         elif sys.argv[i] == "--format":
             inputFormat = sys.argv[i + 1]
             if inputFormat not in ["cdr3", "simplerep"]:
@@ -301,4 +432,4 @@ if __name__ == "__main__":
         cdr3List.append(cols)
         lineCnt += 1
     fp.close()
-    LargerCluster(cdr3List, similarity, prefix, useRepresentative, mode)
+    LargerCluster(cdr3List, similarity, prefix, useRepresentative, mode, indexed)
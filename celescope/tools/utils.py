@@ -1,3 +1,4 @@
+import fcntl
 import glob
 import gzip
 import importlib
@@ -9,7 +10,9 @@ import time
 import unittest
 import json
 import sys
+import tempfile
 from collections import Counter, defaultdict
+from contextlib import contextmanager
 from datetime import timedelta
 from functools import wraps
 
@@ -23,11 +26,17 @@ from celescope.tools.__init__ import (
     OUTS_DIR,
 )
 from celescope.__init__ import ROOT_PATH
+from celescope.tools import profiler
+
+# umask of the process. os.umask can only be read by setting it, which is not thread safe, so it is read once at import.
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 
 def add_log(func):
     """
     logging start and done.
+    Resource usage of each call is recorded by `profiler`.
     """
     logFormatter = logging.Formatter(
         "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -46,17 +55,45 @@ def add_log(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         logger.info("start...")
-        start = time.time()
+        start_usage = profiler.get_usage()
         result = func(*args, **kwargs)
-        end = time.time()
-        used = timedelta(seconds=end - start)
+        used = timedelta(seconds=time.time() - start_usage["time"])
         logger.info("done. time used: %s", used)
+        profiler.add_function_record(logger_name, start_usage)
         return result
 
     wrapper.logger = logger
     return wrapper
 
 
+@contextmanager
+def file_lock(file_name):
+    """
+    Exclusive lock of file_name between processes, using `{file_name}.lock`.
+    fcntl.lockf is used because it also works on NFS.
+    """
+    with open(f"{file_name}.lock", "a") as lock_handle:
+        fcntl.lockf(lock_handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_handle, fcntl.LOCK_UN)
+
+
+def mkstemp_for(file_name):
+    """
+    Create a temporary file of this process in the directory of file_name, to be renamed to file_name.
+    Its permission follows the umask like files created by open().
+    Returns:
+        file descriptor, temporary file path
+    """
+    fd, tmp_file = tempfile.mkstemp(
+        prefix=f"{os.path.basename(file_name)}.", dir=os.path.dirname(file_name) or "."
+    )
+    os.fchmod(fd, 0o666 & ~UMASK)
+    return fd, tmp_file
+
+
 def generic_open(file_name, *args, **kwargs):
     if file_name.endswith(".gz"):
         file_obj = gzip.open(file_name, *args, **kwargs)
@@ -54,11 +54,9 @@ def target_cell_calling(
     # avoid change the original dataframe
     df_temp = df_UMI_sum.copy()
     if target_barcodes:
-        df_temp[umi_col] = df_temp.apply(
-            lambda row: row[umi_col] * weight
-            if row["barcode"] in target_barcodes
-            else row[umi_col],
-            axis=1,
+        is_target = df_temp["barcode"].isin(target_barcodes)
+        df_temp[umi_col] = np.where(
+            is_target, df_temp[umi_col] * weight, df_temp[umi_col]
         )
 
     target_cell_barcodes = set(df_temp.loc[df_temp[umi_col] >= umi_threshold].barcode)
@@ -119,8 +117,9 @@ class Count_vdj(Step):
         ]
 
         if args.target_cell_barcode:
-            self.target_barcodes = utils.read_one_col(args.target_cell_barcode)
-            self.expected_target_cell_num = len(self.target_barcodes)
+            self.target_barcodes, self.expected_target_cell_num = utils.read_one_col(
+                args.target_cell_barcode
+            )
         else:
             self.target_barcodes = None
             self.expected_target_cell_num = args.expected_target_cell_num
@@ -148,8 +147,8 @@ class Count_vdj(Step):
         df_cell = self.df_match_UMI_count_filter[
             self.df_match_UMI_count_filter["barcode"].isin(target_cell_barcodes)
         ]
-        self.df_UMI_sum["mark"] = self.df_UMI_sum["barcode"].apply(
-            lambda x: "CB" if x in target_cell_barcodes else "UB"
+        self.df_UMI_sum["mark"] = np.where(
+            self.df_UMI_sum["barcode"].isin(target_cell_barcodes), "CB", "UB"
         )
         self.df_UMI_sum = self.df_UMI_sum.sort_values(by=["UMI"], ascending=False)
         self.df_UMI_sum.to_csv(self.UMI_sum_file, sep="\t", index=False)
@@ -212,7 +211,7 @@ class Count_vdj(Step):
         df_clonetypes["percent"] = (
             df_clonetypes.barcode / total_CDR3_barcode_number * 100
         )
-        df_clonetypes["percent"] = df_clonetypes["percent"].apply(lambda x: round(x, 2))
+        df_clonetypes["percent"] = df_clonetypes["percent"].round(2)
 
         # add clonetype ID
         df_clonetypes = df_clonetypes.reset_index()
@@ -251,16 +250,12 @@ class Count_vdj(Step):
             iUMI = self.args.BCR_iUMI
 
         for pair in self.pairs:
-            df_pair = df_valid_count.copy()
-            for chain in pair:
-                cdr3_col_name = "aaSeqCDR3_" + chain
-                if cdr3_col_name not in df_pair.columns:
-                    df_pair = pd.DataFrame({"barcode": []})
-                    break
-                else:
-                    df_pair = df_pair[df_pair[cdr3_col_name] != "NA"]
-
-            n_cell_pair = len(df_pair.barcode.unique())
+            cdr3_cols = ["aaSeqCDR3_" + chain for chain in pair]
+            if all(col in df_valid_count.columns for col in cdr3_cols):
+                is_pair = (df_valid_count[cdr3_cols] != "NA").all(axis=1)
+                n_cell_pair = df_valid_count.loc[is_pair, "barcode"].nunique()
+            else:
+                n_cell_pair = 0
 
             pair_str = ",".join(pair)
             self.add_metric(
@@ -291,7 +286,7 @@ class Count_vdj(Step):
         # cloneytpes table
         def format_table(df_clonetypes):
             df_table = df_clonetypes.copy()
-            df_table["percent"] = df_table["percent"].apply(lambda x: str(x) + "%")
+            df_table["percent"] = df_table["percent"].astype(str) + "%"
             seqs = ["aaSeqCDR3"]
             cols = []
             for chain in self.chains:
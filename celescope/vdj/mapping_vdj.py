@@ -12,6 +12,19 @@ from xopen import xopen
 
 
 SPLIT_N_CHUNKS = 4
+# number of AIRR rows loaded at a time in mapping_summary
+AIRR_CHUNKSIZE = 1000000
+AIRR_COLS = [
+    "sequence_id",
+    "locus",
+    "productive",
+    "v_call",
+    "d_call",
+    "j_call",
+    "junction",
+    "junction_aa",
+    "cdr3_aa",
+]
 
 
 class Mapping_vdj(Step):
@@ -115,11 +128,32 @@ class Mapping_vdj(Step):
         self.igblast.logger.info(cmd)
         subprocess.check_call(cmd, shell=True)
 
+    @staticmethod
+    def read_airr(airr_file):
+        """
+        Read the AIRR table in chunks. Only the columns used downstream are loaded.
+        `locus` is loaded as a categorical column.
+
+        Yields:
+            df chunk with empty values filled with ""
+        """
+        reader = pd.read_csv(
+            airr_file,
+            sep="\t",
+            usecols=AIRR_COLS,
+            dtype=str,
+            chunksize=AIRR_CHUNKSIZE,
+        )
+        for df in reader:
+            df.fillna("", inplace=True)
+            df["locus"] = df["locus"].astype("category")
+            yield df
+
     @utils.add_log
     def mapping_summary(self):
         self.add_metric(name="Species", value=self.species, help_info="Human or Mouse")
 
-        df_total_confident = pd.DataFrame()
+        confident_list = []
         (
             total_reads,
             map_to_any_vdj_gene_num,
@@ -127,29 +161,35 @@ class Mapping_vdj(Step):
             correct_cdr3_num,
             confident_num,
         ) = 0, 0, 0, 0, 0
+        chain_count = pd.Series(0, index=self.chains)
 
-        for df in self.airr_out:
-            df = pd.read_csv(df, sep="\t")
-            df.fillna("", inplace=True)
-            total_reads += df.shape[0]
-
-            # mapping to any vdj genes
-            df = df[(df["v_call"] != "") | (df["d_call"] != "") | (df["j_call"] != "")]
-            map_to_any_vdj_gene_num += df.shape[0]
-            # UMIs with CDR3
-            df = df[df["cdr3_aa"] != ""]
-            cdr3_num += df.shape[0]
-            # UMIs with Correct CDR3
-            df = df[
-                ~(df["cdr3_aa"].str.contains(r"\*"))
-                & ~(df["cdr3_aa"].str.contains("X"))
-            ]
-            correct_cdr3_num += df.shape[0]
-            # UMIs Mapped Confidently To VJ Gene
-            df = df[df["productive"] == "T"]
-            confident_num += df.shape[0]
+        for airr_file in self.airr_out:
+            for df in self.read_airr(airr_file):
+                total_reads += df.shape[0]
+
+                # mapping to any vdj genes
+                map_to_any = (
+                    (df["v_call"] != "") | (df["d_call"] != "") | (df["j_call"] != "")
+                )
+                # UMIs with CDR3
+                with_cdr3 = map_to_any & (df["cdr3_aa"] != "")
+                # UMIs with Correct CDR3
+                correct_cdr3 = with_cdr3 & ~df["cdr3_aa"].str.contains(
+                    r"[*X]", regex=True
+                )
+                # UMIs Mapped Confidently To VJ Gene
+                confident = correct_cdr3 & (df["productive"] == "T")
+
+                map_to_any_vdj_gene_num += int(map_to_any.sum())
+                cdr3_num += int(with_cdr3.sum())
+                correct_cdr3_num += int(correct_cdr3.sum())
+                confident_num += int(confident.sum())
 
-            df_total_confident = pd.concat([df_total_confident, df])
+                df = df[confident]
+                chain_count = chain_count.add(
+                    df["locus"].value_counts().reindex(self.chains, fill_value=0)
+                )
+                confident_list.append(df)
 
         self.add_metric(
             name="UMIs Mapped to Any VDJ Gene",
@@ -178,43 +218,32 @@ class Mapping_vdj(Step):
 
         # UMIs Mapped Confidently to each chain
         for chain in self.chains:
-            df_chain = df_total_confident[df_total_confident.locus == chain]
             self.add_metric(
                 name=f"UMIs Mapped to {chain}",
-                value=df_chain.shape[0],
+                value=int(chain_count[chain]),
                 total=total_reads,
                 help_info=f"UMIs mapped confidently to {chain}",
             )
 
         # output file
-        df_VJ = df_total_confident[
-            [
-                "sequence_id",
-                "locus",
-                "v_call",
-                "d_call",
-                "j_call",
-                "junction",
-                "junction_aa",
-            ]
-        ]
-        df_VJ.rename(
-            columns={
-                "sequence_id": "readID",
-                "locus": "chain",
-                "v_call": "bestVGene",
-                "d_call": "bestDGene",
-                "j_call": "bestJGene",
-                "junction": "nSeqCDR3",
-                "junction_aa": "aaSeqCDR3",
-            },
-            inplace=True,
+        if confident_list:
+            df_total_confident = pd.concat(confident_list, ignore_index=True)
+        else:
+            df_total_confident = pd.DataFrame(columns=AIRR_COLS)
+        df_VJ = pd.DataFrame(
+            {
+                "readID": df_total_confident["sequence_id"],
+                "chain": df_total_confident["locus"].astype(str),
+                "bestVGene": df_total_confident["v_call"].str.split("*").str[0],
+                "bestDGene": df_total_confident["d_call"].str.split("*").str[0],
+                "bestJGene": df_total_confident["j_call"].str.split("*").str[0],
+                "nSeqCDR3": df_total_confident["junction"],
+                "aaSeqCDR3": df_total_confident["junction_aa"],
+            }
         )
-        df_VJ["barcode"] = df_VJ["readID"].apply(lambda x: x.split(":")[0])
-        df_VJ["UMI"] = df_VJ["readID"].apply(lambda x: x.split(":")[1])
-
-        for i in ["bestVGene", "bestDGene", "bestJGene"]:
-            df_VJ[i] = df_VJ[i].apply(lambda x: x.split("*")[0])
+        read_attr = df_VJ["readID"].str.split(":")
+        df_VJ["barcode"] = read_attr.str[0]
+        df_VJ["UMI"] = read_attr.str[1]
 
         # filter1: keep top 1 in each combinations
         groupby_elements = [
@@ -0,0 +1,45 @@
+import random
+import unittest
+
+from celescope.bulk_vdj.count_vdj import correct_cdr3_nt
+from celescope.tools import utils
+
+
+def correct_cdr3_nt_pairwise(umi_dict, percent=0.1):
+    """pairwise version of correct_cdr3_nt"""
+    correct_dict = dict()
+    umi_arr = sorted(umi_dict.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+    while len(umi_arr) > 1:
+        low_seq, low_count = umi_arr.pop()
+        for high_seq, high_count in umi_arr:
+            if len(low_seq) != len(high_seq):
+                break
+            if float(low_count / high_count) > percent:
+                break
+            if utils.hamming_distance(low_seq, high_seq) == 1:
+                correct_dict[low_seq] = high_seq
+                umi_dict[high_seq] += umi_dict[low_seq]
+                del umi_dict[low_seq]
+                break
+    return correct_dict
+
+
+class Test_count_vdj(unittest.TestCase):
+    def test_correct_cdr3_nt(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            length = rng.choice([4, 5])
+            umi_dict = {}
+            for _ in range(rng.randint(0, 50)):
+                seq_len = length if rng.random() < 0.9 else length + 1
+                seq = "".join(rng.choice("ACGT") for _ in range(seq_len))
+                umi_dict[seq] = rng.choice([1, 2, 3, 10, 50, 200])
+            percent = rng.choice([0.1, 0.5])
+            expected_dict = dict(umi_dict)
+            expected = correct_cdr3_nt_pairwise(expected_dict, percent)
+            self.assertEqual(correct_cdr3_nt(umi_dict, percent), expected)
+            self.assertEqual(umi_dict, expected_dict)
+
+
+if __name__ == "__main__":
+    unittest.main()
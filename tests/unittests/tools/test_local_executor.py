@@ -0,0 +1,91 @@
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from celescope.tools import local_executor
+from celescope.tools.local_executor import Local_executor
+
+
+def get_job(cmd, after=(), m=1, x=1):
+    return {"cmd": cmd, "m": m, "x": x, "after": list(after)}
+
+
+@mock.patch.object(local_executor, "POLL_INTERVAL", 0.05)
+class Test_local_executor(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_dir = f"{self.tmp_dir}/log"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_retry(self):
+        flag = f"{self.tmp_dir}/flag"
+        job_dict = {
+            # fails at the first attempt
+            "flaky": get_job(f"test -f {flag} || (touch {flag}; exit 1)"),
+            "after_flaky": get_job("true", after=["flaky"]),
+        }
+        executor = Local_executor(job_dict, 2, 4, self.log_dir, retry=1)
+        self.assertEqual(executor.run(), [])
+        self.assertEqual(executor.status_dict["flaky"]["attempts"], 2)
+        self.assertEqual(executor.status_dict["after_flaky"]["attempts"], 1)
+
+    def test_skip_dependents(self):
+        job_dict = {
+            "fail": get_job("exit 3"),
+            "child": get_job("true", after=["fail"]),
+            "grandchild": get_job("true", after=["child"]),
+            "other": get_job("true"),
+        }
+        executor = Local_executor(job_dict, 2, 4, self.log_dir, retry=2)
+        self.assertEqual(executor.run(), ["fail", "child", "grandchild"])
+
+        with open(f"{self.log_dir}/local_status.json") as f:
+            status_dict = json.load(f)
+        self.assertEqual(status_dict["fail"]["status"], local_executor.FAILED)
+        self.assertEqual(status_dict["fail"]["attempts"], 3)
+        self.assertEqual(status_dict["fail"]["returncode"], 3)
+        for name in ("child", "grandchild"):
+            self.assertEqual(status_dict[name]["status"], local_executor.SKIPPED)
+            self.assertEqual(status_dict[name]["attempts"], 0)
+        self.assertEqual(status_dict["other"]["status"], local_executor.DONE)
+
+    def test_over_budget_job_runs_alone(self):
+        time_file = f"{self.tmp_dir}/time.txt"
+
+        def timed(name):
+            return (
+                f"echo {name} start $(date +%s.%N) >> {time_file}; sleep 0.3; "
+                f"echo {name} end $(date +%s.%N) >> {time_file}"
+            )
+
+        job_dict = {
+            "small1": get_job(timed("small1")),
+            "big": get_job(timed("big"), m=100, x=16),
+            "small2": get_job(timed("small2")),
+            "small3": get_job(timed("small3")),
+        }
+        executor = Local_executor(job_dict, 2, 4, self.log_dir)
+        self.assertEqual(executor.run(), [])
+
+        intervals = {}
+        with open(time_file) as f:
+            for line in f:
+                name, event, time = line.split()
+                intervals.setdefault(name, {})[event] = float(time)
+        big = intervals.pop("big")
+        for name, interval in intervals.items():
+            self.assertTrue(
+                interval["end"] <= big["start"] or interval["start"] >= big["end"],
+                name,
+            )
+        # small jobs that fit still run at the same time
+        self.assertLess(intervals["small1"]["start"], intervals["small2"]["end"])
+        self.assertLess(intervals["small2"]["start"], intervals["small1"]["end"])
+
+
+if __name__ == "__main__":
+    unittest.main()
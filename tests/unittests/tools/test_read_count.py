@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from celescope.tools.capture.read_count import Read_count
+
+
+class Test_read_count(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.count_dict = {
+            "AAAA": {"virus1": {"UMI1": 3, "UMI2": 1}, "virus2": {"UMI1": 2}},
+            "CCCC": {"virus1": {"UMI3": 5}},
+            "GGGG": {"virus2": {"UMI2": 0, "UMI4": 7}},
+        }
+
+    def assert_same(self, read_count, other):
+        for name in Read_count.ARRAY_NAMES:
+            np.testing.assert_array_equal(
+                getattr(read_count, name), getattr(other, name)
+            )
+
+    def test_npz_round_trip(self):
+        read_count = Read_count.from_count_dict(self.count_dict)
+        npz_file = f"{self.tmp_dir}/test_raw_read_count.npz"
+        read_count.to_file(npz_file)
+        loaded = Read_count.from_file(npz_file)
+        self.assert_same(loaded, read_count)
+        self.assertEqual(loaded.to_count_dict(), self.count_dict)
+
+    def test_empty_round_trip(self):
+        read_count = Read_count.from_count_dict({})
+        npz_file = f"{self.tmp_dir}/empty.npz"
+        read_count.to_file(npz_file)
+        loaded = Read_count.from_file(npz_file)
+        self.assertEqual(len(loaded), 0)
+        self.assertEqual(loaded.to_count_dict(), {})
+
+    def test_legacy_json(self):
+        json_file = f"{self.tmp_dir}/test_raw_read_count.json"
+        with open(json_file, "w") as f:
+            json.dump(self.count_dict, f, indent=4)
+        from_json = Read_count.from_file(json_file)
+        self.assertEqual(from_json.to_count_dict(), self.count_dict)
+
+        npz_file = f"{self.tmp_dir}/test_raw_read_count.npz"
+        Read_count.from_count_dict(self.count_dict).to_file(npz_file)
+        self.assert_same(from_json, Read_count.from_file(npz_file))
+        self.assertFalse(os.path.exists(f"{npz_file}.npz"))
+
+    def test_groups(self):
+        read_count = Read_count.from_count_dict(self.count_dict)
+        starts, ends = read_count.group_bounds()
+        self.assertEqual(starts.tolist(), [0, 2, 3, 4])
+        self.assertEqual(ends.tolist(), [2, 3, 4, 6])
+
+        barcode_code, ref_code, umi_count = read_count.barcode_ref_umi()
+        pairs = [
+            (read_count.barcodes[b], read_count.refs[r], n)
+            for b, r, n in zip(barcode_code, ref_code, umi_count)
+        ]
+        self.assertEqual(
+            pairs,
+            [
+                ("AAAA", "virus1", 2),
+                ("AAAA", "virus2", 1),
+                ("CCCC", "virus1", 1),
+                ("GGGG", "virus2", 1),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
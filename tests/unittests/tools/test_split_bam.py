@@ -0,0 +1,115 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pysam
+
+from celescope.tools import split_bam
+from celescope.tools.split_bam import split_bam_by_barcode
+
+N_GROUP = 7
+
+
+def has_gene_tag(seg):
+    return seg.has_tag("XT")
+
+
+class Test_split_bam(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bam_file = f"{self.tmp_dir}/in.bam"
+        rng = random.Random(0)
+        header = {
+            "HD": {"VN": "1.6", "SO": "coordinate"},
+            "SQ": [{"SN": "chr1", "LN": 3_000_000}, {"SN": "chr2", "LN": 2_000_000}],
+        }
+        barcodes = [f"BARCODE{i}" for i in range(10)]
+        # barcode9 is not in any group
+        self.barcode_group = {
+            barcode: i % N_GROUP for i, barcode in enumerate(barcodes[:-1])
+        }
+        with pysam.AlignmentFile(self.bam_file, "wb", header=header) as bam:
+            segs = []
+            for i in range(2000):
+                seg = pysam.AlignedSegment(bam.header)
+                seg.query_name = f"read{i}"
+                seg.query_sequence = "A" * 50
+                seg.query_qualities = pysam.qualitystring_to_array("I" * 50)
+                if i % 20 == 0:
+                    seg.is_unmapped = True
+                    seg.reference_id = -1
+                    seg.reference_start = -1
+                else:
+                    seg.reference_id = rng.randint(0, 1)
+                    seg.reference_start = rng.randint(0, 1_900_000)
+                    seg.cigarstring = "50M"
+                    if i % 3:
+                        seg.set_tag("XT", "gene")
+                if i % 50:
+                    seg.set_tag("CB", rng.choice(barcodes))
+                segs.append(seg)
+            segs.sort(
+                key=lambda seg: (seg.is_unmapped, seg.reference_id, seg.reference_start)
+            )
+            for seg in segs:
+                bam.write(seg)
+        pysam.index(self.bam_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def split(self, name, thread, **kwargs):
+        out_bams = [f"{self.tmp_dir}/{name}_{group}.bam" for group in range(N_GROUP)]
+        split_bam_by_barcode(
+            self.bam_file, self.barcode_group, out_bams, thread=thread, **kwargs
+        )
+        records = []
+        for out_bam in out_bams:
+            self.assertTrue(os.path.exists(f"{out_bam}.bai"))
+            with pysam.AlignmentFile(out_bam, "rb") as bam:
+                records.append([seg.to_string() for seg in bam])
+        return records
+
+    def expected(self, read_filter=None):
+        records = [[] for _ in range(N_GROUP)]
+        with pysam.AlignmentFile(self.bam_file, "rb") as bam:
+            for seg in bam:
+                if read_filter is not None and not read_filter(seg):
+                    continue
+                if seg.has_tag("CB") and seg.get_tag("CB") in self.barcode_group:
+                    records[self.barcode_group[seg.get_tag("CB")]].append(
+                        seg.to_string()
+                    )
+        return records
+
+    def test_sharded_and_single_pass(self):
+        expected = self.expected()
+        self.assertTrue(any("\t4\t*\t" in record for record in expected[0]))
+        self.assertEqual(self.split("single", thread=1), expected)
+        self.assertEqual(self.split("sharded", thread=4), expected)
+
+    def test_read_filter(self):
+        expected = self.expected(has_gene_tag)
+        self.assertEqual(
+            self.split("single", thread=1, read_filter=has_gene_tag), expected
+        )
+        self.assertEqual(
+            self.split("sharded", thread=4, read_filter=has_gene_tag), expected
+        )
+
+    def test_group_batches(self):
+        expected = self.expected()
+        with mock.patch.object(split_bam, "MAX_OPEN_FILES", 2):
+            self.assertEqual(self.split("single", thread=1), expected)
+            self.assertEqual(self.split("sharded", thread=4), expected)
+
+    def test_no_output(self):
+        split_bam_by_barcode(self.bam_file, {}, [], thread=4)
+        split_bam_by_barcode(self.bam_file, {}, [], thread=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+from celescope.tools import step_cache
+
+# names of steps run by the tests, in run order
+calls = []
+
+
+def sample(args):
+    calls.append("sample")
+    os.makedirs(args.outdir, exist_ok=True)
+    with open(f"{args.outdir}/stat.txt", "w") as f:
+        f.write("sample")
+
+
+def barcode(args):
+    calls.append("barcode")
+    os.makedirs(args.outdir, exist_ok=True)
+    with open(f"{args.outdir}/stat.txt", "w") as f:
+        f.write("barcode")
+
+
+def assemble(args):
+    calls.append("assemble")
+    os.makedirs(args.outdir, exist_ok=True)
+
+
+class Test_step_cache(unittest.TestCase):
+    def setUp(self):
+        calls.clear()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sample_dir = f"{self.tmp_dir}/test1"
+        self.fq = f"{self.tmp_dir}/R1.fq"
+        with open(self.fq, "w") as f:
+            f.write("@read\nACGT\n+\nFFFF\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_args(self, func, outdir_name, thread=4, assay="rna"):
+        return argparse.Namespace(
+            func=func,
+            subparser_assay=assay,
+            outdir=f"{self.sample_dir}/{outdir_name}",
+            sample="test1",
+            fq1=self.fq,
+            thread=thread,
+            resume=True,
+        )
+
+    def manifest_steps(self):
+        return list(
+            step_cache.load_manifest(f"{self.sample_dir}/{step_cache.MANIFEST_FILE}")
+        )
+
+    def test_skip_unchanged(self):
+        step_cache.run_step(self.get_args(sample, "00.sample"))
+        step_cache.run_step(self.get_args(sample, "00.sample"))
+        self.assertEqual(calls, ["sample"])
+
+        # thread does not change outputs of most steps
+        step_cache.run_step(self.get_args(sample, "00.sample", thread=8))
+        self.assertEqual(calls, ["sample"])
+
+        args = self.get_args(sample, "00.sample")
+        args.resume = False
+        step_cache.run_step(args)
+        self.assertEqual(calls, ["sample", "sample"])
+
+    def test_rerun_changed_input(self):
+        step_cache.run_step(self.get_args(sample, "00.sample"))
+        stat = os.stat(self.fq)
+        os.utime(self.fq, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        step_cache.run_step(self.get_args(sample, "00.sample"))
+        self.assertEqual(calls, ["sample", "sample"])
+
+    def test_rerun_changed_output(self):
+        step_cache.run_step(self.get_args(sample, "00.sample"))
+        os.remove(f"{self.sample_dir}/00.sample/stat.txt")
+        step_cache.run_step(self.get_args(sample, "00.sample"))
+        self.assertEqual(calls, ["sample", "sample"])
+
+    def test_drop_downstream(self):
+        step_cache.run_step(self.get_args(sample, "00.sample"))
+        step_cache.run_step(self.get_args(barcode, "01.barcode"))
+        self.assertEqual(self.manifest_steps(), ["sample", "barcode"])
+
+        stat = os.stat(self.fq)
+        os.utime(self.fq, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        step_cache.run_step(self.get_args(sample, "00.sample"))
+        self.assertEqual(self.manifest_steps(), ["sample"])
+
+        # barcode is unchanged, but it is rerun after sample
+        step_cache.run_step(self.get_args(barcode, "01.barcode"))
+        self.assertEqual(calls, ["sample", "barcode", "sample", "barcode"])
+        self.assertEqual(self.manifest_steps(), ["sample", "barcode"])
+
+    def test_thread_dependent_step(self):
+        step_cache.run_step(self.get_args(assemble, "02.assemble", assay="flv_trust4"))
+        step_cache.run_step(
+            self.get_args(assemble, "02.assemble", thread=8, assay="flv_trust4")
+        )
+        self.assertEqual(calls, ["assemble", "assemble"])
+
+
+if __name__ == "__main__":
+    unittest.main()